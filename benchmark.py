@@ -0,0 +1,592 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+import jsonCodec
+from bundleParser import RESOURCE_TEXT, iter_bundle_entries
+from storage import BACKENDS
+
+'''
+Benchmarks for the FHIR ingestion pipeline.
+Run with "python benchmark.py <benchmark>", see --help for the benchmarks available.
+'''
+
+PARSE_METHODS = ("full", "stream", "default")
+BENCHMARK_DATABASE = "patient_benchmark"
+
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def parse_file(file_path, method):
+    """
+    Function to parse a bundle and touch every entry, the same way the loader consumes it
+    :param file_path: A file path to a .json file
+    :param method: "full" to json.loads the whole file, "stream" to use the incremental parser for every
+    file or "default" to read it the way the loader does
+    :return: the number of entries in the bundle
+    """
+    count = 0
+    if method == "full":
+        with open(file_path, 'r', encoding='utf-8') as file:
+            json_data = json.loads(file.read())
+        for _ in json_data["entry"]:
+            count += 1
+    else:
+        entries = iter_bundle_entries(file_path, whole_file_limit=0) if method == "stream" else \
+            iter_bundle_entries(file_path)
+        for _ in entries:
+            count += 1
+    return count
+
+
+def measure_parse_memory(file_paths, method):
+    """
+    Function to record the peak Python heap used while parsing each file
+    :param file_paths: the files to parse
+    :param method: the parse method, one of PARSE_METHODS
+    :return: a list of (file path, file size, peak bytes) tuples
+    """
+    results = []
+    for file_path in file_paths:
+        tracemalloc.start()
+        parse_file(file_path, method)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((file_path, os.path.getsize(file_path), peak))
+    return results
+
+
+def current_peak_rss():
+    """
+    Function to get the peak resident set size of this process
+    VmHWM is used where available as ru_maxrss is carried over from the parent across fork and exec.
+    :return: the peak RSS in bytes
+    """
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def peak_rss(file_paths, method):
+    """
+    Function to parse every file in a fresh interpreter and return its peak resident set size
+    :param file_paths: the files to parse
+    :param method: the parse method, one of PARSE_METHODS
+    :return: the peak RSS in bytes
+    """
+    output = subprocess.run([sys.executable, __file__, "parse", method] + file_paths,
+                            check=True, capture_output=True, text=True).stdout
+    return int(output.split()[-1])
+
+
+def benchmark_memory(directory):
+    """
+    Compare the memory needed to parse every bundle in a directory with json.loads, with the streaming parser
+    and the way the loader reads it
+    :param directory: A directory containing files in JSON Format
+    :return:
+    """
+    file_paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".json"))
+    print("Parsing " + str(len(file_paths)) + " bundles from " + directory)
+    print()
+    print("{:<8}{:>18}{:>18}{:>18}".format("Method", "Largest file MB", "Peak heap MB", "Peak RSS MB"))
+    for method in PARSE_METHODS:
+        results = measure_parse_memory(file_paths, method)
+        largest = max(results, key=lambda result: result[1])
+        peak = max(result[2] for result in results)
+        print("{:<8}{:>18.2f}{:>18.2f}{:>18.2f}".format(
+            method, largest[1] / 2 ** 20, peak / 2 ** 20, peak_rss(file_paths, method) / 2 ** 20))
+
+
+def parse_resource_mix(text):
+    """
+    Function to read a resource mix such as "Observation=2,Claim=0.5"
+    :param text: comma separated resourceType=weight pairs, may be empty
+    :return: a dictionary of resource type to weight
+    """
+    resource_mix = {}
+    if text:
+        for pair in text.split(","):
+            resource_type, weight = pair.split("=")
+            resource_mix[resource_type.strip()] = float(weight)
+    return resource_mix
+
+
+def new_uuid(rng):
+    """
+    Function to make a random UUID from a seeded generator so generated data is repeatable
+    :param rng: a random.Random
+    :return: the UUID as a string
+    """
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def synthesise_bundle(template, rng, resource_mix):
+    """
+    Function to make a new bundle shaped like a sample bundle
+    Each non-Patient entry is copied weight times on average, where weight comes from the resource mix and
+    defaults to 1. Every UUID in the bundle is then replaced, consistently, so the bundle describes a new
+    patient whose references still resolve.
+    :param template: a sample FHIR Bundle
+    :param rng: a random.Random
+    :param resource_mix: a dictionary of resource type to weight
+    :return: the unique id of the new patient and the bundle as JSON text
+    """
+    entries = []
+    for entry in template["entry"]:
+        resource_type = entry["resource"]["resourceType"]
+        weight = 1.0 if resource_type == "Patient" else resource_mix.get(resource_type, 1.0)
+        copies = int(weight) + (1 if rng.random() < weight - int(weight) else 0)
+        for copy in range(copies):
+            if copy:
+                entry = json.loads(json.dumps(entry))
+                entry["resource"]["id"] = new_uuid(rng)
+                entry["fullUrl"] = "urn:uuid:" + entry["resource"]["id"]
+            entries.append(entry)
+
+    mapping = {}
+    text = UUID_PATTERN.sub(lambda match: mapping.setdefault(match.group(0), new_uuid(rng)),
+                            json.dumps({"resourceType": "Bundle", "type": template["type"], "entry": entries}))
+    return mapping[template["entry"][0]["resource"]["id"]], text
+
+
+def generate_bundles(source_dir, output_dir, scale, resource_mix=None, seed=0):
+    """
+    Function to generate scale synthetic bundles for every sample bundle in source_dir
+    :param source_dir: A directory of sample bundles, e.g. data
+    :param output_dir: the directory the generated bundles are written to
+    :param scale: the number of bundles generated from each sample
+    :param resource_mix: a dictionary of resource type to weight
+    :param seed: the random seed, the same seed always generates the same bundles
+    :return: the number of bundles written
+    """
+    rng = random.Random(seed)
+    resource_mix = resource_mix or {}
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    for f in sorted(os.listdir(source_dir)):
+        if not f.endswith(".json"):
+            continue
+        with open(os.path.join(source_dir, f), 'r', encoding='utf-8') as file:
+            template = json.load(file)
+        name = template["entry"][0]["resource"]["name"][0]
+        for _ in range(scale):
+            unique_id, text = synthesise_bundle(template, rng, resource_mix)
+            file_name = name["given"][0] + "_" + name["family"] + "_" + unique_id + ".json"
+            with open(os.path.join(output_dir, file_name), 'w', encoding='utf-8') as file:
+                file.write(text)
+            count += 1
+    print("Generated " + str(count) + " bundles in " + output_dir)
+    return count
+
+
+def reset_peak_rss():
+    """
+    Function to reset this process's peak RSS so the next stage is measured on its own
+    Only supported on Linux, elsewhere the peak carries over from earlier stages.
+    :return:
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def run_stage(name, stage):
+    """
+    Function to time a pipeline stage and record its throughput and memory
+    :param name: the stage name, used in the progress output
+    :param stage: a function returning the number of files and rows it handled
+    :return: a dictionary of the stage's measurements
+    """
+    print("Running " + name + "....")
+    reset_peak_rss()
+    started = time.perf_counter()
+    files, rows = stage()
+    seconds = time.perf_counter() - started
+    result = {"seconds": seconds, "files": files, "rows": rows,
+              "files_per_sec": files / seconds if seconds else 0, "rows_per_sec": rows / seconds if seconds else 0,
+              "peak_rss_bytes": current_peak_rss()}
+    print("    {:.3f}s, {:.1f} files/sec, {:.1f} rows/sec".format(seconds, result["files_per_sec"],
+                                                                result["rows_per_sec"]))
+    return result
+
+
+def transform_file(file_path, dataReader):
+    """
+    Function to build every row the loader would write for a bundle, without writing them
+    :param file_path: A file path to a .json file
+    :param dataReader: the dataReader module
+    :return: the number of rows built
+    """
+    rows = 0
+    # typed resources are flattened a batch per type, as the loader does
+    typed = {}
+    for entry in iter_bundle_entries(file_path):
+        resource = entry["resource"]
+        if resource["resourceType"] == "Patient":
+            dataReader.patient_row(resource, resource["id"])
+            rows += 1 + len(resource.get("communication", [])) + len(resource.get("telecom", [])) + \
+                len(resource.get("identifier", []))
+        else:
+            dataReader.content_hash(entry.get(RESOURCE_TEXT) or jsonCodec.dumps(resource))
+            rows += 1
+            if resource["resourceType"] in dataReader.RESOURCE_TABLES:
+                typed.setdefault(resource["resourceType"], []).append(resource)
+    for resource_type, resources in typed.items():
+        columns = dataReader.RESOURCE_TABLES[resource_type][1].flatten(resources)
+        rows += len(columns["resource_id"])
+    return rows
+
+
+def benchmark_codecs(directory, codecs=None):
+    """
+    Compare the time each JSON codec takes to decode the bundles in a directory and to encode their resources
+    Decoding is timed over whole files read as bytes, encoding over every resource, the work add_event does.
+    Times are given per GB of JSON decoded or produced.
+    :param directory: A directory containing files in JSON Format
+    :param codecs: the codecs to compare, by default every codec available
+    :return: a dictionary of codec to its measurements
+    """
+    file_paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".json"))
+    previous = jsonCodec.CODEC
+    results = {}
+    print("{:<8}{:>14}{:>14}{:>14}{:>14}".format("Codec", "Decode s/GB", "Decode MB/s", "Encode s/GB",
+                                                 "Encode MB/s"))
+    for codec in codecs or jsonCodec.available_codecs():
+        jsonCodec.use_codec(codec)
+        decoded_bytes = encoded_bytes = 0
+        decode_seconds = encode_seconds = 0.0
+        for file_path in file_paths:
+            with open(file_path, 'rb') as file:
+                data = file.read()
+            started = time.perf_counter()
+            bundle = jsonCodec.loads(data)
+            decode_seconds += time.perf_counter() - started
+            decoded_bytes += len(data)
+            started = time.perf_counter()
+            for entry in bundle["entry"]:
+                encoded_bytes += len(jsonCodec.dumps(entry["resource"]))
+            encode_seconds += time.perf_counter() - started
+        results[codec] = {"decode_seconds_per_gb": decode_seconds / decoded_bytes * 2 ** 30,
+                          "encode_seconds_per_gb": encode_seconds / encoded_bytes * 2 ** 30}
+        print("{:<8}{:>14.2f}{:>14.1f}{:>14.2f}{:>14.1f}".format(
+            codec, results[codec]["decode_seconds_per_gb"], decoded_bytes / decode_seconds / 2 ** 20,
+            results[codec]["encode_seconds_per_gb"], encoded_bytes / encode_seconds / 2 ** 20))
+    jsonCodec.use_codec(previous)
+    return results
+
+
+def reset_database(dataReader):
+    """
+    Function to drop the benchmark database so every run loads into an empty one
+    :param dataReader: the dataReader module
+    :return:
+    """
+    dataReader.storage_backend().drop_database()
+
+
+def benchmark_pipeline(directory, report_path, workers=1, batch_size=None, bundles_per_commit=1, export=True,
+                       backend=None, codec=None):
+    """
+    Run the parse, transform, load and export stages over a directory of bundles and write a JSON report
+    The load stage uses its own database, BENCHMARK_DATABASE, which is dropped at the start of each run.
+    With the sqlite or duckdb backend it is a file of that name in the working directory.
+    :param directory: A directory containing files in JSON Format
+    :param report_path: the file the JSON report is written to
+    :param workers: the number of processes loading files
+    :param batch_size: the maximum number of rows sent in one executemany
+    :param bundles_per_commit: the number of bundles written in each transaction
+    :param export: False to skip the CSV export stage
+    :param backend: the storage backend to load into, by default dataReader.STORAGE_BACKEND
+    :param codec: the JSON codec used, by default the fastest available
+    :return: the report
+    """
+    import dataReader
+
+    if codec:
+        jsonCodec.use_codec(codec)
+    dataReader.DB_NAME = BENCHMARK_DATABASE
+    dataReader.DB_PATH = None
+    if backend:
+        dataReader.STORAGE_BACKEND = backend
+    file_paths = dataReader.list_json_files(directory)
+    stages = {}
+
+    stages["parse"] = run_stage("parse", lambda: (len(file_paths), sum(parse_file(path, "default")
+                                                                       for path in file_paths)))
+    stages["transform"] = run_stage("transform", lambda: (len(file_paths), sum(transform_file(path, dataReader)
+                                                                               for path in file_paths)))
+
+    reset_database(dataReader)
+    dataReader.init_database()
+    load_result = {}
+
+    def load():
+        load_result.update(dataReader.load_files(file_paths, batch_size or dataReader.BATCH_SIZE,
+                                                 bundles_per_commit, workers))
+        return len(file_paths) - len(load_result["failed"]), sum(rows for rows, _ in load_result["stats"].values())
+
+    stages["load"] = run_stage("load", load)
+    if workers > 1:
+        # ru_maxrss for children is the largest of any worker process
+        stages["load"]["worker_peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    if export:
+        output_dir = tempfile.mkdtemp(prefix="benchmark_csv_")
+
+        def export_csv():
+            dataReader.create_csv_files(output_dir)
+            event_files = sum(len(files) - 1 for _, _, files in os.walk(output_dir) if "patient.csv" in files)
+            return len(os.listdir(output_dir)), event_files
+
+        stages["export"] = run_stage("export", export_csv)
+        shutil.rmtree(output_dir)
+
+    report = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "directory": directory,
+        "files": len(file_paths),
+        "bytes": sum(os.path.getsize(path) for path in file_paths),
+        "settings": {"backend": dataReader.storage_backend().name, "json_codec": jsonCodec.CODEC, "workers": workers, "batch_size": batch_size or dataReader.BATCH_SIZE,
+                     "bundles_per_commit": bundles_per_commit},
+        "stages": stages,
+        "tables": {table: {"rows": rows, "seconds": seconds}
+                   for table, (rows, seconds) in load_result["stats"].items()},
+        "failed_files": len(load_result["failed"])
+    }
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print("Report written to " + report_path)
+    return report
+
+
+def stored_event_bytes(dataReader):
+    """
+    Function to measure the event payloads as stored, the text of uncompressed events and the compressed bytes
+    of the others
+    :param dataReader: the dataReader module
+    :return: the number of events, the bytes stored as text and the bytes stored compressed
+    """
+    con = dataReader.connect_patient_db()
+    db_cursor = con.cursor(buffered=False)
+    db_cursor.execute("SELECT event_data, event_blob FROM patient_event")
+    events = text_bytes = blob_bytes = 0
+    for event_data, event_blob in dataReader.fetch_rows(db_cursor):
+        events += 1
+        if event_data is not None:
+            text_bytes += len(str(event_data).encode("utf-8"))
+        if event_blob is not None:
+            blob_bytes += len(event_blob)
+    db_cursor.close()
+    con.close()
+    return events, text_bytes, blob_bytes
+
+
+def directory_digest(directory):
+    """
+    :param directory: an export directory
+    :return: the SHA-1 of the names and contents of every file in it
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            digest.update(os.path.relpath(os.path.join(root, name), directory).encode("utf-8"))
+            with open(os.path.join(root, name), 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+def benchmark_compression(directory, report_path, modes=None, backend="sqlite", export_workers=1):
+    """
+    Load the same bundles once for each way of storing events and write a JSON report of the bytes stored and
+    the ingest and export throughput
+    Each load uses a fresh BENCHMARK_DATABASE. The dictionary is trained before the load starts and timed on
+    its own. The export is the batched CSV export, which decodes every event, and its output is compared with
+    the uncompressed load's to check decompression gives back the same files.
+    :param directory: A directory containing files in JSON Format
+    :param report_path: the file the JSON report is written to
+    :param modes: the storage modes to compare, by default none and every payload codec available
+    :param backend: the storage backend to load into, by default sqlite so the file size can be reported
+    :param export_workers: the number of processes writing the CSV export
+    :return: the report
+    """
+    import dataReader
+    import payloadCodec
+
+    dataReader.DB_NAME = BENCHMARK_DATABASE
+    dataReader.DB_PATH = None
+    dataReader.STORAGE_BACKEND = backend
+    file_paths = dataReader.list_json_files(directory)
+    source_bytes = sum(os.path.getsize(path) for path in file_paths)
+    results = {}
+    baseline_digest = None
+    for mode in modes or ["none"] + payloadCodec.available_codecs():
+        reset_database(dataReader)
+        dataReader.init_database()
+        dataReader.EVENT_COMPRESSION = mode
+        result = {}
+        train_seconds = 0.0
+        if mode != "none":
+            con = dataReader.connect_patient_db()
+            started = time.perf_counter()
+            dictionary_id = dataReader.train_payload_dictionary(con, mode, file_paths)
+            train_seconds = time.perf_counter() - started
+            con.close()
+            result["dictionary_bytes"] = len(payloadCodec.get_dictionary(dictionary_id)) if dictionary_id else 0
+        result["train_seconds"] = train_seconds
+
+        started = time.perf_counter()
+        load_result = dataReader.load_files(file_paths)
+        result["ingest_seconds"] = time.perf_counter() - started
+        result["failed_files"] = len(load_result["failed"])
+        result["events"], text_bytes, blob_bytes = stored_event_bytes(dataReader)
+        result["stored_bytes"] = text_bytes + blob_bytes
+        database_file = dataReader.storage_backend().file_path("." + backend)
+        if backend != "mysql" and os.path.exists(database_file):
+            result["database_file_bytes"] = os.path.getsize(database_file)
+
+        output_dir = tempfile.mkdtemp(prefix="benchmark_csv_")
+        started = time.perf_counter()
+        dataReader.create_csv_files(output_dir, workers=export_workers, layout="per-type")
+        result["export_seconds"] = time.perf_counter() - started
+        digest = directory_digest(output_dir)
+        shutil.rmtree(output_dir)
+        if baseline_digest is None:
+            baseline_digest = digest
+        result["export_matches_first"] = digest == baseline_digest
+        results[mode] = result
+
+    dataReader.EVENT_COMPRESSION = "none"
+    first = next(iter(results.values()))
+    print("{:<8}{:>14}{:>10}{:>14}{:>10}{:>12}{:>12}{:>10}".format(
+        "Mode", "Stored bytes", "Saved", "DB file", "Train s", "Ingest MB/s", "Export ev/s", "Same CSV"))
+    for mode, result in results.items():
+        saved = 1 - result["stored_bytes"] / first["stored_bytes"] if first["stored_bytes"] else 0
+        print("{:<8}{:>14}{:>9.1f}%{:>14}{:>10.3f}{:>12.2f}{:>12.0f}{:>10}".format(
+            mode, result["stored_bytes"], saved * 100, result.get("database_file_bytes", "-"),
+            result["train_seconds"], source_bytes / result["ingest_seconds"] / 2 ** 20,
+            result["events"] / result["export_seconds"], "yes" if result["export_matches_first"] else "NO"))
+
+    report = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "directory": directory,
+        "files": len(file_paths),
+        "bytes": source_bytes,
+        "settings": {"backend": backend, "json_codec": jsonCodec.CODEC, "export_workers": export_workers},
+        "modes": results
+    }
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print("Report written to " + report_path)
+    return report
+
+
+def compare_reports(old_path, new_path):
+    """
+    Print the change in time and throughput of each stage between two benchmark reports
+    :param old_path: the earlier report
+    :param new_path: the later report
+    :return:
+    """
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print("{:<12}{:>12}{:>12}{:>10}{:>14}{:>14}".format("Stage", "Old s", "New s", "Change", "Old rows/s",
+                                                        "New rows/s"))
+    for stage, result in new["stages"].items():
+        if stage not in old["stages"]:
+            continue
+        before = old["stages"][stage]
+        change = (result["seconds"] - before["seconds"]) / before["seconds"] * 100 if before["seconds"] else 0
+        print("{:<12}{:>12.3f}{:>12.3f}{:>+9.1f}%{:>14.1f}{:>14.1f}".format(
+            stage, before["seconds"], result["seconds"], change, before["rows_per_sec"], result["rows_per_sec"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the FHIR ingestion pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    memory_parser = subparsers.add_parser("memory", help="compare peak memory of full and streaming bundle parsing")
+    memory_parser.add_argument("--directory", default="data")
+
+    generate_parser = subparsers.add_parser("generate", help="generate synthetic bundles shaped like the samples")
+    generate_parser.add_argument("--source", default="data")
+    generate_parser.add_argument("--output", default=None, help="defaults to bench_data/x<scale>")
+    generate_parser.add_argument("--scale", type=int, default=10, help="bundles generated per sample bundle")
+    generate_parser.add_argument("--resource-mix", default="",
+                                 help="average copies of each resource type, e.g. Observation=2,Claim=0.5")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="time parse, transform, load and export")
+    pipeline_parser.add_argument("--directory", default="data")
+    pipeline_parser.add_argument("--report", default="benchmark_report.json")
+    pipeline_parser.add_argument("--workers", type=int, default=1)
+    pipeline_parser.add_argument("--batch-size", type=int, default=None)
+    pipeline_parser.add_argument("--bundles-per-commit", type=int, default=1)
+    pipeline_parser.add_argument("--no-export", action="store_true", help="skip the CSV export stage")
+    pipeline_parser.add_argument("--backend", choices=BACKENDS, default=None,
+                                 help="storage backend loaded into, sqlite and duckdb need no database server")
+
+    pipeline_parser.add_argument("--json-codec", choices=jsonCodec.available_codecs(), default=None)
+
+    codec_parser = subparsers.add_parser("codec", help="compare decode and encode time per GB of each JSON codec")
+    codec_parser.add_argument("--directory", default="data")
+
+    compression_parser = subparsers.add_parser("compression",
+                                               help="compare bytes stored, ingest and export with each way of "
+                                                    "storing events")
+    compression_parser.add_argument("--directory", default="data")
+    compression_parser.add_argument("--report", default="compression_report.json")
+    compression_parser.add_argument("--modes", nargs="+", default=None, help="by default none, zlib and zstd")
+    compression_parser.add_argument("--backend", choices=BACKENDS, default="sqlite")
+    compression_parser.add_argument("--export-workers", type=int, default=1)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two pipeline reports")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    # used by peak_rss to parse in a clean process
+    parse_parser = subparsers.add_parser("parse")
+    parse_parser.add_argument("method", choices=PARSE_METHODS)
+    parse_parser.add_argument("files", nargs="+")
+
+    args = parser.parse_args()
+    if args.benchmark == "memory":
+        benchmark_memory(args.directory)
+    elif args.benchmark == "generate":
+        generate_bundles(args.source, args.output or os.path.join("bench_data", "x" + str(args.scale)), args.scale,
+                         parse_resource_mix(args.resource_mix), args.seed)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(args.directory, args.report, args.workers, args.batch_size, args.bundles_per_commit,
+                           not args.no_export, args.backend, args.json_codec)
+    elif args.benchmark == "codec":
+        benchmark_codecs(args.directory)
+    elif args.benchmark == "compression":
+        benchmark_compression(args.directory, args.report, args.modes, args.backend, args.export_workers)
+    elif args.benchmark == "compare":
+        compare_reports(args.old, args.new)
+    elif args.benchmark == "parse":
+        for path in args.files:
+            parse_file(path, args.method)
+        print(current_peak_rss())
@@ -0,0 +1,203 @@
+import json
+import mmap
+import os
+import re
+
+import jsonCodec
+
+'''
+Incremental reader for FHIR Bundles.
+Rather than loading a whole bundle with json.loads, the file is read in chunks and the top level of the
+Bundle is tokenized by hand. Each item of the "entry" array is decoded on its own and handed to the caller,
+so only one entry and one chunk of text are ever held in memory regardless of the size of the bundle.
+When the fast codec is available, bundles up to WHOLE_FILE_LIMIT bytes are instead read as bytes, memory
+mapped from MMAP_THRESHOLD bytes, and decoded in one call, which is quicker than decoding entry by entry but
+holds the whole decoded bundle at once. Set PATIENT_WHOLE_FILE_LIMIT to trade memory for speed, 0 always streams.
+'''
+
+CHUNK_SIZE = 64 * 1024
+# a decoded bundle takes about four times its file size in memory, so this adds up to about 4MB to the peak
+# over streaming. Decoding whole is about twice as fast, but the flat memory of streaming matters more for
+# the large bundles
+WHOLE_FILE_LIMIT = int(os.environ.get("PATIENT_WHOLE_FILE_LIMIT", 1024 * 1024))
+MMAP_THRESHOLD = 1024 * 1024
+# entry key holding the resource's text from the file, set by the streaming reader when it is one line
+RESOURCE_TEXT = "_resource_text"
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class BundleFormatError(ValueError):
+    """
+    Raised when a file does not have the shape of a FHIR Bundle
+    """
+
+
+class _TextBuffer:
+    """
+    A window over a text file that is refilled as values are consumed
+    """
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        """
+        Drop the text already consumed and read at least size more characters
+        :param size: the number of characters to read
+        :return: True if more text was read, False at the end of the file
+        """
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it
+        :return: the next non whitespace character
+        """
+        while True:
+            self.pos = _whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill(self.chunk_size):
+                raise BundleFormatError("Unexpected end of bundle")
+
+    def expect(self, characters):
+        """
+        Consume the next character, which must be one of characters
+        :param characters: the characters allowed next
+        :return: the character consumed
+        """
+        character = self.peek()
+        if character not in characters:
+            raise BundleFormatError("Expected one of " + characters + " but found " + character)
+        self.pos += 1
+        return character
+
+    def value(self, keep_text=False):
+        """
+        Decode the next complete JSON value, reading more of the file until it fits in the buffer
+        :param keep_text: True to also return the value's text as it appears in the file
+        :return: the decoded value, or a tuple of the value and its text if keep_text is True
+        """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # a number at the very end of the buffer may carry on in the next chunk
+                if self.eof or not isinstance(value, (int, float)) or \
+                        (end < len(self.text) and self.text[end] not in ".eE+-"):
+                    text = self.text[self.pos:end] if keep_text else None
+                    self.pos = end
+                    return (value, text) if keep_text else value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read geometrically more each retry so a large value is decoded in linear time
+            if not self.fill(max(size, len(self.text))):
+                continue
+            size *= 2
+
+
+def _entry(buffer):
+    """
+    Decode one item of the entry array, keeping the resource's own text when it is on a single line
+    so it can be stored without encoding the resource again
+    :param buffer: the _TextBuffer positioned at the item
+    :return: the entry dictionary
+    """
+    if buffer.peek() != "{":
+        return buffer.value()
+    buffer.expect("{")
+    entry = {}
+    if buffer.peek() == "}":
+        buffer.expect("}")
+        return entry
+    while True:
+        key = buffer.value()
+        buffer.expect(":")
+        if key == "resource":
+            entry[key], text = buffer.value(keep_text=True)
+            if "\n" not in text:
+                entry[RESOURCE_TEXT] = text
+        else:
+            entry[key] = buffer.value()
+        if buffer.expect(",}") == "}":
+            return entry
+
+
+def iter_entries(file, chunk_size=CHUNK_SIZE):
+    """
+    Generator yielding each item of a Bundle's entry array from an open text file
+    :param file: a file object opened in text mode
+    :param chunk_size: the number of characters read from the file at a time
+    :return: an iterator of entry dictionaries
+    """
+    buffer = _TextBuffer(file, chunk_size)
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        return
+    while True:
+        key = buffer.value()
+        buffer.expect(":")
+        if key == "entry":
+            buffer.expect("[")
+            if buffer.peek() != "]":
+                while True:
+                    yield _entry(buffer)
+                    if buffer.expect(",]") == "]":
+                        break
+            else:
+                buffer.expect("]")
+        else:
+            buffer.value()
+        if buffer.expect(",}") == "}":
+            return
+
+
+def read_bundle(file_path, size):
+    """
+    Function to decode a whole bundle file with the codec from its bytes
+    Files of MMAP_THRESHOLD bytes or more are memory mapped so the file is not copied into the heap first.
+    :param file_path: A file path to a .json file
+    :param size: the size of the file in bytes
+    :return: the decoded bundle
+    """
+    with open(file_path, 'rb') as file:
+        if size < MMAP_THRESHOLD:
+            return jsonCodec.loads(file.read())
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            return jsonCodec.loads(view)
+
+
+def iter_bundle_entries(file_path, chunk_size=CHUNK_SIZE, whole_file_limit=None):
+    """
+    Generator yielding each item of the entry array in a FHIR Bundle file
+    :param file_path: A file path to a .json file
+    :param chunk_size: the number of characters read from the file at a time
+    :param whole_file_limit: the largest file decoded in one call when the fast codec is in use, by default
+    WHOLE_FILE_LIMIT
+    :return: an iterator of entry dictionaries
+    """
+    if whole_file_limit is None:
+        whole_file_limit = WHOLE_FILE_LIMIT
+    size = os.path.getsize(file_path)
+    if jsonCodec.CODEC != "json" and 0 < size <= whole_file_limit:
+        bundle = read_bundle(file_path, size)
+        if not isinstance(bundle, dict):
+            raise BundleFormatError("Expected a Bundle object")
+        yield from bundle.get("entry", [])
+        return
+    with open(file_path, 'r', encoding='utf-8') as file:
+        yield from iter_entries(file, chunk_size)
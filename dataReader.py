@@ -1,11 +1,27 @@
+import argparse
+import hashlib
+import importlib.util
+import io
 import json
+import multiprocessing
 import os
+import shutil
+import sys
 from os import listdir
 from os.path import isfile, join
-import mysql.connector
-from tkinter import *
+import time
+from datetime import datetime
 import csv
-import pandas as pd
+import jsonCodec
+import payloadCodec
+from bundleParser import RESOURCE_TEXT, iter_bundle_entries
+from metrics import METRICS
+from resourceTables import (RESOURCE_TABLE_COLUMNS, RESOURCE_TABLES, CREATE_TABLES, GENERIC_EVENT_EXTRACTOR,
+                            PATIENT_EXTRACTOR)
+from storage import BACKENDS, create_backend
+from summaryTables import (CLAIM_TOTAL_PLACES, CREATE_TABLES as CREATE_SUMMARY_TABLES, SUMMARY_RESOURCE_TYPES,
+                           SUMMARY_TABLE_COLUMNS, empty_summaries, read_summaries, rebuild_summaries,
+                           update_patient_summaries)
 
 '''
 An external system / supplier is sending patient data to our platform using the FHIR standard. 
@@ -14,63 +30,384 @@ This program will transform these FHIR messages into a more workable format.
 '''
 
 
+DB_NAME = "patient_database"
+DB_CONFIG = {
+    "host": os.environ.get("PATIENT_DB_HOST", "mydb"),
+    "user": os.environ.get("PATIENT_DB_USER", "root"),
+    "password": os.environ.get("PATIENT_DB_PASSWORD", "root"),
+    "port": int(os.environ.get("PATIENT_DB_PORT", "3306"))
+}
+POOL_SIZE = int(os.environ.get("PATIENT_DB_POOL_SIZE", "4"))
+# mysql, sqlite or duckdb, see storage.py
+STORAGE_BACKEND = os.environ.get("PATIENT_DB_BACKEND", "mysql")
+# the database file for sqlite and duckdb, by default DB_NAME with the backend's extension
+DB_PATH = os.environ.get("PATIENT_DB_PATH")
+BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+ROWS_PER_PARQUET_FILE = 100000
+ROWS_PER_CSV_FILE = 100000
+# a folder per patient with a file per event, or each resource type's events batched into large files
+CSV_LAYOUTS = ("per-event", "per-type")
+# patients on each page of the patient browser
+UI_PAGE_SIZE = 100
+# the columns the patient browser can be ordered by
+UI_SORT_COLUMNS = ("patient_id", "unique_id", "given_name", "family_name")
+# patient ranges per export worker, so the work stays balanced when some patients have many more events
+SHARDS_PER_WORKER = 4
+# patient table columns exported to Parquet as numbers, the others are written as text
+PATIENT_PARQUET_NUMBERS = {"patient_id": int, "address_latitude": float, "address_longitude": float,
+                           "disability_adjusted_life_years": float, "quality_adjusted_life_years": float}
+# flattened columns for resource types exported to Parquet without a typed table
+GENERIC_EVENT_COLUMNS = GENERIC_EVENT_EXTRACTOR.columns
+# none, zlib or zstd, how new events are stored, see payloadCodec. Compressed events are kept in event_blob
+EVENT_COMPRESSION = os.environ.get("PATIENT_EVENT_COMPRESSION", "none")
+# bundle files sampled for the resources a payload dictionary is trained on
+PAYLOAD_SAMPLE_FILES = 50
+# seconds to wait for another session to finish with a patient before giving up on the bundle
+LOCK_TIMEOUT = 30
+
+# columns written by the bulk loader for each table, in insert order
+TABLE_COLUMNS = {
+    "patient": ("unique_id", "given_name", "family_name", "birth_date", "birth_sex", "gender", "mother",
+                "marital_status", "name_use", "address_line", "address_city", "address_state", "address_country",
+                "address_latitude", "address_longitude", "birth_city", "birth_state", "birth_country",
+                "us_core_ethnicity", "us_core_race", "prefix", "death_dateTime", "multiple_birth",
+                "disability_adjusted_life_years", "quality_adjusted_life_years", "content_hash"),
+    "patient_language": ("patient", "language"),
+    "patient_contact": ("patient", "contact_system", "type", "value"),
+    "patient_identifier": ("patient", "id_system", "type", "value"),
+    "patient_event": ("patient", "event_data", "type", "resource_id", "content_hash", "event_blob"),
+    "ingest_manifest": ("file_path", "file_size", "mtime", "content_hash", "processed_at", "run_id",
+                        "patient_unique_id"),
+    **RESOURCE_TABLE_COLUMNS,
+    **SUMMARY_TABLE_COLUMNS
+}
+
+_backend = None
+
+
+def storage_backend():
+    """
+    Function to get the storage backend the patient database is kept in
+    The backend is created on first use from STORAGE_BACKEND, DB_NAME, DB_CONFIG, POOL_SIZE and DB_PATH.
+    :return: the StorageBackend
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_backend(STORAGE_BACKEND, DB_NAME, DB_CONFIG, POOL_SIZE, DB_PATH)
+    return _backend
+
+
 def connect_patient_db():
     """
     Function to connect to the patient database
-    :return: the mySql connection or False if connection fails
+    With MySQL, connections are handed out from a pool that is created on first use. The pool is recreated
+    if the process has been forked so connections are never shared between processes.
+    :return: the database connection or False if connection fails
+    """
+    return storage_backend().connect()
+
+
+def insert_sql(table):
+    """
+    Function to build the parameterised INSERT statement for one of the patient tables
+    :param table: the table name, must be a key of TABLE_COLUMNS
+    :return: the INSERT statement
+    """
+    columns = TABLE_COLUMNS[table]
+    return "INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + \
+           ", ".join(["%s"] * len(columns)) + ")"
+
+
+class BulkLoader:
+    """
+    Writes rows to the patient tables in batches on a single pooled connection.
+
+    Child rows are buffered per table and sent with executemany once batch_size rows are waiting or the
+    bundle ends. Resources for the typed tables are buffered as they are and flattened a batch at a time.
+    The transaction is committed every bundles_per_commit bundles and each bundle is protected by a
+    savepoint so a bad bundle can be rolled back on its own.
+    Rows and time spent are recorded per table so throughput can be reported at the end of a run.
     """
-    try:
-        return mysql.connector.connect(
-            host="mydb",
-            user="root",
-            password="root",
-            database="patient_database",
-            port=3306
-        )
-    except:
-        print("The Patient Database does not exist.")
-        return False
+
+    def __init__(self, con=None, batch_size=BATCH_SIZE, bundles_per_commit=1, run_id=None):
+        self.con = con or connect_patient_db()
+        if not self.con:
+            raise ConnectionError("Cannot connect to the Patient Database")
+        self.backend = storage_backend()
+        self.cursor = self.con.cursor()
+        self.batch_size = batch_size
+        # without savepoints a failed bundle rolls back the whole transaction, so it must hold only one
+        self.bundles_per_commit = bundles_per_commit if self.backend.savepoints else 1
+        self.buffers = {table: [] for table in TABLE_COLUMNS}
+        # typed table to its extractor and the patient ids and resources waiting to be flattened
+        self.resources = {}
+        self.stats = {table: [0, 0.0] for table in TABLE_COLUMNS}
+        self.commits = [0, 0.0]
+        self.pending_bundles = 0
+        self.locks = []
+        # the ingest_manifest as committed, and the entries written in the open transaction, which are only
+        # added to it once they are committed
+        self.manifest = None
+        self.manifest_pending = []
+        self.bundle_manifest_start = 0
+        # files whose bundles were committed as part of a transaction that was then lost, see abort_transaction
+        self.lost_files = []
+        # the ingest_run the files loaded are recorded against in the manifest
+        self.run_id = run_id
+        self.patients = None
+        self.unchanged_files = 0
+        # the payload_dictionary new events are compressed with, looked up on first use
+        self.payload_dictionary = None
+        self.started = time.perf_counter()
+
+    def insert(self, table, row):
+        """
+        Insert a single row straight away, used where the generated id is needed for child rows
+        :param table: the table to insert into
+        :param row: a tuple of values in TABLE_COLUMNS order
+        :return: the id of the new row
+        """
+        start = time.perf_counter()
+        row_id = self.backend.insert(self.cursor, insert_sql(table), row, table + "_id")
+        self._record(table, 1, start)
+        return row_id
+
+    def add(self, table, row):
+        """
+        Buffer a row to be written with the next batch for its table
+        :param table: the table to insert into
+        :param row: a tuple of values in TABLE_COLUMNS order
+        :return:
+        """
+        buffer = self.buffers[table]
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flush(table)
+
+    def add_resource(self, patient_id, resource):
+        """
+        Buffer a resource to be flattened into its typed table with the next batch
+        :param patient_id: the database id of the resource's patient
+        :param resource: a FHIR resource whose type is in RESOURCE_TABLES
+        :return:
+        """
+        table, extractor = RESOURCE_TABLES[resource["resourceType"]]
+        pending = self.resources.get(table)
+        if pending is None:
+            pending = self.resources[table] = (extractor, [], [])
+        pending[1].append(patient_id)
+        pending[2].append(resource)
+        if len(pending[2]) >= self.batch_size:
+            self.flush(table)
+
+    def flatten(self, table=None):
+        """
+        Flatten buffered resources into rows for their typed tables, one pass over each batch
+        :param table: the table to flatten for, or None for every table
+        :return:
+        """
+        for name in ([table] if table else list(self.resources)):
+            pending = self.resources.pop(name, None)
+            if pending is not None:
+                extractor, patient_ids, resources = pending
+                with METRICS.timer("flatten"):
+                    columns = extractor.flatten(resources, {"patient": patient_ids})
+                self.buffers[name].extend(zip(*columns.values()))
+
+    def flush(self, table=None):
+        """
+        Send buffered rows to the database with one executemany per table
+        :param table: the table to flush, or None to flush every table
+        :return:
+        """
+        self.flatten(table)
+        for name in ([table] if table else TABLE_COLUMNS):
+            rows = self.buffers[name]
+            if rows:
+                start = time.perf_counter()
+                self.cursor.executemany(insert_sql(name), rows)
+                self._record(name, len(rows), start)
+                self.buffers[name] = []
+
+    def begin_bundle(self):
+        """
+        Mark the start of a bundle so it can be rolled back without losing earlier bundles
+        :return:
+        """
+        self.flush()
+        self.backend.savepoint(self.cursor)
+        self.bundle_manifest_start = len(self.manifest_pending)
+
+    def end_bundle(self):
+        """
+        Mark the end of a bundle, committing once bundles_per_commit bundles are waiting
+        :return:
+        """
+        self.pending_bundles += 1
+        if self.pending_bundles >= self.bundles_per_commit:
+            self.commit()
+
+    def abort_bundle(self):
+        """
+        Discard everything written or buffered since begin_bundle
+        :return:
+        """
+        self.buffers = {table: [] for table in TABLE_COLUMNS}
+        self.resources = {}
+        del self.manifest_pending[self.bundle_manifest_start:]
+        try:
+            self.backend.rollback_to_savepoint(self.con, self.cursor)
+        except self.backend.Error as e:
+            # after a deadlock or a lost connection the server has already rolled back the whole transaction,
+            # and the savepoint with it
+            METRICS.error("rollback_to_savepoint", e)
+            self.abort_transaction()
+
+    def abort_transaction(self):
+        """
+        Roll back the open transaction, failing every bundle written in it rather than only the current one
+        The files of the bundles that had already ended are added to lost_files for the caller to report.
+        :return:
+        """
+        try:
+            self.con.rollback()
+        except self.backend.Error as e:
+            METRICS.error("rollback", e)
+        self.lost_files.extend(file_path for file_path, _ in self.manifest_pending)
+        self.manifest_pending = []
+        self.bundle_manifest_start = 0
+        self.pending_bundles = 0
+        # patients added in the transaction were cached as stored
+        self.patients = None
+        for name in self.locks:
+            try:
+                self.backend.release_lock(self.cursor, name)
+            except self.backend.Error as e:
+                METRICS.error("release_lock", e)
+        self.locks = []
+
+    def take_lost_files(self):
+        """
+        :return: the files whose bundles have been rolled back since the last call, see abort_transaction
+        """
+        lost, self.lost_files = self.lost_files, []
+        return lost
+
+    def commit(self):
+        """
+        Flush all buffers and commit the open transaction
+        :return:
+        """
+        self.flush()
+        start = time.perf_counter()
+        self.con.commit()
+        self.commits[0] += 1
+        self.commits[1] += time.perf_counter() - start
+        METRICS.observe("db_commit", time.perf_counter() - start)
+        self.pending_bundles = 0
+        if self.manifest is not None:
+            self.manifest.update(self.manifest_pending)
+        self.manifest_pending = []
+        self.bundle_manifest_start = 0
+        for name in self.locks:
+            self.backend.release_lock(self.cursor, name)
+        self.locks = []
+
+    def close(self):
+        """
+        Commit anything outstanding and return the connection to the pool
+        :return:
+        """
+        self.commit()
+        self.cursor.close()
+        self.con.close()
+
+    def lock_patient(self, unique_id):
+        """
+        Take a named database lock on a patient so no other session can insert the same patient
+        The lock is held until the transaction commits. If another session holds it, anything pending
+        is committed first so two sessions can never wait on each other's locks.
+        :param unique_id: the unique patient ID from the bundle
+        :return: True if the lock was acquired, False if it timed out
+        """
+        name = "patient:" + unique_id
+        if not self.backend.try_lock(self.cursor, name, 0):
+            self.commit()
+            if not self.backend.try_lock(self.cursor, name, LOCK_TIMEOUT):
+                return False
+        self.locks.append(name)
+        return True
+
+    def report(self):
+        """
+        Print the rows written and throughput for each table
+        :return:
+        """
+        print_load_report(self.stats, self.commits, time.perf_counter() - self.started)
+
+    def rows_written(self):
+        """
+        :return: the total number of rows written to every table
+        """
+        return sum(rows for rows, _ in self.stats.values())
+
+    def _record(self, table, rows, start):
+        seconds = time.perf_counter() - start
+        stats = self.stats[table]
+        stats[0] += rows
+        stats[1] += seconds
+        METRICS.observe("db_write." + table, seconds)
+
+
+def print_load_report(stats, commits, elapsed):
+    """
+    Function to print the rows written and throughput for each table
+    :param stats: a dictionary of table name to [rows, seconds]
+    :param commits: [number of commits, seconds spent committing]
+    :param elapsed: the wall clock time of the load in seconds
+    :return:
+    """
+    print()
+    print("{:<28}{:>10}{:>12}{:>12}".format("Table", "Rows", "Seconds", "Rows/sec"))
+    for table, (rows, seconds) in stats.items():
+        rate = rows / seconds if seconds else 0
+        print("{:<28}{:>10}{:>12.3f}{:>12.1f}".format(table, rows, seconds, rate))
+    print(str(commits[0]) + " commits took " + "{:.3f}".format(commits[1]) + "s")
+    print("Total time " + "{:.3f}".format(elapsed) + "s")
 
 
 def init_database():
     """
     Function to initialise the patient database
     If the database exists then it will return true
-    If the database does not exist it will create the database patient_database on the mySQL server
+    If the database does not exist it will create the database patient_database in the storage backend
     along with the appropriate tables patient, patient_identifier, patient_contact, patient_event and patient_language
+    The typed resource tables from resourceTables are created if missing, whether or not the database is new
 
-    If the function cannot connect to the mySQL server it will return false
+    If the function cannot connect to the database server it will return false
 
     :return: Boolean
     """
+    backend = storage_backend()
     # try to connect to the patient_database
-    if not connect_patient_db():
+    con = connect_patient_db()
+    if not con:
         # if can't connect to patient_database as it does not exist then create it
         print("Creating Patient Database...")
-        try:
-            root_con = mysql.connector.connect(
-                host="mydb",
-                user="root",
-                password="root",
-                port=3306
-            )
-
-        except:
-            print("Error: cannot connect to the server")
+        if not backend.create_database():
             return False
-
-        root_cursor = root_con.cursor()
-
-        # create patient_database
-        root_cursor.execute("CREATE DATABASE patient_database")
-        root_con.close()
-
         con = connect_patient_db()
-        db_cursor = con.cursor()
+        if not con:
+            return False
+
+    db_cursor = con.cursor()
+    if not backend.table_exists(db_cursor, "patient"):
+        print("Creating Patient Tables...")
 
         # create patient table
-        db_cursor.execute(
-            "CREATE TABLE patient (patient_id INT NOT NULL AUTO_INCREMENT, unique_id VARCHAR(37), "
+        backend.create_table(db_cursor,
+            "CREATE TABLE patient (patient_id INT NOT NULL AUTO_INCREMENT, unique_id VARCHAR(37) NOT NULL, "
             "given_name VARCHAR(255), "
             "family_name VARCHAR(255), birth_date VARCHAR(255), birth_sex VARCHAR(2), gender VARCHAR(255), "
             "mother VARCHAR(255), marital_status VARCHAR(255), name_use VARCHAR(255), address_line VARCHAR(255), "
@@ -78,438 +415,2026 @@ def init_database():
             "DECIMAL(8,6), address_longitude DECIMAL(9,6), birth_city VARCHAR(255), birth_state VARCHAR(255), "
             "birth_country VARCHAR(255), us_core_ethnicity VARCHAR(255), us_core_race VARCHAR(255), prefix VARCHAR("
             "255), death_dateTime VARCHAR(255), multiple_birth VARCHAR(255), disability_adjusted_life_years FLOAT, "
-            "quality_adjusted_life_years FLOAT, PRIMARY KEY(patient_id))")
+            "quality_adjusted_life_years FLOAT, content_hash CHAR(40), PRIMARY KEY(patient_id), "
+            "UNIQUE INDEX unique_id (unique_id))")
 
         # create patient_contact table
-        db_cursor.execute(
+        backend.create_table(db_cursor,
             "CREATE TABLE patient_contact (patient_contact_id MEDIUMINT NOT NULL AUTO_INCREMENT, patient INT, "
             "contact_system VARCHAR(255), type VARCHAR(255), value VARCHAR(255), PRIMARY KEY(patient_contact_id), "
-            "FOREIGN KEY (patient) REFERENCES patient(patient_id))")
+            "INDEX patient (patient), FOREIGN KEY (patient) REFERENCES patient(patient_id))")
 
         # create patient_identifier table
-        db_cursor.execute(
+        backend.create_table(db_cursor,
             "CREATE TABLE patient_identifier (patient_identifier_id MEDIUMINT NOT NULL AUTO_INCREMENT, patient INT , "
             "id_system VARCHAR(255), type VARCHAR(255), value VARCHAR(255), PRIMARY KEY(patient_identifier_id), "
-            "FOREIGN KEY (patient) REFERENCES "
+            "INDEX patient (patient), FOREIGN KEY (patient) REFERENCES "
             "patient(patient_id))")
 
         # create patient_language table
-        db_cursor.execute(
+        backend.create_table(db_cursor,
             "CREATE TABLE patient_language (patient_language_id MEDIUMINT NOT NULL AUTO_INCREMENT, patient INT, "
-            "language VARCHAR(255), PRIMARY KEY(patient_language_id), FOREIGN KEY (patient) REFERENCES "
-            "patient(patient_id))")
+            "language VARCHAR(255), PRIMARY KEY(patient_language_id), INDEX patient (patient), "
+            "FOREIGN KEY (patient) REFERENCES patient(patient_id))")
 
         # create patient_event table
-        db_cursor.execute(
+        backend.create_table(db_cursor,
             "CREATE TABLE patient_event (patient_event_id MEDIUMINT NOT NULL AUTO_INCREMENT, patient INT, "
-            "event_data LONGTEXT, type VARCHAR(255), PRIMARY KEY(patient_event_id), FOREIGN KEY (patient) REFERENCES "
-            "patient(patient_id))")
+            "event_data LONGTEXT, type VARCHAR(255), resource_id VARCHAR(64), content_hash CHAR(40), "
+            "event_blob LONGBLOB, PRIMARY KEY(patient_event_id), INDEX patient_resource (patient, resource_id), "
+            "FOREIGN KEY (patient) REFERENCES patient(patient_id))")
 
-        con.close()
         print("Patient Database created successfully")
         print()
-        return True
-    else:
-        return True
+
+    migrate_database(con)
+    con.close()
+    return True
 
 
-def add_patient(patient_data, patient_id):
+def migrate_database(con):
     """
-    A function to add the patient to the database and record their information
-    :param patient_data: the json formatted data for the patient
-    :param patient_id: the unique patient ID to be used when adding to the database
+    Function to bring a database created by an earlier version up to the current schema
+    Tables, columns and indexes added after the first release are applied here so older databases gain them.
+    Every step checks whether it is needed first, so this is safe to run on every start.
+    :param con: a connection to the patient database
     :return:
     """
+    backend = storage_backend()
+    db_cursor = con.cursor()
+    for statement in CREATE_TABLES + CREATE_SUMMARY_TABLES:
+        backend.create_table(db_cursor, statement)
+    backend.create_table(
+        db_cursor, "CREATE TABLE IF NOT EXISTS ingest_manifest (file_path VARCHAR(255) NOT NULL, file_size BIGINT, "
+        "mtime DOUBLE, content_hash CHAR(64), processed_at DATETIME, run_id INT, patient_unique_id VARCHAR(64), "
+        "PRIMARY KEY(file_path))")
+    backend.create_table(
+        db_cursor, "CREATE TABLE IF NOT EXISTS ingest_run (run_id INT NOT NULL AUTO_INCREMENT, directory VARCHAR(255), "
+        "file_count INT, started_at DATETIME, finished_at DATETIME, PRIMARY KEY(run_id))")
+    backend.create_table(
+        db_cursor, "CREATE TABLE IF NOT EXISTS schema_migration (name VARCHAR(64) NOT NULL, applied_at DATETIME, "
+        "PRIMARY KEY(name))")
+    backend.create_table(
+        db_cursor, "CREATE TABLE IF NOT EXISTS payload_dictionary (dictionary_id INT NOT NULL AUTO_INCREMENT, "
+        "codec VARCHAR(8), dictionary LONGBLOB, sample_count INT, created_at DATETIME, PRIMARY KEY(dictionary_id))")
+    ensure_column(db_cursor, "patient", "content_hash", "CHAR(40)")
+    ensure_column(db_cursor, "ingest_manifest", "run_id", "INT")
+    ensure_column(db_cursor, "ingest_manifest", "patient_unique_id", "VARCHAR(64)")
+    ensure_index(db_cursor, "ingest_manifest", "patient_unique_id", "patient_unique_id")
+    ensure_column(db_cursor, "patient_event", "event_blob", "LONGBLOB")
+    if ensure_column(db_cursor, "patient_event", "resource_id", "VARCHAR(64)"):
+        ensure_column(db_cursor, "patient_event", "content_hash", "CHAR(40)")
+    ensure_index(db_cursor, "patient_event", "patient_resource", "patient, resource_id")
+    for table in ("patient_contact", "patient_identifier", "patient_language"):
+        ensure_index(db_cursor, table, "patient", "patient")
+    # the summaries read a patient's typed rows after each bundle, MySQL already indexes the foreign key
+    for table, _ in RESOURCE_TABLES.values():
+        ensure_index(db_cursor, table, "patient", "patient")
+
+    if not index_exists(db_cursor, "patient", "unique_id"):
+        remove_duplicate_patients(con)
+        ensure_index(db_cursor, "patient", "unique_id", "unique_id", unique=True)
+    apply_migration(con, "backfill_event_hashes", backfill_event_hashes)
+    apply_migration(con, "swap_patient_geolocation", swap_patient_geolocation)
+    apply_migration(con, "resolve_manifest_paths", resolve_manifest_paths)
+    apply_migration(con, "build_summary_tables", build_summary_tables)
+    apply_migration(con, "round_claim_totals", round_claim_totals)
+    con.commit()
+
+
+def apply_migration(con, name, migration):
+    """
+    Function to run a one off change to the stored data, unless it has already been applied
+    Applied migrations are recorded by name in the schema_migration table.
+    :param con: a connection to the patient database
+    :param name: the name the migration is recorded under
+    :param migration: a function taking the connection that makes the change
+    :return: True if the migration was applied, False if it already had been
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT name FROM schema_migration WHERE name=%s", (name,))
+    if db_cursor.fetchone() is not None:
+        return False
+    print("Applying migration " + name)
+    migration(con)
+    db_cursor.execute("INSERT INTO schema_migration (name, applied_at) VALUES (%s, %s)", (name, datetime.utcnow()))
+    con.commit()
+    return True
 
-    con = connect_patient_db()
+
+def swap_patient_geolocation(con):
+    """
+    Function to correct patients loaded when the latitude was read from the longitude extension and the
+    longitude from the latitude extension
+    :param con: a connection to the patient database
+    :return:
+    """
     db_cursor = con.cursor()
+    db_cursor.execute("SELECT patient_id, address_latitude, address_longitude FROM patient")
+    updates = [(longitude, latitude, patient_id) for patient_id, latitude, longitude in db_cursor.fetchall()]
+    if updates:
+        print("Swapping the latitude and longitude of " + str(len(updates)) + " patients")
+        db_cursor.executemany("UPDATE patient SET address_latitude=%s, address_longitude=%s WHERE patient_id=%s",
+                              updates)
 
-    birth_date = patient_data["birthDate"]
-    birth_sex = patient_data["extension"][3]["valueCode"]
-    mothers_maiden_name = str(patient_data["extension"][2]["valueString"]).replace("'", "''")
-    marital_status = patient_data["maritalStatus"]["text"]
-    gender = patient_data["gender"]
-    family_name = str(patient_data["name"][0]["family"]).replace("'", "''")
-    name_use = patient_data["name"][0]["use"]
-    disability_adjusted_life_years = str(patient_data["extension"][5]["valueDecimal"])
-    quality_adjusted_life_years = str(patient_data["extension"][6]["valueDecimal"])
-
-    home_address_line = str(patient_data["address"][0]["line"][0]).replace("'", "''")
-    home_address_city = str(patient_data["address"][0]["city"]).replace("'", "''")
-    home_address_state = str(patient_data["address"][0]["state"]).replace("'", "''")
-    home_address_country = str(patient_data["address"][0]["country"]).replace("'", "''")
-    home_address_longitude = str(patient_data["address"][0]["extension"][0]["extension"][0]["valueDecimal"])
-    home_address_latitude = str(patient_data["address"][0]["extension"][0]["extension"][1]["valueDecimal"])
-
-    birth_place_city = str(patient_data["extension"][4]["valueAddress"]["city"]).replace("'", "''")
-    birth_place_state = str(patient_data["extension"][4]["valueAddress"]["state"]).replace("'", "''")
-    birth_place_country = str(patient_data["extension"][4]["valueAddress"]["country"]).replace("'", "''")
-
-    us_core_ethnicity = patient_data["extension"][1]["extension"][0]["valueCoding"]["display"]
-    us_core_race = patient_data["extension"][0]["extension"][0]["valueCoding"]["display"]
 
-    try:
-        prefix = patient_data["name"][0]["prefix"][0]
-    except:
-        prefix = ""
+def resolve_manifest_paths(con):
+    """
+    Function to re-key manifest records made when files were recorded under the path they were loaded by,
+    see manifest_key
+    Relative paths are resolved against the working directory, as the loads were usually run from it. Records
+    whose file is not found there are left for the next load of that file to replace.
+    :param con: a connection to the patient database
+    :return:
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT file_path FROM ingest_manifest")
+    keys = {file_path: manifest_key(file_path) for file_path, in db_cursor.fetchall()}
+    moved = [(key, file_path) for file_path, key in keys.items()
+             if key != file_path and key not in keys and os.path.exists(key)]
+    if moved:
+        print("Resolving the paths of " + str(len(moved)) + " manifest records")
+        db_cursor.executemany("UPDATE ingest_manifest SET file_path=%s WHERE file_path=%s", moved)
 
-    try:
-        death_date_time = patient_data["deceasedDateTime"]
-    except:
-        death_date_time = "n/a"
 
-    try:
-        multiple_birth = str(patient_data["multipleBirthBoolean"])
-    except:
-        multiple_birth = ""
+def build_summary_tables(con):
+    """
+    Function to fill the summary tables from the typed tables, see summaryTables
+    :param con: a connection to the patient database
+    :return:
+    """
+    loader = BulkLoader(con)
+    with METRICS.timer("rebuild_summaries"):
+        rebuild_summaries(loader)
+    loader.commit()
+    print("Summary tables rebuilt in " + "{:.3f}".format(time.perf_counter() - loader.started) + "s")
 
-    given_name = ""
-    for name in patient_data["name"][0]["given"]:
-        given_name += name + " "
-    given_name = given_name[:-1].replace("'", "\'")
 
-    try:
-        sql = "INSERT INTO patient_database.patient (`patient_id`,`unique_id`,`given_name`,`family_name`," \
-              "`birth_date`,`birth_sex`,`gender`,`mother`,`marital_status`,`name_use`,`address_line`," \
-              "`address_city`,`address_state`,`address_country`,`address_latitude`,`address_longitude`," \
-              "`birth_city`,`birth_state`,`birth_country`,`us_core_ethnicity`,`us_core_race`,`prefix`," \
-              "`death_dateTime`,`multiple_birth`,`disability_adjusted_life_years`,`quality_adjusted_life_years`) " \
-              "VALUES (NULL, '" + patient_id + "', '" + given_name + "', '" + family_name + "', '" + birth_date + \
-              "', '" + birth_sex + "', '" + gender + "', '" + mothers_maiden_name + "', '" + marital_status + "', '" + name_use + "', '" + home_address_line + "', '" + home_address_city + "', '" + home_address_state + "','" + home_address_country + "', '" + home_address_latitude + "', '" + home_address_longitude + "', '" + birth_place_city + "', '" + birth_place_state + "', '" + birth_place_country + "', '" + us_core_ethnicity + "', '" + us_core_race + "', '" + prefix + "', '" + death_date_time + "', '" + multiple_birth + "', '" + disability_adjusted_life_years + "', '" + quality_adjusted_life_years + "') "
-        db_cursor.execute(sql.rstrip("\n"))
-        con.commit()
-        db_patient_id = db_cursor.lastrowid
-    except Exception as e:
-        print()
-        print("ERROR: Could not add " + given_name + " " + family_name)
-        print()
-        con.close()
-        return None
+def round_claim_totals(con):
+    """
+    Function to correct claim totals that SQLite added up as floating point numbers before they were rounded
+    :param con: a connection to the patient database
+    :return:
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("UPDATE summary_claim_month SET total_value = ROUND(total_value, %s)", (CLAIM_TOTAL_PLACES,))
 
-    con.close()
-    return db_patient_id
+
+def index_exists(db_cursor, table, index):
+    """
+    Function to check whether a table has an index
+    :param db_cursor: a cursor on the patient database
+    :param table: the table to check
+    :param index: the index name
+    :return: Boolean
+    """
+    return storage_backend().index_exists(db_cursor, table, index)
 
 
-def add_patient_language(language, patient_id):
+def ensure_index(db_cursor, table, index, columns, unique=False):
     """
-    Function to add communication method/language for a patient
-    A patient may have many languages or communication methods
-    :param language: the language/communication method to be added
-    :param patient_id: the unique patient ID for the patient in question
-    :return:
+    Function to add an index to an existing table if it is missing
+    :param db_cursor: a cursor on the patient database
+    :param table: the table to index
+    :param index: the index name
+    :param columns: the indexed columns, comma separated
+    :param unique: True to create a UNIQUE index
+    :return: True if the index was added, False if it already existed
     """
+    if index_exists(db_cursor, table, index):
+        return False
+    print("Adding index " + table + "." + index)
+    db_cursor.execute(storage_backend().create_index_sql(table, index, columns, unique))
+    return True
 
-    con = connect_patient_db()
+
+def remove_duplicate_patients(con):
+    """
+    Function to remove patients that were inserted more than once before unique_id was made UNIQUE
+    The first copy of each patient is kept and the rows belonging to the other copies are deleted.
+    :param con: a connection to the patient database
+    :return: the number of duplicate patients removed
+    """
     db_cursor = con.cursor()
-    try:
-        sql = "INSERT INTO `patient_database`.`patient_language`(`patient_language_id`,`patient`,`language`) VALUES (NULL,'" + str(
-            patient_id) + "','" + language + "');"
-        db_cursor.execute(sql.rstrip("\n"))
+    db_cursor.execute("SELECT p.patient_id FROM patient p JOIN (SELECT unique_id, MIN(patient_id) AS first_id "
+                      "FROM patient GROUP BY unique_id HAVING COUNT(*) > 1) d ON d.unique_id = p.unique_id "
+                      "AND p.patient_id <> d.first_id")
+    duplicates = [(row[0],) for row in db_cursor.fetchall()]
+    if duplicates:
+        print("Removing " + str(len(duplicates)) + " duplicate patients")
+        for table in TABLE_COLUMNS:
+            if "patient" in TABLE_COLUMNS[table]:
+                db_cursor.executemany("DELETE FROM " + table + " WHERE patient=%s", duplicates)
+        db_cursor.executemany("DELETE FROM patient WHERE patient_id=%s", duplicates)
         con.commit()
-    except Exception as e:
-        print("ERROR: Could not add language for" + patient_id)
-        con.close()
+    return len(duplicates)
+
+
+def ensure_column(db_cursor, table, column, definition):
+    """
+    Function to add a column to an existing table if it is missing
+    :param db_cursor: a cursor on the patient database
+    :param table: the table to check
+    :param column: the column name
+    :param definition: the column type and options used when adding it
+    :return: True if the column was added, False if it already existed
+    """
+    backend = storage_backend()
+    if backend.column_exists(db_cursor, table, column):
         return False
+    print("Adding " + table + "." + column)
+    db_cursor.execute("ALTER TABLE " + table + " ADD COLUMN " + column + " " + backend.column_definition(definition))
     return True
 
 
-def add_patient_identifier(identifier, patient_id):
+def backfill_event_hashes(con):
+    """
+    Function to fill in resource_id and content_hash for events stored before they were recorded
+    so a re-sent bundle does not insert those events a second time
+    Events are read a batch at a time in id order, and each batch is read in full before it is updated as
+    DuckDB runs every cursor on one connection. Events that cannot be decoded are left as they are and counted.
+    :param con: a connection to the patient database
+    :return:
+    """
+    db_cursor = con.cursor()
+    load_payload_dictionaries(db_cursor)
+    last_id = 0
+    skipped = 0
+    while True:
+        db_cursor.execute("SELECT patient_event_id, event_data, event_blob FROM patient_event "
+                          "WHERE resource_id IS NULL AND patient_event_id > %s ORDER BY patient_event_id LIMIT %s",
+                          (last_id, BATCH_SIZE))
+        events = db_cursor.fetchall()
+        if not events:
+            break
+        updates = []
+        for event_id, event_data, event_blob in events:
+            resource = load_event_json(event_data, event_blob)
+            if resource is None:
+                skipped += 1
+                continue
+            updates.append((resource.get("id"), content_hash(jsonCodec.dumps(resource)), event_id))
+        if updates:
+            db_cursor.executemany("UPDATE patient_event SET resource_id=%s, content_hash=%s "
+                                  "WHERE patient_event_id=%s", updates)
+        last_id = events[-1][0]
+    if skipped:
+        METRICS.count("undecodable_events", skipped)
+        print("ERROR: " + str(skipped) + " stored events could not be decoded and were left without a resource id")
+    con.commit()
+
+
+def patient_row(patient_data, patient_id, patient_json=None):
+    """
+    A function to extract the patient's information into a row for the patient table
+    The columns are read as set out in PATIENT_SPEC, with extensions found by their url.
+    :param patient_data: the json formatted data for the patient
+    :param patient_id: the unique patient ID to be used when adding to the database
+    :param patient_json: the patient already serialised, if the caller has it
+    :return: a tuple of values in TABLE_COLUMNS["patient"] order
+    """
+    if patient_json is None:
+        patient_json = jsonCodec.dumps(patient_data)
+    return (patient_id,) + PATIENT_EXTRACTOR.rows(patient_data)[0][1:] + (content_hash(patient_json),)
+
+
+@METRICS.timed("add_patient")
+def add_patient(patient_data, patient_id, loader, patient_json=None):
+    """
+    A function to add the patient to the database and record their information
+    :param patient_data: the json formatted data for the patient
+    :param patient_id: the unique patient ID to be used when adding to the database
+    :param loader: the BulkLoader the patient row is written through
+    :param patient_json: the patient already serialised, if the caller has it
+    :return: the database id of the new patient
+    """
+    return loader.insert("patient", patient_row(patient_data, patient_id, patient_json))
+
+
+@METRICS.timed("update_patient")
+def update_patient(patient_data, db_patient_id, loader, patient_json=None):
+    """
+    A function to overwrite an existing patient's information with a newer copy
+    Languages, contacts and identifiers are replaced rather than merged.
+    :param patient_data: the json formatted data for the patient
+    :param db_patient_id: the database id of the patient
+    :param loader: the BulkLoader the rows are written through
+    :param patient_json: the patient already serialised, if the caller has it
+    :return:
+    """
+    row = patient_row(patient_data, patient_data["id"], patient_json)
+    columns = TABLE_COLUMNS["patient"]
+    loader.cursor.execute("UPDATE patient SET " + ", ".join(column + "=%s" for column in columns) +
+                          " WHERE patient_id=%s", row + (db_patient_id,))
+    for table in ("patient_language", "patient_contact", "patient_identifier"):
+        loader.cursor.execute("DELETE FROM " + table + " WHERE patient=%s", (db_patient_id,))
+    add_patient_details(patient_data, db_patient_id, loader)
+
+
+def add_patient_details(patient_data, db_patient_id, loader):
+    """
+    A function to record the languages, contact methods and identifiers of a patient
+    :param patient_data: the json formatted data for the patient
+    :param db_patient_id: the database id of the patient
+    :param loader: the BulkLoader the rows are buffered on
+    :return:
+    """
+    # record patient languages in the database
+    for language in patient_data["communication"]:
+        add_patient_language(language["language"]["text"], db_patient_id, loader)
+
+    # record patient contact information in the database
+    for telecom in patient_data["telecom"]:
+        add_patient_contact(telecom, db_patient_id, loader)
+
+    # record patient identifiers in the database
+    for identifier in patient_data["identifier"]:
+        add_patient_identifier(identifier, db_patient_id, loader)
+
+
+@METRICS.timed("add_patient_language")
+def add_patient_language(language, patient_id, loader):
+    """
+    Function to add communication method/language for a patient
+    A patient may have many languages or communication methods
+    :param language: the language/communication method to be added
+    :param patient_id: the database id for the patient in question
+    :param loader: the BulkLoader the row is buffered on
+    :return:
+    """
+    loader.add("patient_language", (patient_id, language))
+
+
+@METRICS.timed("add_patient_identifier")
+def add_patient_identifier(identifier, patient_id, loader):
     """
     Function to add a form of identification for a patient
     A patient may have many forms of identification
     :param identifier: the particular identifier to be added
-    :param patient_id: the unique patient id for the patient in question
+    :param patient_id: the database id for the patient in question
+    :param loader: the BulkLoader the row is buffered on
     :return:
     """
     try:
-        identifier_type = str(identifier["type"]["text"]).replace("'", "''")
-    except:
+        identifier_type = str(identifier["type"]["text"])
+    except KeyError:
         identifier_type = "-"
-    identifier_system = identifier["system"]
-    identifier_value = identifier["value"]
-    con = connect_patient_db()
-    db_cursor = con.cursor()
-    try:
-        sql = "INSERT INTO `patient_database`.`patient_identifier`(`patient_identifier_id`,`patient`,`id_system`,`type`,`value`)VALUES (NULL, '" + str(
-            patient_id) + "','" + identifier_system + "', '" + identifier_type + "', '" + identifier_value + "');"
-        db_cursor.execute(sql.rstrip("\n"))
-        con.commit()
-    except Exception as e:
-        print("ERROR: Could not add identifier for" + patient_id)
-        con.close()
-        return False
-
-    con.close()
-    return True
+    loader.add("patient_identifier", (patient_id, identifier["system"], identifier_type, identifier["value"]))
 
 
-def add_patient_contact(contact_info, patient_id):
+@METRICS.timed("add_patient_contact")
+def add_patient_contact(contact_info, patient_id, loader):
     """
     Function to add patient contact information to the database
     A single patient could have many methods of contact
     :param contact_info: the contact information to be added
-    :param patient_id: the unique patient id to be used for reference
-    :return: True if successful, False if unsuccessful
+    :param patient_id: the database id to be used for reference
+    :param loader: the BulkLoader the row is buffered on
+    :return:
     """
-    telecom_system = contact_info["system"]
-    telecom_use = contact_info["use"]
-    telecom_value = contact_info["value"]
-
-    con = connect_patient_db()
-    db_cursor = con.cursor()
-    try:
-        sql = "INSERT INTO `patient_database`.`patient_contact`(`patient_contact_id`,`patient`,`contact_system`,`type`,`value`)VALUES (NULL, '" + str(
-            patient_id) + "','" + telecom_system + "', '" + telecom_use + "', '" + telecom_value + "');"
-        db_cursor.execute(sql.rstrip("\n"))
-        con.commit()
-    except Exception as e:
-        print("ERROR: Could not add identifier for" + patient_id)
-        con.close()
-        return False
-
-    con.close()
-    return True
+    loader.add("patient_contact", (patient_id, contact_info["system"], contact_info["use"], contact_info["value"]))
 
 
-def add_event(event_data, patient_id):
+@METRICS.timed("add_event")
+def add_event(event_data, patient_id, loader, event_json=None):
     """
     Function to add patient event data to the database.
     The data is stored as JSON data so it can be used later by the interface to create CSV files.
+    Resource types listed in RESOURCE_TABLES are also flattened into their typed table.
     :param event_data: the event data in json format
-    :param patient_id: the unique id for the patient related to the event
+    :param patient_id: the database id for the patient related to the event
+    :param loader: the BulkLoader the row is buffered on
+    :param event_json: the resource already serialised, if the caller has it
     :return: 
     """
+    resource = event_data["resource"]
+    if event_json is None:
+        event_json = event_data.get(RESOURCE_TEXT) or jsonCodec.dumps(resource)
+    if EVENT_COMPRESSION == "none":
+        stored_json, event_blob = event_json, None
+    else:
+        stored_json, event_blob = None, compress_event(event_json, loader)
+    loader.add("patient_event", (patient_id, stored_json, resource["resourceType"], event_resource_id(event_data),
+                                 content_hash(event_json), event_blob))
 
-    con = connect_patient_db()
+    # flatten the resource types analytics use most into their own typed tables
+    if resource["resourceType"] in RESOURCE_TABLES:
+        loader.add_resource(patient_id, resource)
+
+
+def compress_event(event_json, loader):
+    """
+    Function to compress an event for the event_blob column with EVENT_COMPRESSION
+    The latest dictionary trained for the codec is used, or none if there is not one yet.
+    :param event_json: the serialised resource
+    :param loader: the BulkLoader the event is written with
+    :return: the compressed payload
+    """
+    if loader.payload_dictionary is None:
+        loader.payload_dictionary = latest_payload_dictionary(loader.cursor, EVENT_COMPRESSION)
+    return payloadCodec.compress(event_json, EVENT_COMPRESSION, loader.payload_dictionary)
+
+
+def latest_payload_dictionary(db_cursor, codec):
+    """
+    Function to find and register the most recently trained dictionary for a codec
+    :param db_cursor: a cursor on the patient database
+    :param codec: one of payloadCodec.CODECS
+    :return: the dictionary id, or 0 if none has been trained
+    """
+    db_cursor.execute("SELECT dictionary_id, dictionary FROM payload_dictionary WHERE codec=%s "
+                      "ORDER BY dictionary_id DESC LIMIT 1", (codec,))
+    row = db_cursor.fetchone()
+    if row is None:
+        return 0
+    payloadCodec.add_dictionary(row[0], codec, row[1])
+    return row[0]
+
+
+def load_payload_dictionaries(db_cursor):
+    """
+    Function to register every stored dictionary so any compressed event can be decoded
+    It is called before the events are queried, as the query may still be streaming rows while they are decoded.
+    :param db_cursor: a cursor on the patient database
+    :return:
+    """
+    db_cursor.execute("SELECT dictionary_id, codec, dictionary FROM payload_dictionary")
+    for dictionary_id, codec, dictionary in db_cursor.fetchall():
+        payloadCodec.add_dictionary(dictionary_id, codec, dictionary)
+
+
+def train_payload_dictionary(con, codec, file_paths):
+    """
+    Function to train a dictionary for a codec on resources from the bundle files, unless one is already stored
+    Up to PAYLOAD_SAMPLE_FILES files spread across the list are sampled. Events keep the dictionary they were
+    compressed with, so one stored here only affects events written after it.
+    :param con: a connection to the patient database
+    :param codec: one of payloadCodec.CODECS
+    :param file_paths: the .json files being loaded
+    :return: the dictionary id, or 0 if there were too few resources to train on
+    """
     db_cursor = con.cursor()
-    try:
-        formatted_event_data = json.dumps(event_data["resource"]).replace('"', '""').replace("'", "''")
-        sql = "INSERT INTO `patient_database`.`patient_event`(`patient_event_id`,`patient`,`event_data`, `type`)VALUES (NULL, '" + str(
-            patient_id) + "','" + formatted_event_data + "','" + event_data["resource"]["resourceType"] + "');"
-        db_cursor.execute(sql.rstrip("\n"))
-        con.commit()
-    except Exception as e:
-        print("ERROR: Could not add event for" + patient_id)
-        con.close()
-        return False
+    dictionary_id = latest_payload_dictionary(db_cursor, codec)
+    if dictionary_id or not file_paths:
+        return dictionary_id
+    step = max(len(file_paths) // PAYLOAD_SAMPLE_FILES, 1)
+    samples = []
+    with METRICS.timer("train_payload_dictionary"):
+        for file_path in file_paths[::step][:PAYLOAD_SAMPLE_FILES]:
+            try:
+                for entry in iter_bundle_entries(file_path):
+                    samples.append(entry.get(RESOURCE_TEXT) or jsonCodec.dumps(entry["resource"]))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                METRICS.error("train_payload_dictionary", e)
+        dictionary = payloadCodec.train_dictionary(codec, samples)
+    if dictionary is None:
+        print("Too few resources to train a " + codec + " dictionary, events are compressed without one")
+        return 0
+    dictionary_id = storage_backend().insert(
+        db_cursor, "INSERT INTO payload_dictionary (codec, dictionary, sample_count, created_at) "
+        "VALUES (%s, %s, %s, %s)", (codec, dictionary, len(samples), datetime.utcnow()), "dictionary_id")
+    con.commit()
+    payloadCodec.add_dictionary(dictionary_id, codec, dictionary)
+    print("Trained a " + str(len(dictionary)) + " byte " + codec + " dictionary on " + str(len(samples)) +
+          " resources")
+    return dictionary_id
+
+
+@METRICS.timed("delete_event")
+def delete_event(resource_id, resource_type, patient_id, loader):
+    """
+    Function to remove a stored event, and its typed table rows, so a changed copy can be added
+    :param resource_id: the resource id of the event
+    :param resource_type: the FHIR resourceType of the event
+    :param patient_id: the database id for the patient related to the event
+    :param loader: the BulkLoader whose transaction the delete runs in
+    :return:
+    """
+    loader.cursor.execute("DELETE FROM patient_event WHERE patient=%s AND resource_id=%s", (patient_id, resource_id))
+    if resource_type in RESOURCE_TABLES:
+        table = RESOURCE_TABLES[resource_type][0]
+        loader.cursor.execute("DELETE FROM " + table + " WHERE patient=%s AND resource_id=%s",
+                              (patient_id, resource_id))
 
-    con.close()
-    return True
+
+def event_resource_id(event_data):
+    """
+    Function to get the identifier used to recognise an event when a bundle is sent again
+    :param event_data: the bundle entry for the event
+    :return: the resource id, or the entry's fullUrl if the resource has no id
+    """
+    return event_data["resource"].get("id") or event_data.get("fullUrl")
+
+
+def content_hash(text):
+    """
+    Function to fingerprint serialised resource data so unchanged resources can be skipped
+    :param text: the serialised data
+    :return: the hex SHA-1 of the text
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
 
-def process_json(json_data, file_path):
+def same_content(stored_hash, value, text):
+    """
+    Function to check whether a stored copy of a resource or patient matches a newly received one
+    The stored hash may be of another encoding of the same content, from an earlier version, the other
+    JSON codec or the resource's own text in its file, so those encodings are tried before it is treated as
+    changed. They are only needed when the hashes differ.
+    :param stored_hash: the content_hash stored with the copy in the database
+    :param value: the decoded resource
+    :param text: the resource's text that would be stored now
+    :return: True if the stored copy has the same content
+    """
+    if stored_hash == content_hash(text):
+        return True
+    return stored_hash in {content_hash(encoded) for encoded in jsonCodec.encodings(value) | {json.dumps(value)}}
+
+
+def process_entries(entries, file_path, loader, manifest_row=None):
     """"
-    :param file_path: the path for the file the json data came from
-    :param json_data: a Json object that was created by load_json_data
+    Adds the patient in a bundle along with all of their events as a single unit of work.
+    If anything in the bundle fails it is rolled back so a patient is never left half loaded.
+    Entries are consumed one at a time so the bundle never needs to be held in memory.
+
+    If the patient is already in the database their details are updated if they have changed, and only
+    events that are new or whose content has changed since they were stored are written. If any of the rows the
+    summary tables are built from change, the patient's summaries are updated as part of the same unit of work.
+    :param entries: an iterator of the bundle's entries, starting with the Patient
+    :param file_path: the path for the file the entries came from
+    :param loader: the BulkLoader used to write the bundle
+    :param manifest_row: the ingest_manifest row recorded for the file once the bundle is written
     :return: True if handled without error, False if there is an error
     """
-    if json_data["entry"][0]["resource"]["resourceType"] == "Patient":
-        patient_data = json_data["entry"][0]["resource"]
+    first_entry = next(entries, None)
+    if first_entry is not None and first_entry["resource"]["resourceType"] == "Patient":
+        patient_data = first_entry["resource"]
         unique_id = patient_data["id"]
 
-        con = connect_patient_db()
-        db_cursor = con.cursor()
-        db_cursor.execute("SELECT * FROM patient WHERE unique_id='" + unique_id + "'")
-        patient = db_cursor.fetchall()
-
-        # if the patient does not exist
-        if len(patient) == 0:
-            # Add the patient to the database
-            db_patient_id = add_patient(patient_data, unique_id)
-
-            # record patient languages in the database
-            for language in patient_data["communication"]:
-                add_patient_language(language["language"]["text"], db_patient_id)
-
-            # record patient contact information in the database
-            for telecom in patient_data["telecom"]:
-                add_patient_contact(telecom, db_patient_id)
-
-            # record patient identifiers in the database
-            for identifier in patient_data["identifier"]:
-                add_patient_identifier(identifier, db_patient_id)
-
-            # record all patient events in the database
-            for event in json_data["entry"]:
-                if event["resource"]["resourceType"] != "Patient":
-                    add_event(event, db_patient_id)
+        # hold the patient lock so a parallel worker with the same patient cannot insert it as well
+        with METRICS.timer("db_lock"):
+            locked = loader.lock_patient(unique_id)
+        if not locked:
+            METRICS.count("lock_timeouts")
+            print("ERROR: Timed out waiting for patient " + unique_id + " in " + file_path)
+            return False
+
+        if loader.patients is None:
+            loader.patients = read_patients(loader)
+        patient = loader.patients.get(unique_id)
+        patient_json = jsonCodec.dumps(patient_data)
+        patient_hash = content_hash(patient_json)
+
+        loader.begin_bundle()
+        try:
+            # if the patient does not exist
+            if patient is None:
+                try:
+                    # Add the patient to the database
+                    db_patient_id = add_patient(patient_data, unique_id, loader, patient_json)
+                    add_patient_details(patient_data, db_patient_id, loader)
+                    stored_events = {}
+                except loader.backend.IntegrityError:
+                    # the unique index shows another session added the patient since the cache was read. With
+                    # more than one bundle per commit this transaction's snapshot may be older than that row,
+                    # so it is read with a locking read, which sees the latest committed rows
+                    loader.cursor.execute(loader.backend.locking_read_sql(
+                        "SELECT patient_id, content_hash FROM patient WHERE unique_id=%s"), (unique_id,))
+                    patient = loader.cursor.fetchone()
+                    if patient is None:
+                        raise LookupError("patient " + unique_id + " is in the unique index but cannot be read")
+
+            # a patient without a content hash may have been left half loaded, see repair_patients
+            repairing = False
+            if patient is not None:
+                db_patient_id, stored_hash = patient
+                repairing = stored_hash is None
+                if not same_content(stored_hash, patient_data, patient_json):
+                    update_patient(patient_data, db_patient_id, loader, patient_json)
+                with METRICS.timer("db_lookup"):
+                    loader.cursor.execute("SELECT resource_id, content_hash FROM patient_event WHERE patient=%s",
+                                          (db_patient_id,))
+                    stored_events = dict(loader.cursor.fetchall())
+
+            # the patient's share of the summary tables before the bundle changes any of their typed rows
+            summaries_before = None
+            # record all new or changed patient events in the database
+            for event in entries:
+                resource = event["resource"]
+                if resource["resourceType"] == "Patient":
+                    continue
+                resource_id = event_resource_id(event)
+                event_json = event.get(RESOURCE_TEXT) or jsonCodec.dumps(resource)
+                if resource_id in stored_events:
+                    if same_content(stored_events[resource_id], resource, event_json):
+                        continue
+                if summaries_before is None and resource["resourceType"] in SUMMARY_RESOURCE_TYPES:
+                    with METRICS.timer("summaries"):
+                        summaries_before = empty_summaries() if patient is None else \
+                            read_summaries(loader.cursor, db_patient_id)
+                if resource_id in stored_events:
+                    delete_event(resource_id, resource["resourceType"], db_patient_id, loader)
+                elif repairing:
+                    # clear any typed table rows written without their event
+                    delete_event(resource_id, resource["resourceType"], db_patient_id, loader)
+                add_event(event, db_patient_id, loader, event_json)
+
+            if manifest_row is not None:
+                record_manifest(manifest_row, loader, unique_id)
+            loader.flush()
+            if summaries_before is not None:
+                with METRICS.timer("summaries"):
+                    update_patient_summaries(db_patient_id, summaries_before, loader)
+            loader.patients[unique_id] = (db_patient_id, patient_hash)
+        except Exception as e:
+            loader.abort_bundle()
+            METRICS.error("process_bundle", e)
+            print("ERROR: Could not add patient " + unique_id + " from " + file_path + ": " + str(e))
+            return False
+        loader.end_bundle()
     else:
+        METRICS.count("bundles_without_patient")
         print("ERROR: Patient Details not found for " + file_path)
 
     return True
 
 
-def load_json_data(file_path):
+def file_hash(file_path):
+    """
+    Function to calculate the SHA-256 of a file's content without reading it all into memory
+    :param file_path: the file to hash
+    :return: the hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_key(file_path):
+    """
+    Function to get the path a file is recorded under in the manifest
+    Symbolic links and relative paths are resolved, so the same file is recognised however it is reached.
+    :param file_path: the path the file was found by
+    :return: the canonical path
+    """
+    return os.path.realpath(file_path)
+
+
+def read_manifest(loader):
+    """
+    Function to load the ingest_manifest table, keyed on file path
+    :param loader: the BulkLoader whose connection is used
+    :return: a dictionary of file path to (file size, mtime, content hash, patient unique id)
+    """
+    loader.cursor.execute("SELECT file_path, file_size, mtime, content_hash, patient_unique_id FROM ingest_manifest")
+    return {row[0]: tuple(row[1:]) for row in loader.cursor.fetchall()}
+
+
+def read_patients(loader):
+    """
+    Function to load the id and content hash of every patient in one query
+    so each bundle can check whether its patient exists without a round trip
+    :param loader: the BulkLoader whose connection is used
+    :return: a dictionary of unique patient ID to (database id, content hash)
+    """
+    loader.cursor.execute("SELECT unique_id, patient_id, content_hash FROM patient")
+    return {row[0]: (row[1], row[2]) for row in loader.cursor.fetchall()}
+
+
+def record_manifest(manifest_row, loader, unique_id=None):
+    """
+    Function to record a processed file in the ingest_manifest table, replacing any earlier record
+    The record is written in the same transaction as the bundle, so it is the checkpoint that the file was
+    loaded in full. The loader's copy of the manifest only gains it once the transaction is committed, so a
+    bundle that is rolled back is not taken as loaded when the file is seen again.
+    :param manifest_row: a tuple of the file path, size, mtime, content hash and time processed
+    :param loader: the BulkLoader the row is written through
+    :param unique_id: the unique patient ID of the bundle's patient
+    :return:
+    """
+    loader.cursor.execute("DELETE FROM ingest_manifest WHERE file_path=%s", (manifest_row[0],))
+    loader.add("ingest_manifest", tuple(manifest_row) + (loader.run_id, unique_id))
+    loader.manifest_pending.append((manifest_row[0], tuple(manifest_row[1:4]) + (unique_id,)))
+
+
+def load_json_data(file_path, loader):
     """
-    Function to load the JSON data from a given JSON file and create a json Object with it's data
+    Function to stream the entries from a given JSON file into the database
+    Files whose size and modification time match the manifest are skipped without being opened. Files that
+    have been touched but whose content hash is unchanged are skipped after hashing.
     :param file_path: A file path to a .json file
-    :return: True if successful, False if unable to load
+    :param loader: the BulkLoader used to write the bundle
+    :return: True if successful or unchanged, False if unable to load
     """
-    with open(file_path, 'r') as file:
-        try:
-            if process_json(json.loads(file.read()), file_path):
-                return True
+    if loader.manifest is None:
+        loader.manifest = read_manifest(loader)
+    file_path = manifest_key(file_path)
+    file_stat = os.stat(file_path)
+    recorded = loader.manifest.get(file_path)
+    if recorded is not None and recorded[0] == file_stat.st_size and recorded[1] == file_stat.st_mtime:
+        loader.unchanged_files += 1
+        METRICS.count("files_unchanged")
+        return True
+
+    with METRICS.timer("file_hash"):
+        manifest_row = (file_path, file_stat.st_size, file_stat.st_mtime, file_hash(file_path), datetime.utcnow())
+    METRICS.count("bytes_read", file_stat.st_size)
+    if recorded is not None and recorded[2] == manifest_row[3]:
+        # touched but not changed, remember the new stat so the next run skips it straight away
+        record_manifest(manifest_row, loader, recorded[3])
+        loader.unchanged_files += 1
+        METRICS.count("files_unchanged")
+        return True
+
+    entries = iter_bundle_entries(file_path)
+    try:
+        with METRICS.timer("process_bundle"):
+            processed = process_entries(METRICS.timed_iter("parse_entry", entries), file_path, loader, manifest_row)
+    except (ValueError, KeyError, TypeError) as e:
+        METRICS.error("parse", e)
+        METRICS.count("files_failed")
+        print("ERROR: " + file_path + " is in the wrong format")
+        return False
+    except loader.backend.Error as e:
+        # the lock, cache or savepoint queries before the bundle's own error handling failed, so the
+        # transaction cannot be relied on
+        METRICS.error("process_bundle", e)
+        METRICS.count("files_failed")
+        print("ERROR: Cannot process " + file_path + ": " + str(e))
+        loader.abort_transaction()
+        return False
+    finally:
+        entries.close()
+
+    if processed:
+        METRICS.count("files_loaded")
+        return True
+    else:
+        METRICS.count("files_failed")
+        print("ERROR: Cannot process " + file_path)
+        print()
+        return False
+
+
+def list_json_files(directory):
+    """
+    Function to find the .json files in a directory
+    :param directory: A directory containing files in JSON Format
+    :return: a list of file paths
+    """
+    file_paths = []
+    for f in listdir(directory):
+        if isfile(join(directory, f)):
+            if f[-5:] == ".json":
+                file_paths.append(directory + "/" + f)
             else:
-                print("ERROR: Cannot process " + file_path)
-                print()
-                return False
-        except:
-            print("ERROR: " + file_path + " is in the wrong format")
-            return False
+                print(f + " is not a .json file")
+    return file_paths
 
 
-def load_json_files(directory):
+def start_run(con, directory, file_count):
+    """
+    Function to record the start of a load in the ingest_run table
+    :param con: a connection to the patient database
+    :param directory: the directory being loaded
+    :param file_count: the number of files found in it
+    :return: the run id
+    """
+    db_cursor = con.cursor()
+    run_id = storage_backend().insert(
+        db_cursor, "INSERT INTO ingest_run (directory, file_count, started_at) VALUES (%s, %s, %s)",
+        (directory, file_count, datetime.utcnow()), "run_id")
+    con.commit()
+    return run_id
+
+
+def finish_run(con, run_id):
+    """
+    Function to record that a load ran to the end, whether or not every file could be loaded
+    :param con: a connection to the patient database
+    :param run_id: the run id from start_run
+    :return:
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("UPDATE ingest_run SET finished_at=%s WHERE run_id=%s", (datetime.utcnow(), run_id))
+    con.commit()
+
+
+def interrupted_run(con):
+    """
+    Function to find the last load if it stopped before the end
+    :param con: a connection to the patient database
+    :return: a tuple of the run id, directory, number of files, start time and number of files it checkpointed,
+    or None if the last load finished
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT run_id, directory, file_count, started_at, finished_at FROM ingest_run "
+                      "ORDER BY run_id DESC LIMIT 1")
+    run = db_cursor.fetchone()
+    if run is None or run[4] is not None:
+        return None
+    db_cursor.execute("SELECT COUNT(*) FROM ingest_manifest WHERE run_id=%s", (run[0],))
+    return tuple(run[:4]) + (db_cursor.fetchone()[0],)
+
+
+def repair_patients(con):
+    """
+    Function to find patients that were not loaded in full and make sure their bundles are loaded again
+    A patient is half loaded if it has no content hash, which is written with the rest of its bundle, or no
+    events at all. Their content hash is cleared so the next load of their bundle rewrites the patient and its
+    details and adds any missing events, and the files they came from are removed from the manifest so they
+    are not skipped. A bundle that really holds only a patient is loaded again as well, which is harmless.
+    :param con: a connection to the patient database
+    :return: the number of patients repaired
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT p.patient_id, p.unique_id FROM patient p WHERE p.content_hash IS NULL OR NOT EXISTS "
+                      "(SELECT 1 FROM patient_event e WHERE e.patient = p.patient_id)")
+    patients = db_cursor.fetchall()
+    if patients:
+        print("Repairing " + str(len(patients)) + " half loaded patients, their bundles will be loaded again")
+        db_cursor.executemany("UPDATE patient SET content_hash=NULL WHERE patient_id=%s",
+                              [(patient_id,) for patient_id, _ in patients])
+        db_cursor.executemany("DELETE FROM ingest_manifest WHERE patient_unique_id=%s",
+                              [(unique_id,) for _, unique_id in patients])
+        con.commit()
+    METRICS.count("patients_repaired", len(patients))
+    return len(patients)
+
+
+_worker_loader = None
+_worker_barrier = None
+
+
+def _init_worker(batch_size, bundles_per_commit, barrier, run_id=None):
+    """
+    Process pool initializer giving each worker its own long-lived database session
+    :param batch_size: the maximum number of rows sent in one executemany
+    :param bundles_per_commit: the number of bundles written in each transaction
+    :param barrier: a Barrier shared by all workers, used by _close_worker
+    :param run_id: the ingest_run the files are loaded in
+    :return:
+    """
+    global _worker_loader, _worker_barrier
+    # a worker only ever uses one connection
+    storage_backend().pool_size = 1
+    # start from empty metrics rather than a copy of the parent's
+    METRICS.reset()
+    _worker_loader = BulkLoader(batch_size=batch_size, bundles_per_commit=bundles_per_commit, run_id=run_id)
+    _worker_barrier = barrier
+
+
+def _load_file_in_worker(file_path):
+    """
+    Process pool task to load a single file on the worker's session
+    :param file_path: A file path to a .json file
+    :return: the file path, whether it loaded successfully, the number of rows written and the files loaded
+    earlier that have been rolled back since
+    """
+    rows_before = _worker_loader.rows_written()
+    try:
+        loaded = load_json_data(file_path, _worker_loader)
+    except Exception as e:
+        METRICS.error("load_file", e)
+        print("ERROR: " + file_path + " failed in worker " + str(os.getpid()) + ": " + str(e))
+        loaded = False
+    return file_path, loaded, _worker_loader.rows_written() - rows_before, lost_files(_worker_loader)
+
+
+def lost_files(loader):
+    """
+    Function to report the files whose bundles were rolled back after they had been loaded, see
+    BulkLoader.abort_transaction
+    :param loader: the BulkLoader the files were loaded with
+    :return: the list of files, which are now failed
+    """
+    lost = loader.take_lost_files()
+    for file_path in lost:
+        METRICS.count("files_loaded", -1)
+        METRICS.count("files_failed")
+        print("ERROR: " + file_path + " was rolled back with the rest of its transaction")
+    return lost
+
+
+def _close_worker(_):
+    """
+    Process pool task to commit and close a worker's session
+    The barrier makes every worker wait here so each one picks up exactly one of these tasks.
+    :return: the worker's table stats, commit stats, number of unchanged files skipped and metrics
+    """
+    _worker_barrier.wait()
+    _worker_loader.close()
+    return _worker_loader.stats, _worker_loader.commits, _worker_loader.unchanged_files, METRICS.snapshot()
+
+
+def load_files(file_paths, batch_size=BATCH_SIZE, bundles_per_commit=1, workers=1, run_id=None):
+    """
+    Function to load a list of bundle files into the database
+    With one worker all files are written through one BulkLoader so the run uses a single connection.
+    With more, files are shared out to a process pool where each worker keeps its own connection.
+    :param file_paths: the .json files to load
+    :param batch_size: the maximum number of rows sent in one executemany
+    :param bundles_per_commit: the number of bundles written in each transaction
+    :param workers: the number of processes loading files
+    :param run_id: the ingest_run the files are recorded against in the manifest
+    :return: a dictionary of the failed files, table stats, commit stats, unchanged file count and seconds taken
+    """
+    started = time.perf_counter()
+    failed = []
+
+    if workers > 1 and not storage_backend().parallel_load:
+        print("The " + storage_backend().name + " backend allows a single writer, loading in one process")
+        workers = 1
+    if workers > 1:
+        barrier = multiprocessing.Barrier(workers)
+        pool = multiprocessing.Pool(workers, _init_worker, (batch_size, bundles_per_commit, barrier, run_id))
+        results = pool.imap_unordered(_load_file_in_worker, file_paths)
+        for done, (file_path, loaded, rows, lost) in enumerate(results, 1):
+            if not loaded:
+                failed.append(file_path)
+            failed.extend(lost)
+            METRICS.count("rows", rows)
+            METRICS.progress(done, len(file_paths))
+        worker_stats = pool.map(_close_worker, range(workers), chunksize=1)
+        pool.close()
+        pool.join()
+
+        stats = {table: [0, 0.0] for table in TABLE_COLUMNS}
+        commits = [0, 0.0]
+        unchanged = 0
+        for table_stats, commit_stats, unchanged_files, worker_metrics in worker_stats:
+            METRICS.merge(worker_metrics)
+            for table, (rows, seconds) in table_stats.items():
+                stats[table][0] += rows
+                stats[table][1] += seconds
+            commits[0] += commit_stats[0]
+            commits[1] += commit_stats[1]
+            unchanged += unchanged_files
+    else:
+        loader = BulkLoader(batch_size=batch_size, bundles_per_commit=bundles_per_commit, run_id=run_id)
+        for done, file_path in enumerate(file_paths, 1):
+            rows_before = loader.rows_written()
+            if not load_json_data(file_path, loader):
+                failed.append(file_path)
+            failed.extend(lost_files(loader))
+            METRICS.count("rows", loader.rows_written() - rows_before)
+            METRICS.progress(done, len(file_paths))
+        loader.close()
+        stats = loader.stats
+        commits = loader.commits
+        unchanged = loader.unchanged_files
+
+    return {"failed": failed, "stats": stats, "commits": commits, "unchanged": unchanged,
+            "seconds": time.perf_counter() - started}
+
+
+def load_json_files(directory, batch_size=BATCH_SIZE, bundles_per_commit=1, workers=1, resume=False):
     """
     Function to load in any JSON files in the given starting directory.
+    Each run is recorded in the ingest_run table and every bundle is checkpointed in the manifest as it is
+    committed, so a run that is stopped part way only has the files it had not finished left to load.
+    With resume the last run carries on if it was interrupted, after half loaded patients have been repaired.
     :param directory: A directory containing files in JSON Format
+    :param batch_size: the maximum number of rows sent in one executemany
+    :param bundles_per_commit: the number of bundles written in each transaction
+    :param workers: the number of processes loading files
+    :param resume: True to continue the last run if it did not finish and repair half loaded patients
     :return: True if directory exists, False if it does not or does not contain files.
     """
     print(str(len(listdir(directory))) + " Files found in " + directory)
+    file_paths = list_json_files(directory)
+
+    con = connect_patient_db()
+    run = interrupted_run(con)
+    run_id = None
+    if resume:
+        if run is not None:
+            run_id = run[0]
+            print("Resuming the run started " + str(run[3]) + " on " + str(run[1]) + ", " + str(run[4]) + " of " +
+                  str(run[2]) + " files were loaded before it stopped")
+        else:
+            print("The last run finished, nothing to resume")
+        repair_patients(con)
+    elif run is not None:
+        print("The run started " + str(run[3]) + " did not finish, files it loaded will be skipped. "
+              "Use --resume to also repair half loaded patients")
+    if run_id is None:
+        run_id = start_run(con, directory, len(file_paths))
+    if EVENT_COMPRESSION != "none":
+        train_payload_dictionary(con, EVENT_COMPRESSION, file_paths)
+    con.close()
+
     print("Loading....")
     print()
-    loaded_count = 0
-    for f in listdir(directory):
-        if isfile(join(directory, f)):
-            if f[-5:] == ".json":
-                if load_json_data(directory + "/" + f):
-                    loaded_count += 1
-            else:
-                print(f + " is not a .json file")
+    result = load_files(file_paths, batch_size, bundles_per_commit, workers, run_id)
+    con = connect_patient_db()
+    finish_run(con, run_id)
+    con.close()
+    failed = result["failed"]
+    if METRICS.progress_interval:
+        METRICS.progress(len(file_paths), len(file_paths), force=True)
+
     print()
-    print("Loaded " + str(loaded_count) + " Successfully")
+    print("Loaded " + str(len(file_paths) - len(failed) - result["unchanged"]) + " Successfully")
+    print("Skipped " + str(result["unchanged"]) + " unchanged since the last run")
+    if failed:
+        print(str(len(failed)) + " Failed:")
+        for file_path in sorted(failed):
+            print("    " + file_path)
+    print_load_report(result["stats"], result["commits"], result["seconds"])
     return True
 
 
-def create_csv_files():
+def decode_event_data(event_data, event_blob=None):
     """
-    A function to create formatted CSV files for each patient in the database
-    and all corresponding events
-    :return: True
+    Function to turn a stored patient_event.event_data value back into plain JSON text
+    Rows written before the bulk loader was introduced had their quotes doubled for string-built SQL,
+    these are detected and unescaped. Compressed events are decompressed from event_blob, the dictionaries
+    must have been registered with load_payload_dictionaries.
+    :param event_data: the stored event data
+    :param event_blob: the stored compressed event, None if the event was stored as text
+    :return: the event as a JSON string
     """
-    print("Generating CSV files.....")
-    # Check is csv folder exists if not create it
-    if not os.path.isdir('csv'):
-        os.mkdir('csv')
+    if event_blob is not None:
+        return payloadCodec.decompress(event_blob)
+    event_data = str(event_data)
+    if event_data.startswith('{""'):
+        return event_data.replace("''", "'").replace('""', '"')
+    return event_data
+
+
+def load_event_json(event_data, event_blob=None):
+    """
+    Function to decode a stored event into the resource
+    :param event_data: the stored event data
+    :param event_blob: the stored compressed event, if it was compressed
+    :return: the resource, or None if it cannot be decoded
+    """
+    return parse_event_json(decode_event_data(event_data, event_blob))
+
+
+def parse_event_json(text):
+    """
+    Function to decode an event's JSON text, including the text of events stored by the first version
+    Rows written with string-built SQL went through MySQL's escape handling, which turned the escaped quotes of
+    the XHTML narrative's xmlns attribute into bare ones and escaped newlines into raw ones. Those rows are read
+    with the narrative's opening tag simplified, as the CSV export writes it, and control characters allowed.
+    :param text: the event's text from decode_event_data
+    :return: the resource, or None if it cannot be decoded
+    """
+    try:
+        return jsonCodec.loads(text)
+    except ValueError:
+        pass
+    try:
+        return json.loads(text.replace('<div xmlns="http://www.w3.org/1999/xhtml">', "<div>"), strict=False)
+    except ValueError:
+        return None
 
-    # for each patient create a directory and fill it with events and patient csv files
+
+def fetch_rows(db_cursor, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Generator yielding the rows of an executed query batch_size rows at a time
+    With an unbuffered cursor the rows are read from the server as they are fetched, so only one batch is
+    held in memory however large the result is.
+    :param db_cursor: a cursor the query has been executed on
+    :param batch_size: the number of rows fetched at a time
+    :return: an iterator of rows
+    """
+    while True:
+        with METRICS.timer("export_fetch"):
+            rows = db_cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def staging_dir(output_dir):
+    """
+    Function to make an empty directory beside output_dir for an export to be written to before it is published
+    :param output_dir: the directory the export will be published as
+    :return: the staging directory
+    """
+    staging = os.path.normpath(output_dir) + ".partial"
+    if os.path.isdir(staging):
+        # left by an export that did not finish
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    return staging
+
+
+def publish_export(staging, output_dir):
+    """
+    Function to replace output_dir with a finished export by renaming its staging directory
+    Readers see the previous export or the new one, never part of one. A directory cannot be renamed over one
+    that has files in it, so the previous export is renamed out of the way first and then removed.
+    :param staging: the staging directory from staging_dir
+    :param output_dir: the directory the export is published as
+    :return:
+    """
+    previous = None
+    if os.path.exists(output_dir):
+        previous = os.path.normpath(output_dir) + ".previous"
+        if os.path.exists(previous):
+            shutil.rmtree(previous)
+        os.replace(output_dir, previous)
+    os.replace(staging, output_dir)
+    if previous is not None:
+        shutil.rmtree(previous)
+
+
+def patient_shards(shard_count):
+    """
+    Function to split the patients into ranges of patient_id with about the same number of patients in each
+    :param shard_count: the number of ranges wanted
+    :return: a list of (first patient_id, last patient_id) tuples, fewer than shard_count if there are few patients
+    """
     con = connect_patient_db()
     db_cursor = con.cursor()
-    db_cursor.execute("SELECT * FROM patient")
-    patients = db_cursor.fetchall()
+    db_cursor.execute("SELECT patient_id FROM patient ORDER BY patient_id")
+    patient_ids = [row[0] for row in db_cursor.fetchall()]
+    db_cursor.close()
+    con.close()
+    size = -(-len(patient_ids) // shard_count)
+    return [(patient_ids[i], patient_ids[min(i + size, len(patient_ids)) - 1])
+            for i in range(0, len(patient_ids), size or 1)]
+
+
+def _init_export_worker():
+    """
+    Process pool initializer for export workers, which each read through a single connection
+    :return:
+    """
+    storage_backend().pool_size = 1
+
 
-    db_cursor.execute("SHOW COLUMNS FROM patient")
-    headers = db_cursor.fetchall()
-    header = []
-    for item in headers:
-        header.append(item[0])
-
-    for patient in patients:
-        folder_name = patient[2] + "_" + patient[3] + "_" + patient[1]
-        if not os.path.isdir('csv/' + folder_name):
-            os.mkdir('csv/' + folder_name)
-
-        # Create patient file
-        with open('csv/' + folder_name + '/patient.csv', 'w', encoding='UTF8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
+def _export_shard_in_worker(task):
+    """
+    Process pool task to export one shard of patients
+    :param task: the export function, its arguments and the shard passed as its last argument
+    :return: what the export function returns and the metrics recorded while it ran
+    """
+    export, arguments, shard = task
+    METRICS.reset()
+    return export(*arguments, shard), METRICS.snapshot()
+
+
+def export_shards(export, arguments, workers=1):
+    """
+    Function to run an export over every patient, sharded by patient across a process pool
+    With one worker the export runs once in this process over all patients. With more the patients are split
+    into SHARDS_PER_WORKER ranges per worker, so a worker that finishes early picks up another range.
+    :param export: a module level function taking arguments followed by the shard, a (first, last) range of
+    patient_id or None for every patient, and returning the number of files or writes it made
+    :param arguments: the arguments passed before the shard
+    :param workers: the number of processes exporting
+    :return: the total of the numbers the shards returned
+    """
+    if workers > 1 and not storage_backend().parallel_export:
+        print("The " + storage_backend().name + " backend allows a single process, exporting in one process")
+        workers = 1
+    if workers <= 1:
+        return export(*arguments, None)
+
+    tasks = [(export, arguments, shard) for shard in patient_shards(workers * SHARDS_PER_WORKER)]
+    total = 0
+    with multiprocessing.Pool(workers, _init_export_worker) as pool:
+        for written, worker_metrics in pool.imap_unordered(_export_shard_in_worker, tasks):
+            METRICS.merge(worker_metrics)
+            total += written
+    return total
+
+
+def shard_filter(column, shard):
+    """
+    :param column: the patient id column to filter on
+    :param shard: a (first, last) range of patient_id, or None for every patient
+    :return: a WHERE condition for the shard, starting with " WHERE", or "", and its parameters
+    """
+    if shard is None:
+        return "", ()
+    return " WHERE " + column + " BETWEEN %s AND %s", tuple(shard)
+
+
+def csv_event_json(event_data, event_blob=None):
+    """
+    Function to turn a stored event into the JSON text read into its CSV row
+    :param event_data: the stored event data
+    :param event_blob: the stored compressed event, if it was compressed
+    :return: the event as a single line of JSON
+    """
+    formatted_event_data = decode_event_data(event_data, event_blob).replace(
+        '<div xmlns="http://www.w3.org/1999/xhtml">', "<div>").strip("\n")
+    if "\n" in formatted_event_data:
+        # a batch is read as JSON lines, so each event must be on one
+        formatted_event_data = jsonCodec.dumps(jsonCodec.loads(formatted_event_data))
+    return formatted_event_data
+
+
+def write_csv_shard(output_dir, batch_size, rows_per_file, shard=None):
+    """
+    Function to export a shard of patients as CSV files batched by resource type
+    The shard's patients are written to patient/part-<shard>.csv and its events, read in type order, are
+    collected rows_per_file at a time into one DataFrame per resource type and written to
+    <resourceType>/part-<shard>-<batch>.csv. Each event row starts with its patient's unique id and event id.
+    :param output_dir: the directory the export is written to
+    :param batch_size: the number of rows fetched from the database at a time
+    :param rows_per_file: the largest number of events written to one file
+    :param shard: a (first, last) range of patient_id, or None for every patient
+    :return: the number of files written
+    """
+    import pandas as pd
+
+    name = "all" if shard is None else "{:010d}".format(shard[0])
+    con = connect_patient_db()
+    db_cursor = con.cursor(buffered=False)
+    files = 0
+
+    condition, parameters = shard_filter("patient_id", shard)
+    with METRICS.timer("export_query"):
+        db_cursor.execute("SELECT * FROM patient" + condition + " ORDER BY patient_id", parameters)
+    header = [column[0] for column in db_cursor.description]
+    os.makedirs(os.path.join(output_dir, "patient"), exist_ok=True)
+    with open(os.path.join(output_dir, "patient", "part-" + name + ".csv"), 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for patient in fetch_rows(db_cursor, batch_size):
             writer.writerow(patient)
+    files += 1
+
+    def write_events(resource_type, part, unique_ids, event_ids, event_jsons):
+        with METRICS.timer("csv_decode"):
+            # dates are left as FHIR wrote them, as a batch mixing time zones would only be converted in part
+            df = pd.read_json(io.StringIO("\n".join(event_jsons)), lines=True, encoding='utf-8-sig',
+                              convert_dates=False)
+            df.insert(0, "patient_unique_id", unique_ids)
+            df.insert(1, "patient_event_id", event_ids)
+        os.makedirs(os.path.join(output_dir, resource_type), exist_ok=True)
+        with METRICS.timer("csv_write"):
+            df.to_csv(os.path.join(output_dir, resource_type, "part-" + name + "-" + str(part) + ".csv"),
+                      index=None)
+        METRICS.count("csv_files")
+        METRICS.count("csv_rows", len(df))
+
+    condition, parameters = shard_filter("e.patient", shard)
+    load_payload_dictionaries(db_cursor)
+    with METRICS.timer("export_query"):
+        db_cursor.execute("SELECT p.unique_id, e.patient_event_id, e.type, e.event_data, e.event_blob "
+                          "FROM patient_event e JOIN patient p ON p.patient_id = e.patient" + condition +
+                          " ORDER BY e.type, e.patient, e.patient_event_id", parameters)
+    current_type = None
+    part = 0
+    batch = ([], [], [])
+    for unique_id, event_id, event_type, event_data, event_blob in fetch_rows(db_cursor, batch_size):
+        if event_type != current_type or len(batch[0]) >= rows_per_file:
+            if batch[0]:
+                write_events(current_type, part, *batch)
+                files += 1
+            part = part + 1 if event_type == current_type else 0
+            current_type = event_type
+            batch = ([], [], [])
+        batch[0].append(unique_id)
+        batch[1].append(event_id)
+        batch[2].append(csv_event_json(event_data, event_blob))
+    if batch[0]:
+        write_events(current_type, part, *batch)
+        files += 1
+
+    db_cursor.close()
+    con.close()
+    return files
 
-        db_cursor.execute("SELECT * FROM patient_event WHERE patient=" + str(patient[0]))
-        events = db_cursor.fetchall()
 
-        for event in events:
-            # Create event file
-            formatted_event_data = str(event[2]).replace("''","'").replace('""','"').replace('<div xmlns="http://www.w3.org/1999/xhtml">',"<div>").strip("\n")
-            df = pd.read_json(formatted_event_data, lines=True, encoding='utf-8-sig')
-            df.to_csv('csv/' + folder_name + '/event_' + str(event[0]) + '_' + str(event[3]) + '.csv', index=None)
+def patient_folder_name(patient):
+    """
+    :param patient: a row of the patient table, starting patient_id, unique_id, given_name, family_name
+    :return: the name of the patient's folder in a CSV export
+    """
+    return str(patient[2]) + "_" + str(patient[3]) + "_" + str(patient[1])
+
+
+def write_patient_csv(folder_path, header, patient):
+    """
+    Function to write a patient's patient.csv
+    :param folder_path: the patient's folder
+    :param header: the patient table's column names
+    :param patient: the patient's row
+    :return:
+    """
+    with open(os.path.join(folder_path, 'patient.csv'), 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerow(patient)
+
 
+def write_event_csv(folder_path, event_id, event_type, event_data, event_blob=None):
+    """
+    Function to write one event as its own CSV file in a patient's folder
+    :param folder_path: the patient's folder
+    :param event_id: the event's patient_event_id
+    :param event_type: the event's resource type
+    :param event_data: the stored event data
+    :param event_blob: the stored compressed event, if it was compressed
+    :return:
+    """
+    import pandas as pd
+
+    with METRICS.timer("csv_decode"):
+        formatted_event_data = decode_event_data(event_data, event_blob).replace('<div xmlns="http://www.w3.org/1999/xhtml">',"<div>").strip("\n")
+        # pandas no longer accepts literal JSON text, only paths and file objects
+        df = pd.read_json(io.StringIO(formatted_event_data), lines=True, encoding='utf-8-sig')
+    with METRICS.timer("csv_write"):
+        df.to_csv(os.path.join(folder_path, 'event_' + str(event_id) + '_' + str(event_type) + '.csv'), index=None)
+    METRICS.count("csv_files")
+
+
+def export_patient_csv(patient_id, output_dir="csv", include_events=True, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Function to export a single patient's folder, in the per-event layout of create_csv_files
+    With events the folder is written to a staging folder that then replaces it, so it is never seen half
+    written. Without, only patient.csv is replaced and any event files already exported are kept.
+    :param patient_id: the database id of the patient
+    :param output_dir: the directory the patient's folder is written in
+    :param include_events: True to write the patient's event files as well as patient.csv
+    :param batch_size: the number of events fetched from the database at a time
+    :return: the patient's folder, or None if the patient is not in the database
+    """
+    con = connect_patient_db()
+    db_cursor = con.cursor(buffered=False)
+    db_cursor.execute("SELECT * FROM patient WHERE patient_id=%s", (patient_id,))
+    header = [column[0] for column in db_cursor.description]
+    patient = db_cursor.fetchone()
+    db_cursor.fetchall()
+    if patient is None:
+        db_cursor.close()
+        con.close()
+        return None
+
+    folder_path = os.path.join(output_dir, patient_folder_name(patient))
+    if include_events:
+        staging = staging_dir(folder_path)
+        write_patient_csv(staging, header, patient)
+        load_payload_dictionaries(db_cursor)
+        db_cursor.execute("SELECT patient_event_id, type, event_data, event_blob FROM patient_event "
+                          "WHERE patient=%s ORDER BY patient_event_id", (patient_id,))
+        for event_id, event_type, event_data, event_blob in fetch_rows(db_cursor, batch_size):
+            write_event_csv(staging, event_id, event_type, event_data, event_blob)
+        publish_export(staging, folder_path)
+    else:
+        os.makedirs(folder_path, exist_ok=True)
+        write_patient_csv(folder_path, header, patient)
+    db_cursor.close()
+    con.close()
+    return folder_path
+
+
+def write_patient_folders(output_dir, batch_size, shard=None):
+    """
+    Function to export a shard of patients as a folder per patient holding patient.csv and a CSV file per event
+    Patients and their events are read with a single query ordered by patient through an unbuffered cursor,
+    and each patient's files are written as their rows arrive.
+    :param output_dir: the directory the patient folders are written to
+    :param batch_size: the number of rows fetched from the database at a time
+    :param shard: a (first, last) range of patient_id, or None for every patient
+    :return: the number of files written
+    """
+    con = connect_patient_db()
+    db_cursor = con.cursor(buffered=False)
+    load_payload_dictionaries(db_cursor)
+    condition, parameters = shard_filter("p.patient_id", shard)
+    # patients without events are still returned by the left join, with NULL event columns
+    with METRICS.timer("export_query"):
+        db_cursor.execute("SELECT p.*, e.patient_event_id, e.event_data, e.event_blob, e.type FROM patient p "
+                          "LEFT JOIN patient_event e ON e.patient = p.patient_id" + condition +
+                          " ORDER BY p.patient_id, e.patient_event_id", parameters)
+    header = [column[0] for column in db_cursor.description][:-4]
+
+    files = 0
+    current_patient = None
+    folder_path = None
+    for row in fetch_rows(db_cursor, batch_size):
+        patient = row[:-4]
+        event_id, event_data, event_blob, event_type = row[-4:]
+        if patient[0] != current_patient:
+            current_patient = patient[0]
+            folder_path = os.path.join(output_dir, patient_folder_name(patient))
+            if not os.path.isdir(folder_path):
+                os.mkdir(folder_path)
+            write_patient_csv(folder_path, header, patient)
+            files += 1
+
+        if event_id is None:
+            continue
+        write_event_csv(folder_path, event_id, event_type, event_data, event_blob)
+        files += 1
+
+    db_cursor.close()
     con.close()
+    return files
+
+
+def create_csv_files(output_dir="csv", batch_size=EXPORT_BATCH_SIZE, workers=1, rows_per_file=ROWS_PER_CSV_FILE,
+                     layout="per-event"):
+    """
+    A function to create formatted CSV files for each patient in the database
+    and all corresponding events
+    With the per-event layout each patient has a folder holding patient.csv and one file per event, see
+    write_patient_folders. With the per-type layout events are batched by resource type, see write_csv_shard.
+    Either layout can be sharded by patient across worker processes, and either way it is written to a
+    staging directory that replaces output_dir once it is complete.
+    :param output_dir: the directory the export is written to
+    :param batch_size: the number of rows fetched from the database at a time
+    :param workers: the number of processes the export is sharded across
+    :param rows_per_file: the largest number of events in one file of the per-type layout
+    :param layout: one of CSV_LAYOUTS
+    :return: True
+    """
+    if layout not in CSV_LAYOUTS:
+        raise ValueError("CSV layout " + str(layout) + " is not one of " + ", ".join(CSV_LAYOUTS))
+    print("Generating CSV files.....")
+    staging = staging_dir(output_dir)
+    if layout == "per-type":
+        files = export_shards(write_csv_shard, (staging, batch_size, rows_per_file), workers)
+    else:
+        files = export_shards(write_patient_folders, (staging, batch_size), workers)
+    print(str(files) + " CSV files written")
+    publish_export(staging, output_dir)
     print("CSV files generated successfully")
-    print("They are now available in the csv folder")
+    print("They are now available in the " + output_dir + " folder")
+    return True
+
+
+def event_date(resource):
+    """
+    Function to find the date an event happened, whatever the resource type
+    :param resource: the event's FHIR resource
+    :return: the date/dateTime string, or None if the resource has no date
+    """
+    for key in ("effectiveDateTime", "performedDateTime", "onsetDateTime", "occurrenceDateTime", "authoredOn",
+                "recordedDate", "issued", "date", "created"):
+        if key in resource:
+            return resource[key]
+    for key in ("period", "effectivePeriod", "performedPeriod", "billablePeriod"):
+        if key in resource:
+            return resource[key].get("start")
+    return None
+
+
+def parquet_schema(resource_type):
+    """
+    Function to build the Arrow schema of the Parquet dataset for a resource type
+    Every batch of a type is written with the same schema so the dataset can be read as one table.
+    :param resource_type: the FHIR resourceType
+    :return: a pyarrow Schema
+    """
+    import pyarrow as pa
+
+    if resource_type in RESOURCE_TABLES:
+        columns = RESOURCE_TABLE_COLUMNS[RESOURCE_TABLES[resource_type][0]][1:]
+    else:
+        columns = GENERIC_EVENT_COLUMNS
+    fields = [pa.field("patient_unique_id", pa.string()), pa.field("patient_event_id", pa.int64()),
+              pa.field("event_year", pa.string())]
+    for column in columns:
+        if column.endswith("_datetime") or column in ("issued", "created", "recorded_date"):
+            fields.append(pa.field(column, pa.timestamp("us")))
+        elif column in ("value_numeric", "total_value"):
+            fields.append(pa.field(column, pa.float64()))
+        elif column == "item_count":
+            fields.append(pa.field(column, pa.int64()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    fields.append(pa.field("resource_json", pa.string()))
+    return pa.schema(fields)
+
+
+def write_parquet_shard(output_dir, partition_by, batch_size, rows_per_file, shard=None):
+    """
+    Function to export the events of a shard of patients into the Parquet dataset of each resource type
+    Events are read with fetchmany in batches and collected per resource type. Once rows_per_file events of a
+    type are waiting they are flattened into columns in one pass, with the same extractors as the typed tables,
+    and written. Each dataset is partitioned on the patient's unique id or the year of the event. Every write
+    adds new uniquely named files, so shards can be written to the same datasets at the same time. The shard's
+    patients are then written with write_parquet_patients.
+    :param output_dir: the directory the datasets are written to
+    :param partition_by: "patient" or "date"
+    :param batch_size: the number of events fetched from the database at a time
+    :param rows_per_file: the number of events of a resource type collected before they are written
+    :param shard: a (first, last) range of patient_id, or None for every patient
+    :return: the number of writes
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partition_column = "patient_unique_id" if partition_by == "patient" else "event_year"
+
+    def write_rows(resource_type, resources, per_resource):
+        schema = parquet_schema(resource_type)
+        extractor = RESOURCE_TABLES[resource_type][1] if resource_type in RESOURCE_TABLES else \
+            GENERIC_EVENT_EXTRACTOR
+        with METRICS.timer("flatten"):
+            columns = extractor.flatten(resources, per_resource)
+        with METRICS.timer("parquet_write"):
+            table = pa.Table.from_pydict(columns, schema=schema)
+            pq.write_to_dataset(table, os.path.join(output_dir, resource_type), partition_cols=[partition_column])
+        METRICS.count("parquet_rows", table.num_rows)
+
+    con = connect_patient_db()
+    db_cursor = con.cursor(buffered=False)
+    condition, parameters = shard_filter("e.patient", shard)
+    load_payload_dictionaries(db_cursor)
+    # ordered by type so only one resource type is being collected at a time
+    with METRICS.timer("export_query"):
+        db_cursor.execute("SELECT p.unique_id, e.patient_event_id, e.type, e.event_data, e.event_blob "
+                          "FROM patient_event e JOIN patient p ON p.patient_id = e.patient" + condition +
+                          " ORDER BY e.type, e.patient, e.patient_event_id", parameters)
+
+    writes = 0
+    current_type = None
+    resources = []
+    per_resource = None
+    for unique_id, event_id, resource_type, event_data, event_blob in fetch_rows(db_cursor, batch_size):
+        if resource_type != current_type or len(resources) >= rows_per_file:
+            if resources:
+                write_rows(current_type, resources, per_resource)
+                writes += 1
+            current_type = resource_type
+            resources = []
+            per_resource = {"patient_unique_id": [], "patient_event_id": [], "event_year": [], "resource_json": []}
+
+        event_json = decode_event_data(event_data, event_blob)
+        try:
+            resource = jsonCodec.loads(event_json)
+        except ValueError:
+            # an event stored by the first version, written out again as valid JSON
+            resource = parse_event_json(event_json)
+            if resource is None:
+                METRICS.count("undecodable_events")
+                print("ERROR: Event " + str(event_id) + " could not be decoded and was not exported")
+                continue
+            event_json = jsonCodec.dumps(resource)
+        date = event_date(resource)
+        resources.append(resource)
+        per_resource["patient_unique_id"].append(unique_id)
+        per_resource["patient_event_id"].append(event_id)
+        per_resource["event_year"].append(date[:4] if date else "unknown")
+        per_resource["resource_json"].append(event_json)
+    if resources:
+        write_rows(current_type, resources, per_resource)
+        writes += 1
+
+    writes += write_parquet_patients(db_cursor, output_dir, batch_size, rows_per_file, shard)
+    db_cursor.close()
+    con.close()
+    return writes
+
+
+def write_parquet_patients(db_cursor, output_dir, batch_size, rows_per_file, shard=None):
+    """
+    Function to export the patient table rows of a shard of patients into the patient Parquet dataset
+    The dataset has the same columns as the patient CSV files. It is not partitioned, each write adds a new
+    uniquely named file.
+    :param db_cursor: a cursor on the patient database
+    :param output_dir: the directory the datasets are written to
+    :param batch_size: the number of patients fetched from the database at a time
+    :param rows_per_file: the number of patients written to each file
+    :param shard: a (first, last) range of patient_id, or None for every patient
+    :return: the number of writes
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    condition, parameters = shard_filter("patient_id", shard)
+    with METRICS.timer("export_query"):
+        db_cursor.execute("SELECT * FROM patient" + condition + " ORDER BY patient_id", parameters)
+    header = [column[0] for column in db_cursor.description]
+    # the numeric columns keep their type, DECIMAL values are written as doubles and the rest as text
+    types = [PATIENT_PARQUET_NUMBERS.get(column, str) for column in header]
+    schema = pa.schema([pa.field(column, pa.int64() if kind is int else pa.float64() if kind is float else pa.string())
+                        for column, kind in zip(header, types)])
+
+    def write_patients(rows):
+        columns = {column: [None if value is None else kind(value) for value in values]
+                   for column, kind, values in zip(header, types, zip(*rows))}
+        with METRICS.timer("parquet_write"):
+            table = pa.Table.from_pydict(columns, schema=schema)
+            pq.write_to_dataset(table, os.path.join(output_dir, "patient"))
+        METRICS.count("parquet_rows", table.num_rows)
+
+    writes = 0
+    rows = []
+    for row in fetch_rows(db_cursor, batch_size):
+        rows.append(row)
+        if len(rows) >= rows_per_file:
+            write_patients(rows)
+            writes += 1
+            rows = []
+    if rows:
+        write_patients(rows)
+        writes += 1
+    return writes
+
+
+def create_parquet_files(output_dir="parquet", partition_by="patient", batch_size=EXPORT_BATCH_SIZE,
+                         rows_per_file=ROWS_PER_PARQUET_FILE, workers=1):
+    """
+    A function to export every event in the database as one Parquet dataset per resource type, and the patients
+    as a patient dataset
+    The events and patients are written by write_parquet_shard, sharded by patient across workers processes. The datasets
+    are written to a staging directory that replaces output_dir once the export is complete.
+    :param output_dir: the directory the datasets are written to
+    :param partition_by: "patient" or "date"
+    :param batch_size: the number of events fetched from the database at a time
+    :param rows_per_file: the number of events of a resource type collected before they are written
+    :param workers: the number of processes exporting
+    :return: True if the export was written, False if pyarrow is not installed
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        print("ERROR: pyarrow is required to export Parquet files")
+        return False
 
+    print("Generating Parquet files.....")
+    staging = staging_dir(output_dir)
+    export_shards(write_parquet_shard, (staging, partition_by, batch_size, rows_per_file), workers)
+    publish_export(staging, output_dir)
+    print("Parquet files generated successfully")
+    print("They are now available in the " + output_dir + " folder")
     return True
 
 
-def load_app_interface():
+def patient_page_query(after=None, search=None, page_size=UI_PAGE_SIZE, order_by="patient_id"):
+    """
+    Function to build the query reading a page of patients for the patient browser
+    Pages are found by keyset pagination: patients are ordered by order_by and then patient_id, and the next
+    page starts after the (sort value, patient_id) of the last patient of this one. Patients with the same name
+    are kept in one order by their patient_id, so none is skipped or shown twice at a page boundary. In
+    patient_id or unique_id order each page is read from an index however far through the patients it is,
+    where an OFFSET would read and throw away every patient before it.
+    :param after: the (sort value, patient_id) the page starts after, see PatientPager.sort_key, or None for the
+    first page
+    :param search: text the given name, family name or unique id must start with, ignoring case, or None
+    :param page_size: the most patients returned
+    :param order_by: one of UI_SORT_COLUMNS
+    :return: the SQL and a tuple of its parameters
+    """
+    if order_by not in UI_SORT_COLUMNS:
+        raise ValueError("Patients cannot be ordered by " + str(order_by))
+    # names may be NULL, which would compare as neither before nor after the last patient of a page
+    key = order_by if order_by in ("patient_id", "unique_id") else "COALESCE(" + order_by + ", '')"
+    conditions = []
+    parameters = []
+    if after is not None:
+        if order_by == "patient_id":
+            conditions.append("patient_id > %s")
+            parameters.append(after[1])
+        else:
+            # spelled out rather than as a row comparison, which MySQL 5.7 cannot use an index for
+            conditions.append("(" + key + " > %s OR (" + key + " = %s AND patient_id > %s))")
+            parameters += [after[0], after[0], after[1]]
+    if search:
+        # ! escapes the LIKE wildcards typed into the search, as the databases differ on the default escape
+        pattern = search.lower().replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+        conditions.append("(LOWER(given_name) LIKE %s ESCAPE '!' OR LOWER(family_name) LIKE %s ESCAPE '!' "
+                          "OR LOWER(unique_id) LIKE %s ESCAPE '!')")
+        parameters += [pattern] * 3
+    sql = "SELECT patient_id, unique_id, given_name, family_name FROM patient"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + key + (", patient_id" if order_by != "patient_id" else "") + " LIMIT %s"
+    return sql, tuple(parameters) + (page_size,)
+
+
+def patient_page(db_cursor, after=None, search=None, page_size=UI_PAGE_SIZE, order_by="patient_id"):
+    """
+    Function to read a page of patients for the patient browser, see patient_page_query
+    :param db_cursor: a cursor on the patient database
+    :param after: the (sort value, patient_id) the page starts after, or None for the first page
+    :param search: text the given name, family name or unique id must start with, ignoring case, or None
+    :param page_size: the most patients returned
+    :param order_by: one of UI_SORT_COLUMNS
+    :return: a list of (patient_id, unique_id, given_name, family_name) rows
+    """
+    db_cursor.execute(*patient_page_query(after, search, page_size, order_by))
+    return db_cursor.fetchall()
+
+
+class PatientPager:
+    """
+    The pages of the patient browser, walked forward and back a page at a time
+    The key each page visited starts after is kept, so going back reads the earlier page again by its key.
+    Moving to another page does not read it, so the browser can end its read transaction first.
+    """
+
+    def __init__(self, db_cursor, search=None, order_by="patient_id", page_size=UI_PAGE_SIZE):
+        """
+        :param db_cursor: a cursor on the patient database
+        :param search: text the given name, family name or unique id must start with, ignoring case, or None
+        :param order_by: one of UI_SORT_COLUMNS
+        :param page_size: the most patients on a page
+        """
+        self.db_cursor = db_cursor
+        self.search = search
+        self.order_by = order_by
+        self.page_size = page_size
+        # the key each page visited starts after, the last being the current page
+        self.starts = [None]
+        self.rows = []
+        self.more = False
+
+    def sort_key(self, row):
+        """
+        :param row: a row of patient_page
+        :return: the (sort value, patient_id) the page after the row starts after
+        """
+        value = row[UI_SORT_COLUMNS.index(self.order_by)]
+        return ("" if value is None else value), row[0]
+
+    def read(self):
+        """
+        Function to read the current page again, with any patients loaded since it was last read
+        :return: the page's rows
+        """
+        # one row more than the page shows whether there is a next page
+        rows = patient_page(self.db_cursor, self.starts[-1], self.search, self.page_size + 1, self.order_by)
+        self.more = len(rows) > self.page_size
+        self.rows = rows[:self.page_size]
+        return self.rows
+
+    def next_page(self):
+        """
+        Function to move to the page after the one last read, which the next read returns
+        :return:
+        """
+        self.starts.append(self.sort_key(self.rows[-1]))
+
+    def previous_page(self):
+        """
+        Function to move to the page before the current one, which the next read returns
+        :return:
+        """
+        self.starts.pop()
+
+    def page_number(self):
+        """
+        :return: the number of the current page, counting from 1
+        """
+        return len(self.starts)
+
+
+def event_counts(db_cursor, patient_ids):
+    """
+    Function to count the events of a page of patients with one aggregate over the patient_event index
+    :param db_cursor: a cursor on the patient database
+    :param patient_ids: the database ids of the patients
+    :return: a dictionary of patient_id to number of events, patients without events are left out
+    """
+    if not patient_ids:
+        return {}
+    db_cursor.execute("SELECT patient, COUNT(*) FROM patient_event WHERE patient IN (" +
+                      ", ".join(["%s"] * len(patient_ids)) + ") GROUP BY patient", tuple(patient_ids))
+    return dict(db_cursor.fetchall())
+
+
+def load_app_interface(output_dir="csv"):
     """
     A function to display the contents of the database to the user and allow them to generate CSV files
     at the click of a button.
 
-    Currently incomplete and not in use.
+    Patients are shown a page at a time, read with a PatientPager, in a table that only holds the rows of that
+    page, so the window opens and pages as quickly with a million patients as with ten. Clicking a column
+    heading orders the patients by it. The event counts of the page come from event_counts. Exports for the
+    selected patient run on a background thread with their own connection, and report back through a queue
+    the window polls, so it keeps responding while they run.
 
+    :param output_dir: the directory patient folders are exported to
     :return:
     """
-    app = Tk()
+    import queue
+    import threading
+    import tkinter as tk
+    from tkinter import ttk
+
+    app = tk.Tk()
     app.title("Medical Records")
     app.geometry("900x600")
-    app.resizable(width=0, height=0)
     app['bg'] = 'white'
 
-    frame = Frame(app)
-    frame.pack(expand=True, fill=BOTH)  # .grid(row=0,column=0)
-    canvas = Canvas(frame, bg='#FFFFFF', width=900, height=600)
-    hbar = Scrollbar(frame, orient=HORIZONTAL)
-    hbar.pack(side=BOTTOM, fill=X)
-    hbar.config(command=canvas.xview)
-    vbar = Scrollbar(frame, orient=VERTICAL)
-    vbar.pack(side=RIGHT, fill=Y)
-    vbar.config(command=canvas.yview)
-    canvas.config(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
-
     con = connect_patient_db()
+    if not con:
+        return
     db_cursor = con.cursor()
-    db_cursor.execute("SELECT given_name, family_name, unique_id FROM patient")
-    patients = db_cursor.fetchall()
+    state = {"pager": PatientPager(db_cursor)}
+    # (outcome, detail) of each finished export, put by the export threads and read on the Tk thread
+    results = queue.Queue()
+
+    search_bar = tk.Frame(app, bg='white')
+    search_bar.pack(side=tk.TOP, fill=tk.X, padx=8, pady=8)
+    tk.Label(search_bar, text="Name or Unique ID", bg='white').pack(side=tk.LEFT)
+    search_text = tk.StringVar()
+    search_entry = tk.Entry(search_bar, textvariable=search_text, width=40)
+    search_entry.pack(side=tk.LEFT, padx=8)
+
+    table_frame = tk.Frame(app)
+    table_frame.pack(side=tk.TOP, expand=True, fill=tk.BOTH, padx=8)
+    table = ttk.Treeview(table_frame, columns=("unique_id", "given_name", "family_name", "events"),
+                         show="headings", selectmode="browse")
+    for column, heading, width in (("unique_id", "Unique ID", 300), ("given_name", "Given Name", 200),
+                                   ("family_name", "Family Name", 200), ("events", "Events", 100)):
+        if column in UI_SORT_COLUMNS:
+            table.heading(column, text=heading, command=lambda order_by=column: sort(order_by))
+        else:
+            table.heading(column, text=heading)
+        table.column(column, width=width, anchor=tk.E if column == "events" else tk.W)
+    vbar = tk.Scrollbar(table_frame, orient=tk.VERTICAL, command=table.yview)
+    table.configure(yscrollcommand=vbar.set)
+    vbar.pack(side=tk.RIGHT, fill=tk.Y)
+    table.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+
+    buttons = tk.Frame(app, bg='white')
+    buttons.pack(side=tk.TOP, fill=tk.X, padx=8, pady=8)
+    status = tk.Label(app, text="", bg='white', anchor=tk.W)
+    status.pack(side=tk.BOTTOM, fill=tk.X, padx=8, pady=4)
+
+    def show_page():
+        # end the read transaction so the page includes patients loaded since the last one
+        con.rollback()
+        pager = state["pager"]
+        rows = pager.read()
+        counts = event_counts(db_cursor, [row[0] for row in rows])
+        table.delete(*table.get_children())
+        for patient_id, unique_id, given_name, family_name in rows:
+            table.insert("", tk.END, iid=str(patient_id),
+                         values=(unique_id, given_name, family_name, counts.get(patient_id, 0)))
+        previous_button.config(state=tk.NORMAL if pager.page_number() > 1 else tk.DISABLED)
+        next_button.config(state=tk.NORMAL if pager.more else tk.DISABLED)
+        page_label.config(text="Page " + str(pager.page_number()))
+
+    def next_page():
+        state["pager"].next_page()
+        show_page()
+
+    def previous_page():
+        state["pager"].previous_page()
+        show_page()
+
+    def search(_=None):
+        state["pager"] = PatientPager(db_cursor, search_text.get().strip() or None, state["pager"].order_by)
+        show_page()
+
+    def sort(order_by):
+        state["pager"] = PatientPager(db_cursor, state["pager"].search, order_by)
+        show_page()
+
+    def export(include_events):
+        selected = table.selection()
+        if not selected:
+            status.config(text="Select a patient first")
+            return
+        patient_id = int(selected[0])
+        status.config(text="Exporting " + table.set(selected[0], "unique_id") + "...")
+
+        def run():
+            try:
+                results.put(("done", export_patient_csv(patient_id, output_dir, include_events)))
+            except Exception as e:
+                METRICS.error("ui_export", e)
+                results.put(("error", str(e)))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def poll_results():
+        while not results.empty():
+            outcome, detail = results.get()
+            if outcome == "error":
+                status.config(text="ERROR: The export failed: " + detail)
+            elif detail is None:
+                status.config(text="ERROR: The patient is no longer in the database")
+            else:
+                status.config(text="Exported to " + detail)
+        app.after(200, poll_results)
+
+    tk.Button(search_bar, text="Search", command=search).pack(side=tk.LEFT)
+    search_entry.bind("<Return>", search)
+    previous_button = tk.Button(buttons, text="< Previous", command=previous_page)
+    previous_button.pack(side=tk.LEFT)
+    page_label = tk.Label(buttons, text="", bg='white', width=10)
+    page_label.pack(side=tk.LEFT)
+    next_button = tk.Button(buttons, text="Next >", command=next_page)
+    next_button.pack(side=tk.LEFT)
+    tk.Button(buttons, text="Events CSV", command=lambda: export(True)).pack(side=tk.RIGHT)
+    tk.Button(buttons, text="Profile CSV", command=lambda: export(False)).pack(side=tk.RIGHT, padx=8)
+
+    show_page()
+    poll_results()
+    app.mainloop()
+    db_cursor.close()
     con.close()
 
-    # this wil create a label widget
-    l1 = Label(canvas, text="Unique ID", width=37)
-    l2 = Label(canvas, text="Given Name", width=18)
-    l3 = Label(canvas, text="Family Name", width=18)
-    l4 = Label(canvas, text="Events", width=18)
-    l5 = Label(canvas, text="Profile CSV", width=20)
-    l6 = Label(canvas, text="Events CSV", width=10)
-
-    # grid method to arrange labels in respective
-    # rows and columns as specified
-    l1.grid(row=0, column=1, sticky=W, pady=2)
-    l2.grid(row=0, column=2, sticky=W, pady=2)
-    l3.grid(row=0, column=3, sticky=W, pady=2)
-    l4.grid(row=0, column=4, sticky=W, pady=2)
-    l5.grid(row=0, column=5, sticky=W, pady=2)
-    l6.grid(row=0, column=6, sticky=W, pady=2)
-
-    i = 1
-    for patient in patients:
-        l1 = Label(canvas, text=patient[2], width=37)
-        l2 = Label(canvas, text=patient[0], width=18)
-        l3 = Label(canvas, text=patient[1], width=18)
-        l4 = Label(canvas, text="Events", width=18)
-        l5 = Label(canvas, text="Profile CSV", width=20)
-        l6 = Label(canvas, text="Events CSV", width=10)
-
-        l1.grid(row=i, column=1, sticky=W, pady=1)
-        l2.grid(row=i, column=2, sticky=W, pady=1)
-        l3.grid(row=i, column=3, sticky=W, pady=1)
-        l4.grid(row=i, column=4, sticky=W, pady=1)
-        l5.grid(row=i, column=5, sticky=W, pady=1)
-        l6.grid(row=i, column=6, sticky=W, pady=1)
-        i += 1
-
-    canvas.configure(scrollregion=canvas.bbox("all"))
-    canvas.pack(side=LEFT, expand=True, fill=BOTH)
 
-    app.mainloop()
+# the subcommands of the command line, "run" being used when none is given
+COMMANDS = ("init", "ingest", "export", "summaries", "ui", "run")
+
+
+def cli_parser():
+    """
+    Function to build the command line parser, with a subcommand for each stage of the pipeline
+    Each subcommand only imports what its stage needs, e.g. pandas for a CSV export and tkinter for the ui,
+    so a headless ingest starts without loading either.
+    :return: the ArgumentParser
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--backend", choices=BACKENDS, default=STORAGE_BACKEND,
+                        help="database the patient tables are kept in")
+    common.add_argument("--database-path", default=DB_PATH,
+                        help="database file for the sqlite and duckdb backends")
+    common.add_argument("--metrics-format", choices=("json", "prometheus"), default=None,
+                        help="dump timers, counters and errors in this format at the end of the run")
+    common.add_argument("--metrics-file", default=None, help="file the metrics are written to instead of stdout")
+
+    ingest = argparse.ArgumentParser(add_help=False)
+    ingest.add_argument("--data-dir", default="data", help="the directory of FHIR bundle files to load")
+    ingest.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="maximum rows sent to the database in one batch")
+    ingest.add_argument("--bundles-per-commit", type=int, default=1,
+                        help="number of bundles written in each transaction")
+    ingest.add_argument("--workers", type=int, default=1,
+                        help="number of processes loading bundle files in parallel")
+    ingest.add_argument("--resume", action="store_true",
+                        help="continue the last load if it was interrupted and repair half loaded patients")
+    ingest.add_argument("--progress-interval", type=float, default=0,
+                        help="seconds between progress lines while loading, 0 for none")
+    ingest.add_argument("--compress-events", choices=("none",) + tuple(payloadCodec.available_codecs()),
+                        default=EVENT_COMPRESSION,
+                        help="store new events compressed with a dictionary trained on the bundles, rather than "
+                             "as JSON text")
+
+    export = argparse.ArgumentParser(add_help=False)
+    export.add_argument("--output-dir", default=None,
+                        help="the directory the export is written to, by default csv or parquet")
+    export.add_argument("--export-batch-size", type=int, default=EXPORT_BATCH_SIZE,
+                        help="number of rows fetched from the database at a time while exporting")
+    export.add_argument("--export-format", choices=("csv", "parquet"), default="csv",
+                        help="write CSV files laid out as --csv-layout, or one Parquet dataset per resource type")
+    export.add_argument("--csv-layout", choices=CSV_LAYOUTS, default="per-event",
+                        help="a folder per patient with one CSV file per event, or each resource type's events "
+                             "batched into large CSV files")
+    export.add_argument("--export-workers", type=int, default=1,
+                        help="processes the export is sharded across by patient")
+    export.add_argument("--partition-by", choices=("patient", "date"), default="patient",
+                        help="how Parquet datasets are partitioned")
+
+    parser = argparse.ArgumentParser(description="Transform FHIR bundles into the patient database and CSV or "
+                                                 "Parquet files. Without a command the whole pipeline is run.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.add_parser("init", parents=[common], help="create the patient database or bring it up to date")
+    commands.add_parser("ingest", parents=[common, ingest], help="load the bundle files into the database")
+    commands.add_parser("export", parents=[common, export], help="write the CSV files or Parquet datasets")
+    commands.add_parser("summaries", parents=[common],
+                        help="recompute the dashboard summary tables from the typed tables")
+    ui = commands.add_parser("ui", parents=[common], help="browse the patients in the database in a window")
+    ui.add_argument("--output-dir", default="csv", help="the directory patient folders are exported to")
+    commands.add_parser("run", parents=[common, ingest, export], help="init, ingest and export, the default")
+    return parser
 
 
 if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        # the whole pipeline runs without a command, as it did before there were commands
+        argv = ["run"] + argv
+    args = cli_parser().parse_args(argv)
+    STORAGE_BACKEND = args.backend
+    DB_PATH = args.database_path
+
     # check if database exists or create if it doesn't exist
-    if init_database():
+    with METRICS.timer("init_database"):
+        initialised = init_database()
+    if initialised and args.command in ("ingest", "run"):
         # load data files and process to fill database
-        load_json_files("data")
+        METRICS.progress_interval = args.progress_interval
+        EVENT_COMPRESSION = args.compress_events
+        with METRICS.timer("ingest"):
+            load_json_files(args.data_dir, args.batch_size, args.bundles_per_commit, args.workers, args.resume)
+
+    if initialised and args.command in ("export", "run"):
+        # create csv or parquet files
+        with METRICS.timer("export"):
+            if args.export_format == "parquet":
+                create_parquet_files(args.output_dir or "parquet", partition_by=args.partition_by,
+                                     batch_size=args.export_batch_size, workers=args.export_workers)
+            else:
+                create_csv_files(args.output_dir or "csv", batch_size=args.export_batch_size,
+                                 workers=args.export_workers, layout=args.csv_layout)
+
+    if initialised and args.command == "summaries":
+        con = connect_patient_db()
+        build_summary_tables(con)
+        con.close()
 
-        # create csv files
-        create_csv_files()
+    if initialised and args.command == "ui":
+        load_app_interface(args.output_dir)
 
-        # load interface
-        # load_app_interface()
+    if args.metrics_format:
+        METRICS.dump(args.metrics_format, args.metrics_file)
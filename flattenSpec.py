@@ -0,0 +1,230 @@
+import re
+
+'''
+Declarative flattening of FHIR resources into table rows.
+A spec names a table and lists its columns, each with a path to the value in the resource, e.g.
+
+    {"table": "patient_condition",
+     "fields": (("resource_id", "id"),
+                ("code", "code.coding[0].code"),
+                ("onset_datetime", "onsetDateTime", fhir_datetime))}
+
+A field is (column, path), (column, path, transform) or (column, path, transform, default). The transform is
+applied to any value found and the default is used when there is none. Paths are dotted keys where a key may
+be followed by one selector:
+    name[2]         the item at that index of the list
+    name[?key]      the first item of the list with a non empty key
+    name(url)       the first item of the list whose url is url or ends with "/" + url, used for extensions
+Alternatives are separated by "|" and the first that gives a value is used. Missing keys and indexes give no
+value rather than an error, so a resource that lacks an optional element, or lists its extensions in another
+order, still flattens.
+
+With "each" in the spec, a row is written for every item of that list in the resource, or one row for the
+resource itself if it has none. Paths starting with "@" are then read from the item and paths starting with
+"^" from the resource the item came from, which gives no value on the row for the resource itself.
+Other paths are always read from the resource.
+
+Extractor compiles a spec once into a single generated Python function that reads every column with plain
+dictionary and list lookups, so flattening costs about the same as hand written code. It turns resources
+into rows or into one list per column.
+'''
+
+_step = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)(?:\[(?:(\d+)|\?([A-Za-z_][A-Za-z0-9_]*))\]|\(([^()|]+)\))?(\.|$)')
+
+# the argument of the generated function each path is read from, by its prefix
+_ROOTS = {"": "resource", "@": "element", "^": "parent"}
+
+
+class SpecError(ValueError):
+    """
+    Raised when a flattening spec or path cannot be compiled
+    """
+
+
+def _having(items, key):
+    """
+    :return: the first dictionary in items with a non empty key, or None
+    """
+    if type(items) is list:
+        for item in items:
+            if type(item) is dict and item.get(key):
+                return item
+    return None
+
+
+def _with_url(items, url, suffix):
+    """
+    :return: the first dictionary in items whose url is url or ends with suffix, or None
+    """
+    if type(items) is list:
+        for item in items:
+            if type(item) is dict:
+                item_url = item.get("url")
+                if item_url == url or (type(item_url) is str and item_url.endswith(suffix)):
+                    return item
+    return None
+
+
+def _alternative_code(text):
+    """
+    Function to translate a path without alternatives into statements that set v to its value
+    The steps are nested ifs that check the type each step needs, so a missing or unexpected element stops
+    the lookup straight away and leaves v as it was rather than raising an error.
+    :param text: the path, possibly starting with "@" or "^"
+    :return: a list of lines of Python
+    """
+    root = text[:1] if text[:1] in ("@", "^") else ""
+    text = text[len(root):]
+    # pairs of the condition the current value must meet, or None for no check, and the next value
+    steps = []
+    pos = 0
+    while pos < len(text):
+        match = _step.match(text, pos)
+        if not match or (match.group(5) == "." and match.end() == len(text)):
+            raise SpecError("Cannot read path " + text + " at position " + str(pos))
+        name, index, key, url = match.group(1, 2, 3, 4)
+        steps.append(("type(x) is dict", "x.get(%r)" % name))
+        if index is not None:
+            steps.append(("type(x) is list and len(x) > %d" % int(index), "x[%d]" % int(index)))
+        elif key is not None:
+            steps.append((None, "_having(x, %r)" % key))
+        elif url is not None:
+            steps.append((None, "_with_url(x, %r, %r)" % (url.strip(), "/" + url.strip())))
+        pos = match.end()
+    if not steps:
+        raise SpecError("Empty path")
+
+    lines = ["x = " + _ROOTS[root]]
+    indent = ""
+    for number, (condition, value) in enumerate(steps):
+        if condition is not None:
+            lines.append(indent + "if " + condition + ":")
+            indent += "    "
+        lines.append(indent + ("v = " if number == len(steps) - 1 else "x = ") + value)
+    return lines
+
+
+def _path_code(path):
+    """
+    Function to translate a path into statements that set v to the first value its alternatives give, or None
+    :param path: the path, see the module notes for the syntax
+    :return: a list of lines of Python
+    """
+    lines = ["v = None"]
+    for depth, text in enumerate(path.split("|")):
+        indent = "    " * depth
+        if depth:
+            lines.append("    " * (depth - 1) + 'if v is None or v == "":')
+        lines.extend(indent + line for line in _alternative_code(text.strip()))
+    return lines
+
+
+def _generate(name, arguments, body, namespace):
+    """
+    Function to compile generated lines into a function
+    :param name: the function name, used in tracebacks
+    :param arguments: the function's argument list
+    :param body: the lines of the function body
+    :param namespace: the names the body refers to
+    :return: the function
+    """
+    # the names are passed in to an outer function so the body reads them as closure variables, which is
+    # quicker than looking up globals and builtins
+    namespace = dict(namespace, type=type, dict=dict, list=list, len=len, _having=_having, _with_url=_with_url)
+    source = "def make(" + ", ".join(namespace) + "):\n" + \
+             "    def " + name + "(" + arguments + "):\n" + \
+             "".join("        " + line + "\n" for line in body) + \
+             "    return " + name + "\n"
+    scope = {}
+    exec(compile(source, "<" + name + ">", "exec"), scope)
+    return scope["make"](**namespace)
+
+
+class Extractor:
+    """
+    A compiled flattening spec.
+
+    The spec is turned into one generated function, rows, that flattens a resource into a list of row tuples
+    in column order. Columns read from the resource itself are worked out once however many rows it gives.
+    The extractor can be called in the same way as rows. flatten turns a batch of resources in one pass into
+    a dictionary of column name to the list of values, ready to be zipped into rows for executemany or handed
+    to pandas or pyarrow.
+    """
+
+    def __init__(self, spec):
+        self.table = spec.get("table")
+        self.each = spec.get("each")
+        self.columns = tuple(field[0] for field in spec["fields"])
+        namespace = {}
+        resource_code = []
+        element_code = []
+        for number, field in enumerate(spec["fields"]):
+            if not 2 <= len(field) <= 4:
+                raise SpecError("Field " + str(field[0]) + " should be (column, path[, transform[, default]])")
+            transform = field[2] if len(field) > 2 else None
+            default = field[3] if len(field) > 3 else None
+            per_element = any(text.strip()[:1] in ("@", "^") for text in field[1].split("|"))
+            code = element_code if per_element else resource_code
+            code.append("# " + field[0])
+            code.extend(_path_code(field[1]))
+            namespace["_default%d" % number] = default
+            if transform is None:
+                code.append('c%d = _default%d if v is None or v == "" else v' % (number, number))
+            else:
+                namespace["_transform%d" % number] = transform
+                code.append('c%d = _default%d if v is None or v == "" else _transform%d(v)'
+                            % (number, number, number))
+        row = "(" + "".join("c%d, " % number for number in range(len(self.columns))) + ")"
+
+        body = resource_code
+        if self.each:
+            body += _path_code(self.each)
+            body += ["if type(v) is list and v:",
+                     "    pairs = [(item, resource) for item in v]",
+                     "else:",
+                     "    pairs = ((resource, None),)",
+                     "rows = []",
+                     "for element, parent in pairs:"]
+            body += ["    " + line for line in element_code]
+            body += ["    rows.append(" + row + ")",
+                     "return rows"]
+        else:
+            body += ["element = resource", "parent = None"] + element_code + ["return [" + row + "]"]
+        self.rows = _generate(re.sub(r'\W', '_', self.table or "event") + "_rows", "resource", body, namespace)
+
+    def __call__(self, resource):
+        """
+        Flatten one resource
+        :param resource: the FHIR resource
+        :return: a list of row tuples in column order
+        """
+        return self.rows(resource)
+
+    def flatten(self, resources, per_resource=None):
+        """
+        Flatten a batch of resources into column lists in a single pass
+        :param resources: a list of FHIR resources
+        :param per_resource: a dictionary of extra column name to a list with one value per resource, which is
+        repeated for every row that resource gives, e.g. the database id of each resource's patient
+        :return: a dictionary of column name to list of values, the extra columns first
+        """
+        per_resource = per_resource or {}
+        rows_of = self.rows
+        if self.each is None:
+            rows = [rows_of(resource)[0] for resource in resources]
+            extra = per_resource
+        else:
+            rows = []
+            counts = []
+            for resource in resources:
+                resource_rows = rows_of(resource)
+                counts.append(len(resource_rows))
+                rows.extend(resource_rows)
+            extra = {name: [value for value, count in zip(column, counts) for _ in range(count)]
+                     for name, column in per_resource.items()}
+        columns = {name: list(column) for name, column in extra.items()}
+        if rows:
+            columns.update(zip(self.columns, map(list, zip(*rows))))
+        else:
+            columns.update((name, []) for name in self.columns)
+        return columns
@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import dataReader
+import payloadCodec
+from bundleParser import iter_bundle_entries
+from metrics import METRICS
+from storage import BACKENDS
+
+'''
+Long running ingestion from an inbox directory.
+The inbox is polled for .json bundles, which are queued once their size and modification time have stopped
+changing. Bundles are parsed on a thread pool and handed to a single writer that owns the database
+connection and commits each bundle as soon as it is written. Both queues are bounded, so a slow database
+holds back the parsers and a slow parser holds back the poller rather than bundles piling up in memory.
+Each file is moved to the done or failed folder once it has been handled.
+Run with "python ingestDaemon.py --inbox <directory>", see --help for the options.
+'''
+
+POLL_INTERVAL = 2.0
+QUEUE_DEPTH = 8
+PARSE_THREADS = 4
+
+
+def scan_inbox(inbox):
+    """
+    Function to find the bundles waiting in the inbox, oldest first
+    :param inbox: the directory to scan, sub directories are not searched
+    :return: a list of (file path, (size, mtime)) tuples
+    """
+    found = []
+    with os.scandir(inbox) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".json"):
+                try:
+                    file_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((dataReader.manifest_key(entry.path), (file_stat.st_size, file_stat.st_mtime)))
+    found.sort(key=lambda item: item[1][1])
+    return found
+
+
+def parse_bundle(file_path):
+    """
+    Function run on the parse pool to hash a bundle file and decode its entries
+    :param file_path: A file path to a .json file
+    :return: the ingest_manifest row for the file and the list of entries
+    """
+    file_stat = os.stat(file_path)
+    with METRICS.timer("file_hash"):
+        manifest_row = (file_path, file_stat.st_size, file_stat.st_mtime, dataReader.file_hash(file_path),
+                        datetime.utcnow())
+    METRICS.count("bytes_read", file_stat.st_size)
+    with METRICS.timer("parse_bundle"):
+        entries = list(iter_bundle_entries(file_path))
+    return manifest_row, entries
+
+
+def write_bundle(loader, manifest_row, entries):
+    """
+    Function run on the writer thread to load a parsed bundle and commit it
+    :param loader: the BulkLoader owned by the writer
+    :param manifest_row: the ingest_manifest row for the file
+    :param entries: the bundle's entries
+    :return: True if written or unchanged, False if unable to load
+    """
+    if loader.manifest is None:
+        loader.manifest = dataReader.read_manifest(loader)
+    file_path = manifest_row[0]
+    recorded = loader.manifest.get(file_path)
+    if recorded is not None and recorded[2] == manifest_row[3]:
+        dataReader.record_manifest(manifest_row, loader, recorded[3])
+        loader.commit()
+        loader.unchanged_files += 1
+        METRICS.count("files_unchanged")
+        return True
+
+    if dataReader.EVENT_COMPRESSION != "none" and loader.payload_dictionary is None:
+        loader.payload_dictionary = payload_dictionary(loader, file_path)
+    with METRICS.timer("process_bundle"):
+        processed = dataReader.process_entries(iter(entries), file_path, loader, manifest_row)
+    # bundles without a patient or that failed leave nothing pending, but any lock taken is released here
+    loader.commit()
+    METRICS.count("files_loaded" if processed else "files_failed")
+    return processed
+
+
+def payload_dictionary(loader, file_path):
+    """
+    Function to find the dictionary events are compressed with, before the first bundle is written
+    If none has been trained for the codec yet, one is trained on the bundles waiting in the inbox.
+    :param loader: the BulkLoader owned by the writer, with nothing pending
+    :param file_path: the bundle about to be written, which is still in the inbox
+    :return: the dictionary id, or 0 to compress without one
+    """
+    waiting = [path for path, _ in scan_inbox(os.path.dirname(file_path))]
+    return dataReader.train_payload_dictionary(loader.con, dataReader.EVENT_COMPRESSION, waiting or [file_path])
+
+
+def move_file(file_path, directory):
+    """
+    Function to move a handled file out of the inbox, renaming it if the name is already taken
+    :param file_path: the file to move
+    :param directory: the done or failed folder
+    :return: the new file path
+    """
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, os.path.basename(file_path))
+    if os.path.exists(target):
+        name, extension = os.path.splitext(os.path.basename(file_path))
+        target = os.path.join(directory, name + "_" + str(time.time_ns()) + extension)
+    os.replace(file_path, target)
+    return target
+
+
+async def watch_inbox(inbox, file_queue, poll_interval, stop, once=False):
+    """
+    Coroutine polling the inbox and queueing each new bundle once it has finished being written
+    A file is queued when its size and modification time are the same on two scans in a row. Queueing waits
+    while the queue is full.
+    :param inbox: the directory to watch
+    :param file_queue: the queue of file paths to parse
+    :param poll_interval: seconds between scans
+    :param stop: an Event set when the daemon should stop
+    :param once: True to queue the files already in the inbox and return
+    :return:
+    """
+    # file path to the stat seen on the last scan, or None once it has been queued
+    seen = {}
+    while not stop.is_set():
+        found = scan_inbox(inbox)
+        for file_path, file_stat in found:
+            if file_path in seen and seen[file_path] is None:
+                continue
+            if once or seen.get(file_path) == file_stat:
+                seen[file_path] = None
+                METRICS.count("files_queued")
+                await file_queue.put(file_path)
+            else:
+                seen[file_path] = file_stat
+        # forget files that have left the inbox, so a new file with the same name is picked up
+        current = {file_path for file_path, _ in found}
+        for file_path in [file_path for file_path in seen if file_path not in current]:
+            del seen[file_path]
+        if once:
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def parse_bundles(file_queue, parsed_queue, parse_pool):
+    """
+    Coroutine taking files from the file queue, parsing them on the parse pool and passing them to the writer
+    A None in the file queue stops the coroutine and is passed on to the writer.
+    :param file_queue: the queue of file paths to parse
+    :param parsed_queue: the queue of (file path, parsed bundle or None) for the writer
+    :param parse_pool: the ThreadPoolExecutor bundles are parsed on
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        file_path = await file_queue.get()
+        if file_path is None:
+            await parsed_queue.put(None)
+            return
+        try:
+            parsed = await loop.run_in_executor(parse_pool, parse_bundle, file_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            METRICS.error("parse", e)
+            print("ERROR: " + file_path + " is in the wrong format")
+            parsed = None
+        await parsed_queue.put((file_path, parsed))
+
+
+async def write_bundles(parsed_queue, loader, db_pool, done_dir, failed_dir, parsers):
+    """
+    Coroutine writing parsed bundles on the single database thread and moving each file once it is handled
+    :param parsed_queue: the queue of (file path, parsed bundle or None) from the parsers
+    :param loader: the BulkLoader used to write every bundle
+    :param db_pool: the single thread ThreadPoolExecutor the loader is used on
+    :param done_dir: the folder loaded files are moved to
+    :param failed_dir: the folder files that could not be loaded are moved to
+    :param parsers: the number of parsers, each of which sends a None when it stops
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    while parsers:
+        item = await parsed_queue.get()
+        if item is None:
+            parsers -= 1
+            continue
+        file_path, parsed = item
+        loaded = False
+        if parsed is not None:
+            try:
+                loaded = await loop.run_in_executor(db_pool, write_bundle, loader, *parsed)
+            except Exception as e:
+                # keep the daemon running, the writer is the only consumer of the parsed queue
+                METRICS.error("load_bundle", e)
+                print("ERROR: " + file_path + " could not be loaded: " + str(e))
+
+        try:
+            if loaded:
+                METRICS.observe("arrival_to_commit", max(time.time() - parsed[0][2], 0))
+                print("Loaded " + move_file(file_path, done_dir))
+            else:
+                print("ERROR: Cannot process " + file_path + ", moved to " + move_file(file_path, failed_dir))
+        except OSError as e:
+            METRICS.error("move_file", e)
+            print("ERROR: Could not move " + file_path + ": " + str(e))
+
+
+async def run_daemon(inbox, done_dir=None, failed_dir=None, poll_interval=POLL_INTERVAL, queue_depth=QUEUE_DEPTH,
+                     parse_threads=PARSE_THREADS, batch_size=dataReader.BATCH_SIZE, once=False):
+    """
+    Coroutine running the daemon until SIGINT or SIGTERM, or until the inbox is empty if once is True
+    Bundles already queued when the daemon is stopped are finished before it returns.
+    :param inbox: the directory to watch
+    :param done_dir: the folder loaded files are moved to, by default inbox/done
+    :param failed_dir: the folder files that could not be loaded are moved to, by default inbox/failed
+    :param poll_interval: seconds between scans of the inbox
+    :param queue_depth: the maximum number of bundles waiting to be parsed, and parsed waiting to be written
+    :param parse_threads: the number of threads parsing bundles
+    :param batch_size: the maximum number of rows sent in one executemany
+    :param once: True to load the files already in the inbox and stop
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(stop_signal, stop.set)
+        except NotImplementedError:
+            # not available on Windows, where Ctrl+C stops the daemon without draining
+            pass
+
+    file_queue = asyncio.Queue(queue_depth)
+    parsed_queue = asyncio.Queue(queue_depth)
+    parse_pool = ThreadPoolExecutor(parse_threads, thread_name_prefix="parse")
+    # the connection is only ever used from this one thread
+    db_pool = ThreadPoolExecutor(1, thread_name_prefix="db")
+    loader = await loop.run_in_executor(db_pool, dataReader.BulkLoader, None, batch_size, 1)
+
+    parsers = [asyncio.create_task(parse_bundles(file_queue, parsed_queue, parse_pool)) for _ in range(parse_threads)]
+    writer = asyncio.create_task(write_bundles(parsed_queue, loader, db_pool, done_dir or os.path.join(inbox, "done"),
+                                               failed_dir or os.path.join(inbox, "failed"), parse_threads))
+    print("Watching " + inbox + " for bundles")
+    try:
+        await watch_inbox(inbox, file_queue, poll_interval, stop, once)
+    finally:
+        for _ in parsers:
+            await file_queue.put(None)
+        await asyncio.gather(writer, *parsers)
+        await loop.run_in_executor(db_pool, loader.close)
+        parse_pool.shutdown()
+        db_pool.shutdown()
+    loader.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Watch a directory and load FHIR bundles as they arrive")
+    parser.add_argument("--inbox", default="inbox", help="the directory new bundles are dropped in")
+    parser.add_argument("--done", default=None, help="where loaded files are moved, by default <inbox>/done")
+    parser.add_argument("--failed", default=None,
+                        help="where files that could not be loaded are moved, by default <inbox>/failed")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="seconds between scans")
+    parser.add_argument("--queue-depth", type=int, default=QUEUE_DEPTH,
+                        help="bundles waiting to be parsed, and parsed bundles waiting to be written")
+    parser.add_argument("--parse-threads", type=int, default=PARSE_THREADS)
+    parser.add_argument("--backend", choices=BACKENDS, default=dataReader.STORAGE_BACKEND,
+                        help="database the patient tables are kept in")
+    parser.add_argument("--database-path", default=dataReader.DB_PATH,
+                        help="database file for the sqlite and duckdb backends")
+    parser.add_argument("--batch-size", type=int, default=dataReader.BATCH_SIZE,
+                        help="maximum rows sent to the database in one batch")
+    parser.add_argument("--once", action="store_true", help="load the files already in the inbox and exit")
+    parser.add_argument("--compress-events", choices=("none",) + tuple(payloadCodec.available_codecs()),
+                        default=dataReader.EVENT_COMPRESSION,
+                        help="store new events compressed with a dictionary trained on the first bundles in the "
+                             "inbox, rather than as JSON text")
+    parser.add_argument("--metrics-format", choices=("json", "prometheus"), default=None,
+                        help="dump timers, counters and errors in this format when the daemon stops")
+    parser.add_argument("--metrics-file", default=None, help="file the metrics are written to instead of stdout")
+    args = parser.parse_args()
+
+    dataReader.STORAGE_BACKEND = args.backend
+    dataReader.DB_PATH = args.database_path
+    dataReader.EVENT_COMPRESSION = args.compress_events
+    os.makedirs(args.inbox, exist_ok=True)
+    if dataReader.init_database():
+        asyncio.run(run_daemon(args.inbox, args.done, args.failed, args.poll_interval, args.queue_depth,
+                               args.parse_threads, args.batch_size, args.once))
+        if args.metrics_format:
+            METRICS.dump(args.metrics_format, args.metrics_file)
@@ -0,0 +1,77 @@
+import json
+import os
+
+'''
+JSON encoding and decoding for the pipeline.
+orjson is used when it is installed, otherwise the standard library json module. Both encode to compact text
+(no spaces, UTF-8 rather than \\u escapes) and decode each other's text to the same values, apart from integers
+beyond 64 bits, which orjson reads as floats. The text is not always identical, floats with an exponent are
+written 1e16 by orjson and 1e+16 by json, so a content hash made with one codec is checked against the
+encodings of every codec, see encodings.
+Set PATIENT_JSON_CODEC=json to use the standard library even when orjson is installed. Call loads and
+dumps through the module, e.g. jsonCodec.dumps(resource), so use_codec can switch codec at run time.
+'''
+
+CODECS = ("orjson", "json")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC = None
+loads = None
+dumps = None
+
+
+def _orjson_dumps(value):
+    """
+    :param value: the value to encode
+    :return: the compact JSON text
+    """
+    return orjson.dumps(value).decode("utf-8")
+
+
+def _json_dumps(value):
+    """
+    :param value: the value to encode
+    :return: the compact JSON text, in the same form as orjson produces
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+# the encoder of each codec
+_DUMPS = {"orjson": _orjson_dumps, "json": _json_dumps}
+
+
+def encodings(value):
+    """
+    :param value: the value to encode
+    :return: the set of texts the available codecs encode the value to
+    """
+    return {_DUMPS[name](value) for name in available_codecs()}
+
+
+def available_codecs():
+    """
+    :return: the codecs that can be used in this environment, fastest first
+    """
+    return [name for name in CODECS if name != "orjson" or orjson is not None]
+
+
+def use_codec(name):
+    """
+    Function to switch the codec used by loads and dumps
+    :param name: one of CODECS
+    :return:
+    """
+    global CODEC, loads, dumps
+    if name not in available_codecs():
+        raise ValueError("JSON codec " + name + " is not available, expected one of " +
+                         ", ".join(available_codecs()))
+    loads = orjson.loads if name == "orjson" else json.loads
+    dumps = _DUMPS[name]
+    CODEC = name
+
+
+use_codec(os.environ.get("PATIENT_JSON_CODEC") or available_codecs()[0])
@@ -0,0 +1,215 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+'''
+Timers and counters for the ingestion pipeline.
+Stages record how long they take and how often they run against a registry, by default the module level
+METRICS. Errors are counted by stage and exception type. A registry can be copied to a plain dictionary
+so worker processes can send theirs back to be merged, and dumped as JSON or Prometheus text. Updates are
+made under a lock so stages running on threads can share a registry.
+'''
+
+METRIC_PREFIX = "fhir_pipeline"
+
+
+class Metrics:
+    """
+    A registry of stage timers, counters and error counts
+    """
+
+    def __init__(self):
+        self.progress_interval = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear everything recorded so far, e.g. in a newly forked worker process
+        :return:
+        """
+        # stage name to [calls, total seconds, longest call in seconds]
+        self.timers = {}
+        self.counters = {}
+        # "stage:ExceptionType" to count
+        self.errors = {}
+        self.started = time.time()
+        self.last_progress = time.perf_counter()
+
+    def observe(self, name, seconds, calls=1):
+        """
+        Record time spent in a stage
+        :param name: the stage name
+        :param seconds: the time taken
+        :param calls: the number of calls the time covers
+        :return:
+        """
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [calls, seconds, seconds]
+            else:
+                timer[0] += calls
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Context manager timing the code it wraps as a stage
+        :param name: the stage name
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function as a stage
+        :param name: the stage name
+        :return: the decorator
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, name, iterator):
+        """
+        Generator timing how long each item of an iterator takes to produce, e.g. parsing bundle entries
+        :param name: the stage name
+        :param iterator: the iterator to wrap
+        :return: the iterator's items
+        """
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter
+        :param name: the counter name
+        :param amount: the amount to add
+        :return:
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def error(self, stage, exception):
+        """
+        Count an error raised in a stage by its exception type
+        :param stage: the stage the error happened in
+        :param exception: the exception raised
+        :return:
+        """
+        key = stage + ":" + type(exception).__name__
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def progress(self, done, total, force=False):
+        """
+        Print a progress and throughput line if progress_interval seconds have passed since the last one
+        :param done: the number of files finished
+        :param total: the number of files in the run
+        :param force: True to print regardless of the interval
+        :return:
+        """
+        now = time.perf_counter()
+        if not force and (not self.progress_interval or now - self.last_progress < self.progress_interval):
+            return
+        self.last_progress = now
+        elapsed = time.time() - self.started
+        print("Progress: {}/{} files, {:.1f} files/sec, {:.0f} rows/sec, {} errors".format(
+            done, total, done / elapsed if elapsed else 0, self.counters.get("rows", 0) / elapsed if elapsed else 0,
+            sum(self.errors.values())))
+
+    def snapshot(self):
+        """
+        Copy the registry to a dictionary that can be pickled or written as JSON
+        :return: the timers, counters and errors
+        """
+        return {"timers": {name: {"calls": calls, "seconds": seconds, "max_seconds": longest}
+                           for name, (calls, seconds, longest) in self.timers.items()},
+                "counters": dict(self.counters),
+                "errors": dict(self.errors)}
+
+    def merge(self, snapshot):
+        """
+        Add the contents of a snapshot, e.g. from a worker process, to this registry
+        :param snapshot: a dictionary made by snapshot()
+        :return:
+        """
+        for name, timer in snapshot["timers"].items():
+            self.observe(name, timer["seconds"], timer["calls"])
+            self.timers[name][2] = max(self.timers[name][2], timer["max_seconds"])
+        for name, amount in snapshot["counters"].items():
+            self.count(name, amount)
+        with self.lock:
+            for key, amount in snapshot["errors"].items():
+                self.errors[key] = self.errors.get(key, 0) + amount
+
+    def to_json(self):
+        """
+        :return: the registry as JSON text
+        """
+        data = self.snapshot()
+        data["elapsed_seconds"] = time.time() - self.started
+        return json.dumps(data, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        :return: the registry in the Prometheus text exposition format
+        """
+        lines = ["# TYPE " + METRIC_PREFIX + "_stage_calls_total counter",
+                 "# TYPE " + METRIC_PREFIX + "_stage_seconds_total counter",
+                 "# TYPE " + METRIC_PREFIX + "_stage_max_seconds gauge"]
+        for name, (calls, seconds, longest) in sorted(self.timers.items()):
+            label = '{stage="' + name + '"}'
+            lines.append(METRIC_PREFIX + "_stage_calls_total" + label + " " + str(calls))
+            lines.append(METRIC_PREFIX + "_stage_seconds_total" + label + " " + repr(seconds))
+            lines.append(METRIC_PREFIX + "_stage_max_seconds" + label + " " + repr(longest))
+        lines.append("# TYPE " + METRIC_PREFIX + "_count_total counter")
+        for name, amount in sorted(self.counters.items()):
+            lines.append(METRIC_PREFIX + '_count_total{name="' + name + '"} ' + str(amount))
+        lines.append("# TYPE " + METRIC_PREFIX + "_errors_total counter")
+        for key, amount in sorted(self.errors.items()):
+            stage, error_type = key.split(":", 1)
+            lines.append(METRIC_PREFIX + '_errors_total{stage="' + stage + '",type="' + error_type + '"} ' +
+                         str(amount))
+        lines.append(METRIC_PREFIX + "_elapsed_seconds " + repr(time.time() - self.started))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, output_format="json", file_path=None):
+        """
+        Write the registry as JSON or Prometheus text
+        :param output_format: "json" or "prometheus"
+        :param file_path: the file to write to, or None to print
+        :return:
+        """
+        text = self.to_prometheus() if output_format == "prometheus" else self.to_json() + "\n"
+        if file_path:
+            with open(file_path, 'w') as file:
+                file.write(text)
+        else:
+            print(text, end="")
+
+
+METRICS = Metrics()
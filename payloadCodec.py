@@ -0,0 +1,207 @@
+import re
+import struct
+import zlib
+
+'''
+Compression of the stored event payloads.
+A compressed payload is a five byte header followed by the compressed resource text. The header is one byte
+naming the codec and the four byte big endian id of the dictionary it was compressed with, 0 for none, so
+every payload can be decompressed on its own whatever mode later rows are written in.
+
+FHIR resources repeat the same keys, code systems and profile URLs, and most are only a few hundred bytes, too
+short for a compressor to learn much from the resource itself. A dictionary trained on sample resources gives
+the compressor that shared text up front. zstd is used when the zstandard package is installed, zlib always
+works and takes a preset dictionary of up to 32KB. Dictionaries are registered by id with add_dictionary
+before payloads that use them are compressed or decompressed.
+'''
+
+CODECS = ("zlib", "zstd")
+# the header byte of each codec
+CODEC_TAGS = {"zlib": 1, "zstd": 2}
+_CODEC_OF_TAG = {tag: codec for codec, tag in CODEC_TAGS.items()}
+HEADER = struct.Struct(">BI")
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ZSTD_DICTIONARY_SIZE = 64 * 1024
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# dictionary id to (codec, dictionary bytes)
+_dictionaries = {}
+# (codec, dictionary id) to the compressor and decompressor, which zstd keeps the digested dictionary in
+_compressors = {}
+_decompressors = {}
+
+# the pieces of JSON a zlib dictionary is built from: a key with its value, or a key, up to a delimiter
+_fragment = re.compile(r'"[^"\\]{1,64}":(?:"[^"\\]{0,200}"|[^,{}\[\]"]{1,32})?|[{}\[\],]')
+
+
+def available_codecs():
+    """
+    :return: the codecs that can be used in this environment
+    """
+    return [name for name in CODECS if name != "zstd" or zstandard is not None]
+
+
+def check_codec(name):
+    """
+    :param name: one of CODECS
+    :return:
+    """
+    if name not in available_codecs():
+        raise ValueError("Payload codec " + name + " is not available, expected one of " +
+                         ", ".join(available_codecs()))
+
+
+def add_dictionary(dictionary_id, codec, dictionary):
+    """
+    Function to register a stored dictionary so payloads compressed with it can be read
+    :param dictionary_id: the payload_dictionary id
+    :param codec: the codec it was trained for
+    :param dictionary: the dictionary bytes
+    :return:
+    """
+    _dictionaries[dictionary_id] = (codec, bytes(dictionary))
+
+
+def has_dictionary(dictionary_id):
+    """
+    :param dictionary_id: a payload_dictionary id
+    :return: True if it has been registered, 0 for no dictionary always is
+    """
+    return not dictionary_id or dictionary_id in _dictionaries
+
+
+def get_dictionary(dictionary_id):
+    """
+    :param dictionary_id: a registered payload_dictionary id
+    :return: the dictionary bytes
+    """
+    return _dictionaries[dictionary_id][1]
+
+
+def train_zlib_dictionary(samples, size=ZLIB_DICTIONARY_SIZE):
+    """
+    Function to build a zlib preset dictionary from the fragments of JSON that repeat most across the samples
+    zlib finds matches closer to the data more cheaply, so the most valuable fragments go at the end.
+    :param samples: a list of serialised resources
+    :param size: the largest dictionary to build, zlib uses at most 32KB
+    :return: the dictionary bytes
+    """
+    counts = {}
+    for sample in samples:
+        # a fragment is only counted once per resource, so one long list does not crowd out what every
+        # resource shares
+        for fragment in set(_fragment.findall(sample)):
+            if len(fragment) > 3:
+                counts[fragment] = counts.get(fragment, 0) + 1
+    ranked = sorted((count * len(fragment), fragment) for fragment, count in counts.items() if count > 1)
+    chosen = []
+    used = 0
+    for _, fragment in reversed(ranked):
+        encoded = fragment.encode("utf-8")
+        if used + len(encoded) > size:
+            break
+        chosen.append(encoded)
+        used += len(encoded)
+    return b"".join(reversed(chosen))
+
+
+def train_dictionary(codec, samples):
+    """
+    Function to train a dictionary for a codec on sample resources
+    :param codec: one of CODECS
+    :param samples: a list of serialised resources
+    :return: the dictionary bytes, or None if there are too few samples to train on
+    """
+    check_codec(codec)
+    if codec == "zstd":
+        try:
+            return zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, [sample.encode("utf-8") for sample in samples],
+                                              level=ZSTD_LEVEL).as_bytes()
+        except zstandard.ZstdError:
+            return None
+    return train_zlib_dictionary(samples) or None
+
+
+def _compressor(codec, dictionary_id):
+    """
+    :return: a function compressing bytes with the codec and dictionary
+    """
+    key = (codec, dictionary_id)
+    if key not in _compressors:
+        dictionary = _dictionaries[dictionary_id][1] if dictionary_id else None
+        if codec == "zstd":
+            _compressors[key] = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL, dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None).compress
+        elif dictionary:
+            # a compressobj can only be used once, copying one that has been given the dictionary is cheap
+            template = zlib.compressobj(ZLIB_LEVEL, zdict=dictionary)
+            _compressors[key] = lambda data: _zlib_compress(template.copy(), data)
+        else:
+            _compressors[key] = lambda data: zlib.compress(data, ZLIB_LEVEL)
+    return _compressors[key]
+
+
+def _zlib_compress(compressobj, data):
+    """
+    :return: data compressed with a fresh compressobj
+    """
+    return compressobj.compress(data) + compressobj.flush()
+
+
+def _decompressor(codec, dictionary_id):
+    """
+    :return: a function decompressing bytes compressed with the codec and dictionary
+    """
+    key = (codec, dictionary_id)
+    if key not in _decompressors:
+        if not has_dictionary(dictionary_id):
+            raise KeyError("Payload dictionary " + str(dictionary_id) + " has not been loaded")
+        dictionary = _dictionaries[dictionary_id][1] if dictionary_id else None
+        if codec == "zstd":
+            if zstandard is None:
+                raise ValueError("zstandard is required to read payloads compressed with zstd")
+            _decompressors[key] = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None).decompress
+        elif dictionary:
+            _decompressors[key] = lambda data: _zlib_decompress(zlib.decompressobj(zdict=dictionary), data)
+        else:
+            _decompressors[key] = zlib.decompress
+    return _decompressors[key]
+
+
+def _zlib_decompress(decompressobj, data):
+    """
+    :return: data decompressed with a fresh decompressobj
+    """
+    return decompressobj.decompress(data) + decompressobj.flush()
+
+
+def compress(text, codec, dictionary_id=0):
+    """
+    Function to compress a serialised resource for storage
+    :param text: the resource's JSON text
+    :param codec: one of CODECS
+    :param dictionary_id: the id of a registered dictionary for the codec, or 0 for none
+    :return: the payload bytes, header included
+    """
+    return HEADER.pack(CODEC_TAGS[codec], dictionary_id) + _compressor(codec, dictionary_id)(text.encode("utf-8"))
+
+
+def decompress(payload):
+    """
+    Function to read a compressed payload back into the resource's JSON text
+    :param payload: the stored bytes, header included
+    :return: the JSON text
+    """
+    payload = bytes(payload)
+    tag, dictionary_id = HEADER.unpack_from(payload)
+    if tag not in _CODEC_OF_TAG:
+        raise ValueError("Unknown payload codec " + str(tag))
+    return _decompressor(_CODEC_OF_TAG[tag], dictionary_id)(payload[HEADER.size:]).decode("utf-8")
+
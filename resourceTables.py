@@ -0,0 +1,252 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from flattenSpec import Extractor
+from metrics import METRICS
+
+'''
+Typed tables for the most common FHIR resource types.
+Each resource type has a table with one column per commonly queried field, and a flattening spec (see
+flattenSpec) listing where each column is found in the resource. The patient column is added by the loader so
+the specs only deal with the resource itself. Dates are stored as UTC DATETIMEs so they can be indexed and
+compared. The spec for the patient table itself is kept here as well.
+'''
+
+CREATE_TABLES = [
+    "CREATE TABLE IF NOT EXISTS patient_encounter (patient_encounter_id INT NOT NULL AUTO_INCREMENT, patient INT, "
+    "resource_id VARCHAR(64), status VARCHAR(32), class_code VARCHAR(32), type_code VARCHAR(64), "
+    "type_display VARCHAR(255), reason_code VARCHAR(64), reason_display VARCHAR(255), start_datetime DATETIME, "
+    "end_datetime DATETIME, service_provider VARCHAR(255), PRIMARY KEY(patient_encounter_id), "
+    "INDEX (resource_id), INDEX (type_code), INDEX (start_datetime), "
+    "FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS patient_observation (patient_observation_id INT NOT NULL AUTO_INCREMENT, "
+    "patient INT, resource_id VARCHAR(64), encounter_id VARCHAR(64), status VARCHAR(32), category VARCHAR(64), "
+    "panel_code VARCHAR(64), code VARCHAR(64), display VARCHAR(255), value_numeric DOUBLE, "
+    "value_text VARCHAR(255), unit VARCHAR(64), effective_datetime DATETIME, issued DATETIME, "
+    "PRIMARY KEY(patient_observation_id), INDEX (resource_id), INDEX (encounter_id), "
+    "INDEX (code, effective_datetime), INDEX (effective_datetime), "
+    "FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS patient_condition (patient_condition_id INT NOT NULL AUTO_INCREMENT, patient INT, "
+    "resource_id VARCHAR(64), encounter_id VARCHAR(64), clinical_status VARCHAR(32), "
+    "verification_status VARCHAR(32), category VARCHAR(64), code VARCHAR(64), display VARCHAR(255), "
+    "onset_datetime DATETIME, abatement_datetime DATETIME, recorded_date DATETIME, "
+    "PRIMARY KEY(patient_condition_id), INDEX (resource_id), INDEX (encounter_id), INDEX (code), "
+    "INDEX (onset_datetime), FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS patient_procedure (patient_procedure_id INT NOT NULL AUTO_INCREMENT, patient INT, "
+    "resource_id VARCHAR(64), encounter_id VARCHAR(64), status VARCHAR(32), code VARCHAR(64), "
+    "display VARCHAR(255), start_datetime DATETIME, end_datetime DATETIME, PRIMARY KEY(patient_procedure_id), "
+    "INDEX (resource_id), INDEX (encounter_id), INDEX (code), INDEX (start_datetime), "
+    "FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS patient_diagnostic_report (patient_diagnostic_report_id INT NOT NULL "
+    "AUTO_INCREMENT, patient INT, resource_id VARCHAR(64), encounter_id VARCHAR(64), status VARCHAR(32), "
+    "category VARCHAR(64), code VARCHAR(64), display VARCHAR(255), effective_datetime DATETIME, issued DATETIME, "
+    "PRIMARY KEY(patient_diagnostic_report_id), INDEX (resource_id), INDEX (encounter_id), INDEX (code), "
+    "INDEX (effective_datetime), FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS patient_claim (patient_claim_id INT NOT NULL AUTO_INCREMENT, patient INT, "
+    "resource_id VARCHAR(64), encounter_id VARCHAR(64), status VARCHAR(32), claim_type VARCHAR(64), "
+    "claim_use VARCHAR(32), start_datetime DATETIME, end_datetime DATETIME, created DATETIME, "
+    "provider VARCHAR(255), item_count INT, total_value DECIMAL(12,2), currency VARCHAR(8), "
+    "PRIMARY KEY(patient_claim_id), INDEX (resource_id), INDEX (encounter_id), INDEX (start_datetime), "
+    "FOREIGN KEY (patient) REFERENCES patient(patient_id))"
+]
+
+
+# a FHIR date, dateTime or instant: YYYY, YYYY-MM, YYYY-MM-DD or a date and time with optional seconds,
+# fraction of a second of any length and time zone
+_fhir_datetime = re.compile(r'(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?'
+                            r'(Z|[+-]\d{2}:\d{2})?)?)?)?$')
+
+
+def fhir_datetime(value):
+    """
+    Function to convert a FHIR date or dateTime string into a naive UTC datetime
+    Partial dates are stored as the start of the year or month they give. Values that still cannot be read
+    are counted as unparsed_datetimes and stored as None, so one bad date does not reject the bundle.
+    :param value: the FHIR date/dateTime, may be None
+    :return: a datetime, or None if there is no value or it cannot be read
+    """
+    if not value:
+        return None
+    match = _fhir_datetime.match(value) if isinstance(value, str) else None
+    if match is None:
+        METRICS.count("unparsed_datetimes")
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        parsed = datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                          int(second or 0), int((fraction or "0")[:6].ljust(6, "0")))
+    except ValueError:
+        METRICS.count("unparsed_datetimes")
+        return None
+    if zone is not None and zone != "Z":
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[4:6]))
+        parsed = parsed.replace(tzinfo=timezone(offset if zone[0] == "+" else -offset))
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def reference_id(reference):
+    """
+    Function to get the id of a referenced resource from a FHIR Reference
+    :param reference: the Reference element, e.g. {"reference": "urn:uuid:..."}
+    :return: the referenced id or None
+    """
+    if not reference or "reference" not in reference:
+        return None
+    return reference["reference"].split(":")[-1].split("/")[-1]
+
+
+def spec_columns(spec):
+    """
+    :param spec: a flattening spec for one of the typed tables
+    :return: the table's columns in insert order, starting with patient
+    """
+    return ("patient",) + tuple(field[0] for field in spec["fields"])
+
+
+ENCOUNTER_SPEC = {
+    "table": "patient_encounter",
+    "fields": (("resource_id", "id"),
+               ("status", "status"),
+               ("class_code", "class.code"),
+               ("type_code", "type[0].coding[0].code"),
+               ("type_display", "type[0].coding[0].display|type[0].text"),
+               ("reason_code", "reasonCode[0].coding[0].code"),
+               ("reason_display", "reasonCode[0].coding[0].display|reasonCode[0].text"),
+               ("start_datetime", "period.start", fhir_datetime),
+               ("end_datetime", "period.end", fhir_datetime),
+               ("service_provider", "serviceProvider.display"))
+}
+
+# Observations with components (e.g. blood pressure) give one row per component, with the code of the
+# Observation itself recorded as the panel_code
+OBSERVATION_SPEC = {
+    "table": "patient_observation",
+    "each": "component",
+    "fields": (("resource_id", "id"),
+               ("encounter_id", "encounter", reference_id),
+               ("status", "status"),
+               ("category", "category[0].coding[0].code"),
+               ("panel_code", "^code.coding[0].code"),
+               ("code", "@code.coding[0].code"),
+               ("display", "@code.coding[0].display|@code.text"),
+               ("value_numeric", "@valueQuantity.value|@valueInteger"),
+               ("value_text", "@valueCodeableConcept.coding[0].display|@valueCodeableConcept.text|"
+                              "@valueCodeableConcept.coding[0].code|@valueString|@valueBoolean|@valueDateTime", str),
+               ("unit", "@valueQuantity.unit"),
+               ("effective_datetime", "effectiveDateTime|effectivePeriod.start", fhir_datetime),
+               ("issued", "issued", fhir_datetime))
+}
+
+CONDITION_SPEC = {
+    "table": "patient_condition",
+    "fields": (("resource_id", "id"),
+               ("encounter_id", "encounter", reference_id),
+               ("clinical_status", "clinicalStatus.coding[0].code"),
+               ("verification_status", "verificationStatus.coding[0].code"),
+               ("category", "category[0].coding[0].code"),
+               ("code", "code.coding[0].code"),
+               ("display", "code.coding[0].display|code.text"),
+               ("onset_datetime", "onsetDateTime", fhir_datetime),
+               ("abatement_datetime", "abatementDateTime", fhir_datetime),
+               ("recorded_date", "recordedDate", fhir_datetime))
+}
+
+PROCEDURE_SPEC = {
+    "table": "patient_procedure",
+    "fields": (("resource_id", "id"),
+               ("encounter_id", "encounter", reference_id),
+               ("status", "status"),
+               ("code", "code.coding[0].code"),
+               ("display", "code.coding[0].display|code.text"),
+               ("start_datetime", "performedDateTime|performedPeriod.start", fhir_datetime),
+               ("end_datetime", "performedPeriod.end|performedDateTime|performedPeriod.start", fhir_datetime))
+}
+
+DIAGNOSTIC_REPORT_SPEC = {
+    "table": "patient_diagnostic_report",
+    "fields": (("resource_id", "id"),
+               ("encounter_id", "encounter", reference_id),
+               ("status", "status"),
+               ("category", "category[0].coding[0].code"),
+               ("code", "code.coding[0].code"),
+               ("display", "code.coding[0].display|code.text"),
+               ("effective_datetime", "effectiveDateTime", fhir_datetime),
+               ("issued", "issued", fhir_datetime))
+}
+
+# the encounter is taken from the first item that references one
+CLAIM_SPEC = {
+    "table": "patient_claim",
+    "fields": (("resource_id", "id"),
+               ("encounter_id", "item[?encounter].encounter[0]", reference_id),
+               ("status", "status"),
+               ("claim_type", "type.coding[0].code"),
+               ("claim_use", "use"),
+               ("start_datetime", "billablePeriod.start", fhir_datetime),
+               ("end_datetime", "billablePeriod.end", fhir_datetime),
+               ("created", "created", fhir_datetime),
+               ("provider", "provider.display"),
+               ("item_count", "item", len, 0),
+               ("total_value", "total.value"),
+               ("currency", "total.currency"))
+}
+
+# the fields common to most resource types, for types without a typed table
+GENERIC_EVENT_SPEC = {
+    "fields": (("resource_id", "id"),
+               ("status", "status"),
+               ("code", "code.coding[0].code|type[0].coding[0].code"),
+               ("display", "code.coding[0].display|code.text|type[0].coding[0].display|type[0].text"))
+}
+
+# extensions are found by their url so the order they are sent in does not matter
+PATIENT_SPEC = {
+    "table": "patient",
+    "fields": (("unique_id", "id"),
+               ("given_name", "name[0].given", " ".join),
+               ("family_name", "name[0].family", str),
+               ("birth_date", "birthDate"),
+               ("birth_sex", "extension(us-core-birthsex).valueCode"),
+               ("gender", "gender"),
+               ("mother", "extension(patient-mothersMaidenName).valueString", str),
+               ("marital_status", "maritalStatus.text"),
+               ("name_use", "name[0].use"),
+               ("address_line", "address[0].line[0]", str),
+               ("address_city", "address[0].city", str),
+               ("address_state", "address[0].state", str),
+               ("address_country", "address[0].country", str),
+               ("address_latitude", "address[0].extension(geolocation).extension(latitude).valueDecimal"),
+               ("address_longitude", "address[0].extension(geolocation).extension(longitude).valueDecimal"),
+               ("birth_city", "extension(patient-birthPlace).valueAddress.city", str),
+               ("birth_state", "extension(patient-birthPlace).valueAddress.state", str),
+               ("birth_country", "extension(patient-birthPlace).valueAddress.country", str),
+               ("us_core_ethnicity", "extension(us-core-ethnicity).extension(ombCategory).valueCoding.display"),
+               ("us_core_race", "extension(us-core-race).extension(ombCategory).valueCoding.display"),
+               ("prefix", "name[0].prefix[0]", None, ""),
+               ("death_dateTime", "deceasedDateTime", None, "n/a"),
+               ("multiple_birth", "multipleBirthBoolean", str, ""),
+               ("disability_adjusted_life_years", "extension(disability-adjusted-life-years).valueDecimal"),
+               ("quality_adjusted_life_years", "extension(quality-adjusted-life-years).valueDecimal"))
+}
+
+RESOURCE_SPECS = {
+    "Encounter": ENCOUNTER_SPEC,
+    "Observation": OBSERVATION_SPEC,
+    "Condition": CONDITION_SPEC,
+    "Procedure": PROCEDURE_SPEC,
+    "DiagnosticReport": DIAGNOSTIC_REPORT_SPEC,
+    "Claim": CLAIM_SPEC
+}
+
+RESOURCE_TABLE_COLUMNS = {spec["table"]: spec_columns(spec) for spec in RESOURCE_SPECS.values()}
+
+# resource type to the table it is flattened into and the compiled extractor that does it
+RESOURCE_TABLES = {resource_type: (spec["table"], Extractor(spec)) for resource_type, spec in RESOURCE_SPECS.items()}
+PATIENT_EXTRACTOR = Extractor(PATIENT_SPEC)
+GENERIC_EVENT_EXTRACTOR = Extractor(GENERIC_EVENT_SPEC)
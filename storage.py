@@ -0,0 +1,625 @@
+import os
+import re
+
+from metrics import METRICS
+
+'''
+Storage backends for the patient database.
+The pipeline writes its SQL for MySQL, with %s placeholders and MySQL table definitions. A backend connects
+to its database and covers everything that differs between databases: placeholders, turning the MySQL
+CREATE TABLE statements into its own dialect, catalog lookups, inserted ids, upserts, savepoints and named
+locks.
+MySQL is the database used in production. SQLite and DuckDB keep the whole database in a local file, so
+the pipeline can run and be benchmarked without a database server, and DuckDB gives the analysts a
+columnar copy of the flattened tables to aggregate over.
+'''
+
+BACKENDS = ("mysql", "sqlite", "duckdb")
+
+_create_table = re.compile(r"CREATE TABLE (IF NOT EXISTS )?(\w+) \((.*)\)$", re.DOTALL)
+_index = re.compile(r"(UNIQUE )?INDEX\s*(\w+)?\s*\((.+)\)$")
+_primary_key = re.compile(r"PRIMARY KEY\s*\((\w+)\)$")
+
+
+def split_definitions(body):
+    """
+    Function to split the body of a CREATE TABLE statement on the commas between definitions
+    :param body: the text between the outer brackets
+    :return: a list of column and constraint definitions
+    """
+    definitions = []
+    depth = 0
+    start = 0
+    for position, character in enumerate(body):
+        if character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "," and depth == 0:
+            definitions.append(body[start:position].strip())
+            start = position + 1
+    definitions.append(body[start:].strip())
+    return definitions
+
+
+class QmarkCursor:
+    """
+    Cursor wrapper for drivers that use ? placeholders, so the pipeline's %s queries run unchanged
+    """
+
+    def __init__(self, cursor, owned=True):
+        self.cursor = cursor
+        self.owned = owned
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace("%s", "?"), params)
+        return self
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(query.replace("%s", "?"), rows)
+        return self
+
+    def close(self):
+        if self.owned:
+            self.cursor.close()
+
+    def __iter__(self):
+        return iter(self.cursor.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class StorageBackend:
+    """
+    The interface every backend implements, with the defaults shared by the file based backends
+    """
+
+    name = None
+    # whether several processes can load into the database at the same time
+    parallel_load = True
+    # whether several processes can read the database for an export at the same time
+    parallel_export = True
+    # whether a bundle can be rolled back on its own with a savepoint
+    savepoints = True
+    # MySQL types replaced when a table is created, as regular expression to replacement
+    column_types = {}
+    keep_foreign_keys = True
+
+    def __init__(self, database, config=None, pool_size=1, path=None):
+        self.database = database
+        self.config = config or {}
+        self.pool_size = pool_size
+        self.path = path
+
+    @property
+    def Error(self):
+        """
+        :return: the driver's base exception class
+        """
+        raise NotImplementedError
+
+    @property
+    def IntegrityError(self):
+        """
+        :return: the exception the driver raises when a unique index is violated
+        """
+        raise NotImplementedError
+
+    def connect(self):
+        """
+        Connect to the patient database
+        :return: a connection, or False if the connection fails
+        """
+        raise NotImplementedError
+
+    def create_database(self):
+        """
+        Create the empty patient database
+        :return: True if created, False if the server cannot be reached
+        """
+        return True
+
+    def drop_database(self):
+        """
+        Remove the patient database and everything in it
+        :return:
+        """
+        raise NotImplementedError
+
+    def table_exists(self, db_cursor, table):
+        """
+        :param db_cursor: a cursor on the patient database
+        :param table: the table name
+        :return: True if the table exists
+        """
+        raise NotImplementedError
+
+    def column_exists(self, db_cursor, table, column):
+        """
+        :param db_cursor: a cursor on the patient database
+        :param table: the table name
+        :param column: the column name
+        :return: True if the table has the column
+        """
+        raise NotImplementedError
+
+    def index_exists(self, db_cursor, table, index):
+        """
+        :param db_cursor: a cursor on the patient database
+        :param table: the table name
+        :param index: the index name as given in the MySQL table definition
+        :return: True if the table has the index
+        """
+        raise NotImplementedError
+
+    def index_name(self, table, index):
+        """
+        Index names are per table in MySQL but per database elsewhere, so they are prefixed with the table
+        :param table: the table name
+        :param index: the index name as given in the MySQL table definition
+        :return: the name the index has in this database
+        """
+        return table + "_" + index
+
+    def column_definition(self, definition):
+        """
+        :param definition: a MySQL column type and options
+        :return: the definition in this database's dialect
+        """
+        for mysql_type, replacement in self.column_types.items():
+            definition = re.sub(mysql_type, replacement, definition)
+        return definition
+
+    def create_index_sql(self, table, index, columns, unique=False):
+        """
+        :param table: the table to index
+        :param index: the index name as given in the MySQL table definition
+        :param columns: the indexed columns, comma separated
+        :param unique: True for a UNIQUE index
+        :return: the CREATE INDEX statement
+        """
+        return "CREATE " + ("UNIQUE " if unique else "") + "INDEX IF NOT EXISTS " + \
+               self.index_name(table, index) + " ON " + table + " (" + columns + ")"
+
+    def auto_increment_column(self, table, column):
+        """
+        :param table: the table name
+        :param column: the name of the MySQL AUTO_INCREMENT primary key
+        :return: the statements needed before the table and the column definition
+        """
+        return [], column + " INTEGER PRIMARY KEY"
+
+    def create_table(self, db_cursor, statement):
+        """
+        Create a table from its MySQL CREATE TABLE statement
+        Indexes are created as separate statements, AUTO_INCREMENT keys become this database's equivalent
+        and column types are translated with column_types.
+        :param db_cursor: a cursor on the patient database
+        :param statement: the MySQL CREATE TABLE statement
+        :return:
+        """
+        if_not_exists, table, body = _create_table.match(statement).groups()
+        before = []
+        columns = []
+        after = []
+        auto_column = None
+        for definition in split_definitions(body):
+            index = _index.match(definition)
+            primary_key = _primary_key.match(definition)
+            if index:
+                unique, index_name, index_columns = index.groups()
+                index_name = index_name or index_columns.split(",")[0].strip()
+                after.append(self.create_index_sql(table, index_name, index_columns, bool(unique)))
+            elif primary_key:
+                if primary_key.group(1) != auto_column:
+                    columns.append(definition)
+            elif definition.startswith("FOREIGN KEY"):
+                if self.keep_foreign_keys:
+                    columns.append(definition)
+            elif "AUTO_INCREMENT" in definition:
+                auto_column = definition.split()[0]
+                statements, column = self.auto_increment_column(table, auto_column)
+                before.extend(statements)
+                columns.append(column)
+            else:
+                column, column_type = definition.split(" ", 1)
+                columns.append(column + " " + self.column_definition(column_type))
+        for sql in before + ["CREATE TABLE " + (if_not_exists or "") + table + " (" + ", ".join(columns) + ")"] + \
+                after:
+            db_cursor.execute(sql)
+
+    def insert(self, db_cursor, sql, row, id_column):
+        """
+        Run an INSERT of a single row
+        :param db_cursor: a cursor on the patient database
+        :param sql: the INSERT statement
+        :param row: the values
+        :param id_column: the table's generated primary key
+        :return: the id of the new row
+        """
+        db_cursor.execute(sql, row)
+        return db_cursor.lastrowid
+
+    def add_to_row_sql(self, table, key_columns, columns, added_columns, decimal_places=None):
+        """
+        Build an INSERT that, when a row with the same key already exists, adds to its counts instead
+        :param table: the table, which must have a primary key or unique index on key_columns
+        :param key_columns: the key columns
+        :param columns: columns only set when the row is new
+        :param added_columns: columns added to the existing row's values
+        :param decimal_places: {column: places} for DECIMAL added columns, whose sums are rounded to the column's
+        places. SQLite stores DECIMAL as a floating point number, so the sum of many additions would otherwise
+        drift from the value a single insert stores.
+        :return: the statement, taking the key, columns and added columns in that order
+        """
+        decimal_places = decimal_places or {}
+        names = tuple(key_columns) + tuple(columns) + tuple(added_columns)
+        sums = []
+        for column in added_columns:
+            total = table + "." + column + " + excluded." + column
+            if column in decimal_places:
+                total = "ROUND(" + total + ", " + str(decimal_places[column]) + ")"
+            sums.append(column + " = " + total)
+        return "INSERT INTO " + table + " (" + ", ".join(names) + ") VALUES (" + ", ".join(["%s"] * len(names)) + \
+            ") ON CONFLICT (" + ", ".join(key_columns) + ") DO UPDATE SET " + ", ".join(sums)
+
+    def locking_read_sql(self, query):
+        """
+        :param query: a SELECT statement
+        :return: the statement made to read the latest committed rows rather than the transaction's snapshot
+        The file based databases have one writer at a time, so their snapshot already holds every committed row.
+        """
+        return query
+
+    def savepoint(self, db_cursor):
+        """
+        Mark the start of a bundle
+        :param db_cursor: a cursor on the patient database
+        :return:
+        """
+        db_cursor.execute("SAVEPOINT bundle")
+
+    def rollback_to_savepoint(self, con, db_cursor):
+        """
+        Discard everything since the bundle's savepoint
+        :param con: the connection the cursor belongs to
+        :param db_cursor: a cursor on the patient database
+        :return:
+        """
+        db_cursor.execute("ROLLBACK TO SAVEPOINT bundle")
+
+    def try_lock(self, db_cursor, name, timeout):
+        """
+        Take a named lock held until release_lock, for databases that more than one process writes to
+        The file based databases serialise their writers, so the default always succeeds.
+        :param db_cursor: a cursor on the patient database
+        :param name: the lock name
+        :param timeout: seconds to wait for the lock
+        :return: True if the lock was taken
+        """
+        return True
+
+    def release_lock(self, db_cursor, name):
+        """
+        Release a named lock taken with try_lock
+        :param db_cursor: a cursor on the patient database
+        :param name: the lock name
+        :return:
+        """
+
+    def file_path(self, extension):
+        """
+        :param extension: the extension used when no path is configured
+        :return: the database file for the file based backends
+        """
+        return self.path or self.database + extension
+
+
+class MySQLBackend(StorageBackend):
+    """
+    The MySQL server the pipeline was written for, with connections handed out from a pool
+    The pool is recreated if the process has been forked so connections are never shared between processes.
+    """
+
+    name = "mysql"
+
+    def __init__(self, database, config=None, pool_size=1, path=None):
+        super().__init__(database, config, pool_size, path)
+        self.pool = None
+        self.pool_pid = None
+
+    @property
+    def Error(self):
+        import mysql.connector
+        return mysql.connector.Error
+
+    @property
+    def IntegrityError(self):
+        import mysql.connector
+        return mysql.connector.errors.IntegrityError
+
+    def connect(self):
+        import mysql.connector
+        import mysql.connector.pooling
+        try:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="patient_pool_" + str(os.getpid()),
+                    pool_size=self.pool_size,
+                    database=self.database,
+                    **self.config
+                )
+                self.pool_pid = os.getpid()
+            return self.pool.get_connection()
+        except mysql.connector.errors.PoolError as e:
+            METRICS.error("connect", e)
+            print("ERROR: No free connections left in the Patient Database pool.")
+            return False
+        except mysql.connector.Error as e:
+            METRICS.error("connect", e)
+            print("The Patient Database does not exist.")
+            return False
+
+    def create_database(self):
+        import mysql.connector
+        try:
+            root_con = mysql.connector.connect(**self.config)
+        except mysql.connector.Error as e:
+            METRICS.error("connect", e)
+            print("Error: cannot connect to the server")
+            return False
+        root_con.cursor().execute("CREATE DATABASE " + self.database)
+        root_con.close()
+        return True
+
+    def drop_database(self):
+        import mysql.connector
+        root_con = mysql.connector.connect(**self.config)
+        root_con.cursor().execute("DROP DATABASE IF EXISTS " + self.database)
+        root_con.close()
+        self.pool = None
+
+    def table_exists(self, db_cursor, table):
+        db_cursor.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema=DATABASE() "
+                          "AND table_name=%s", (table,))
+        return db_cursor.fetchone()[0] > 0
+
+    def column_exists(self, db_cursor, table, column):
+        db_cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema=DATABASE() "
+                          "AND table_name=%s AND column_name=%s", (table, column))
+        return db_cursor.fetchone()[0] > 0
+
+    def index_exists(self, db_cursor, table, index):
+        db_cursor.execute("SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema=DATABASE() "
+                          "AND table_name=%s AND index_name=%s", (table, index))
+        return db_cursor.fetchone()[0] > 0
+
+    def index_name(self, table, index):
+        return index
+
+    def column_definition(self, definition):
+        return definition
+
+    def create_index_sql(self, table, index, columns, unique=False):
+        # MySQL 5.7 has no CREATE INDEX IF NOT EXISTS, callers check index_exists first
+        return "CREATE " + ("UNIQUE " if unique else "") + "INDEX " + index + " ON " + table + " (" + columns + ")"
+
+    def create_table(self, db_cursor, statement):
+        db_cursor.execute(statement)
+
+    def add_to_row_sql(self, table, key_columns, columns, added_columns, decimal_places=None):
+        # MySQL adds DECIMAL columns exactly, they need no rounding
+        names = tuple(key_columns) + tuple(columns) + tuple(added_columns)
+        return "INSERT INTO " + table + " (" + ", ".join(names) + ") VALUES (" + ", ".join(["%s"] * len(names)) + \
+            ") ON DUPLICATE KEY UPDATE " + \
+            ", ".join(column + " = " + column + " + VALUES(" + column + ")" for column in added_columns)
+
+    def locking_read_sql(self, query):
+        # InnoDB reads the latest committed version of the rows it locks, whatever the isolation level
+        return query + " LOCK IN SHARE MODE"
+
+    def try_lock(self, db_cursor, name, timeout):
+        db_cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+        return db_cursor.fetchone()[0] == 1
+
+    def release_lock(self, db_cursor, name):
+        db_cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        db_cursor.fetchall()
+
+
+class SQLiteConnection:
+    """
+    A sqlite3 connection whose cursors take %s placeholders and accept the MySQL buffered option
+    """
+
+    def __init__(self, con):
+        self.con = con
+
+    def cursor(self, buffered=None):
+        return QmarkCursor(self.con.cursor())
+
+    def commit(self):
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+
+    def close(self):
+        self.con.close()
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    A single SQLite file, for local runs and tests
+    SQLite allows one writer, and a worker holding a transaction open over several bundles would keep every
+    other worker waiting on the write lock, so files are loaded by a single process. The database is in WAL
+    mode so exports, which can be shared out to several processes, read while a load is running. Each bundle
+    starts an IMMEDIATE transaction so another process writing at the same time, such as the ingest daemon,
+    waits for the write lock rather than failing on it.
+    """
+
+    name = "sqlite"
+    parallel_load = False
+
+    @property
+    def Error(self):
+        import sqlite3
+        return sqlite3.Error
+
+    @property
+    def IntegrityError(self):
+        import sqlite3
+        return sqlite3.IntegrityError
+
+    def connect(self):
+        import sqlite3
+        try:
+            con = sqlite3.connect(self.file_path(".sqlite"), timeout=self.config.get("timeout", 60))
+            con.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error as e:
+            METRICS.error("connect", e)
+            print("ERROR: Cannot open the Patient Database " + self.file_path(".sqlite") + ": " + str(e))
+            return False
+        return SQLiteConnection(con)
+
+    def drop_database(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.file_path(".sqlite") + suffix):
+                os.remove(self.file_path(".sqlite") + suffix)
+
+    def table_exists(self, db_cursor, table):
+        db_cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=%s", (table,))
+        return db_cursor.fetchone()[0] > 0
+
+    def column_exists(self, db_cursor, table, column):
+        db_cursor.execute("SELECT COUNT(*) FROM pragma_table_info(%s) WHERE name=%s", (table, column))
+        return db_cursor.fetchone()[0] > 0
+
+    def index_exists(self, db_cursor, table, index):
+        db_cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='index' AND tbl_name=%s AND name=%s",
+                          (table, self.index_name(table, index)))
+        return db_cursor.fetchone()[0] > 0
+
+    def savepoint(self, db_cursor):
+        if not db_cursor.connection.in_transaction:
+            db_cursor.execute("BEGIN IMMEDIATE")
+        db_cursor.execute("SAVEPOINT bundle")
+
+
+class DuckDBConnection:
+    """
+    A DuckDB connection that, like the other drivers, always has a transaction open until it is committed
+    DuckDB's own cursors are separate connections with their own transactions, so every cursor handed out
+    here runs on the one connection.
+    """
+
+    def __init__(self, con):
+        self.con = con
+        self.con.begin()
+
+    def cursor(self, buffered=None):
+        return QmarkCursor(self.con, owned=False)
+
+    def commit(self):
+        self.con.commit()
+        self.con.begin()
+
+    def rollback(self):
+        self.con.rollback()
+        self.con.begin()
+
+    def close(self):
+        self.con.close()
+
+
+class DuckDBBackend(StorageBackend):
+    """
+    A single DuckDB file, giving columnar storage for analytical queries over the flattened tables
+    DuckDB allows one writing process, so files are loaded by a single process, and it has no savepoints,
+    so every bundle is committed on its own. Foreign keys are left out as DuckDB cannot update a row that
+    other tables reference.
+    """
+
+    name = "duckdb"
+    parallel_load = False
+    parallel_export = False
+    savepoints = False
+    keep_foreign_keys = False
+    column_types = {r"\bMEDIUMINT\b": "INTEGER", r"\bLONGTEXT\b": "VARCHAR", r"\bLONGBLOB\b": "BLOB",
+                    r"\bDATETIME\b": "TIMESTAMP"}
+
+    @property
+    def Error(self):
+        import duckdb
+        return duckdb.Error
+
+    @property
+    def IntegrityError(self):
+        import duckdb
+        return duckdb.ConstraintException
+
+    def connect(self):
+        try:
+            import duckdb
+        except ImportError as e:
+            METRICS.error("connect", e)
+            print("ERROR: duckdb is required to use the DuckDB backend")
+            return False
+        try:
+            return DuckDBConnection(duckdb.connect(self.file_path(".duckdb")))
+        except duckdb.Error as e:
+            METRICS.error("connect", e)
+            print("ERROR: Cannot open the Patient Database " + self.file_path(".duckdb") + ": " + str(e))
+            return False
+
+    def drop_database(self):
+        for suffix in ("", ".wal"):
+            if os.path.exists(self.file_path(".duckdb") + suffix):
+                os.remove(self.file_path(".duckdb") + suffix)
+
+    def table_exists(self, db_cursor, table):
+        db_cursor.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema=current_schema() "
+                          "AND table_name=%s", (table,))
+        return db_cursor.fetchone()[0] > 0
+
+    def column_exists(self, db_cursor, table, column):
+        db_cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema=current_schema() "
+                          "AND table_name=%s AND column_name=%s", (table, column))
+        return db_cursor.fetchone()[0] > 0
+
+    def index_exists(self, db_cursor, table, index):
+        db_cursor.execute("SELECT COUNT(*) FROM duckdb_indexes() WHERE table_name=%s AND index_name=%s",
+                          (table, self.index_name(table, index)))
+        return db_cursor.fetchone()[0] > 0
+
+    def auto_increment_column(self, table, column):
+        sequence = table + "_seq"
+        return ["CREATE SEQUENCE IF NOT EXISTS " + sequence], \
+            column + " INTEGER PRIMARY KEY DEFAULT nextval('" + sequence + "')"
+
+    def insert(self, db_cursor, sql, row, id_column):
+        db_cursor.execute(sql + " RETURNING " + id_column, row)
+        return db_cursor.fetchone()[0]
+
+    def savepoint(self, db_cursor):
+        pass
+
+    def rollback_to_savepoint(self, con, db_cursor):
+        con.rollback()
+
+
+def create_backend(name, database, config=None, pool_size=1, path=None):
+    """
+    Function to create the storage backend with the given name
+    :param name: one of BACKENDS
+    :param database: the database name, also the file name for the file based backends if no path is given
+    :param config: the connection settings for MySQL
+    :param pool_size: the number of pooled MySQL connections
+    :param path: the database file for SQLite or DuckDB
+    :return: the StorageBackend
+    """
+    backends = {"mysql": MySQLBackend, "sqlite": SQLiteBackend, "duckdb": DuckDBBackend}
+    if name not in backends:
+        raise ValueError("Unknown storage backend " + name + ", expected one of " + ", ".join(BACKENDS))
+    return backends[name](database, config, pool_size, path)
@@ -0,0 +1,227 @@
+'''
+Summary tables for dashboards, kept up to date as bundles are loaded.
+Dashboards read these small tables rather than aggregating the event and typed tables on every query:
+    summary_encounter_month         encounters per patient per month (YYYY-MM of the start date)
+    summary_latest_vital            each patient's most recent vital sign Observation of each code
+    summary_condition_prevalence    patients with each condition code, and how many of them have it active
+    summary_claim_month             claims and their total value per month (YYYY-MM of the billable period)
+The patient tables are rewritten for a patient whenever a bundle changes their typed rows. The condition and
+claim tables cover every patient, so they are adjusted by the difference the bundle made to that patient's
+share of them, and a bundle never has to read other patients' rows. Both happen in the bundle's own
+transaction, so the summaries always match the typed tables. rebuild_summaries recomputes every table from the
+typed tables, for databases loaded before the summaries existed or after the typed tables were changed by hand.
+'''
+
+# the per patient tables, written by the bulk loader, and their columns in insert order
+SUMMARY_TABLE_COLUMNS = {
+    "summary_encounter_month": ("patient", "encounter_month", "encounter_count"),
+    "summary_latest_vital": ("patient", "code", "display", "value_numeric", "value_text", "unit",
+                             "effective_datetime"),
+}
+SUMMARY_TABLES = tuple(SUMMARY_TABLE_COLUMNS) + ("summary_condition_prevalence", "summary_claim_month")
+# resource types whose typed rows the summaries are built from
+SUMMARY_RESOURCE_TYPES = {"Encounter", "Observation", "Condition", "Claim"}
+VITAL_SIGNS = "vital-signs"
+
+CREATE_TABLES = [
+    "CREATE TABLE IF NOT EXISTS summary_encounter_month (summary_encounter_month_id INT NOT NULL AUTO_INCREMENT, "
+    "patient INT, encounter_month CHAR(7), encounter_count INT, PRIMARY KEY(summary_encounter_month_id), "
+    "INDEX (patient), INDEX (encounter_month), FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS summary_latest_vital (summary_latest_vital_id INT NOT NULL AUTO_INCREMENT, "
+    "patient INT, code VARCHAR(64), display VARCHAR(255), value_numeric DOUBLE, value_text VARCHAR(255), "
+    "unit VARCHAR(64), effective_datetime DATETIME, PRIMARY KEY(summary_latest_vital_id), INDEX (patient), "
+    "INDEX (code), FOREIGN KEY (patient) REFERENCES patient(patient_id))",
+
+    "CREATE TABLE IF NOT EXISTS summary_condition_prevalence (code VARCHAR(64) NOT NULL, display VARCHAR(255), "
+    "patient_count INT, active_patient_count INT, PRIMARY KEY(code))",
+
+    "CREATE TABLE IF NOT EXISTS summary_claim_month (claim_month CHAR(7) NOT NULL, claim_count INT, "
+    "total_value DECIMAL(14,2), PRIMARY KEY(claim_month))"
+]
+
+# the typed table rows each summary is built from, by the key they are returned under in read_summaries
+_QUERIES = {
+    "encounter": "SELECT patient, start_datetime FROM patient_encounter",
+    "vital": "SELECT patient, code, display, value_numeric, value_text, unit, effective_datetime, "
+             "patient_observation_id FROM patient_observation WHERE category='" + VITAL_SIGNS + "'",
+    "condition": "SELECT patient, code, display, clinical_status FROM patient_condition",
+    "claim": "SELECT patient, start_datetime, total_value FROM patient_claim",
+}
+# the decimal places of summary_claim_month.total_value
+CLAIM_TOTAL_PLACES = 2
+
+
+def month_of(value):
+    """
+    :param value: a DATETIME as returned by the driver, a datetime or an ISO formatted string, may be None
+    :return: the YYYY-MM month, or None
+    """
+    return None if value is None else str(value)[:7]
+
+
+def _typed_rows(db_cursor, query, patient_id, batch_size):
+    """
+    Generator reading the rows of one of _QUERIES, for one patient or all of them
+    :param db_cursor: a cursor on the patient database
+    :param query: the query
+    :param patient_id: the database id of the patient, or None for every patient
+    :param batch_size: the number of rows fetched at a time
+    :return: an iterator of rows
+    """
+    if patient_id is None:
+        db_cursor.execute(query)
+    else:
+        db_cursor.execute(query + (" AND" if " WHERE " in query else " WHERE") + " patient=%s", (patient_id,))
+    while True:
+        rows = db_cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def read_summaries(db_cursor, patient_id=None, batch_size=10000):
+    """
+    Function to work out the summaries of one patient, or of every patient, from the typed tables
+    :param db_cursor: a cursor on the patient database
+    :param patient_id: the database id of the patient, or None for every patient
+    :param batch_size: the number of rows fetched at a time
+    :return: a dictionary holding
+        "encounter": {(patient, month): encounter count}
+        "vital": {(patient, code): the summary_latest_vital row}
+        "condition": {code: [display, patient count, active patient count]}
+        "claim": {month: [claim count, total value in cents]}
+    """
+    encounters = {}
+    for patient, start in _typed_rows(db_cursor, _QUERIES["encounter"], patient_id, batch_size):
+        month = month_of(start)
+        if month is not None:
+            encounters[patient, month] = encounters.get((patient, month), 0) + 1
+
+    # the latest reading is the one with the latest date, and of those the last stored
+    latest = {}
+    for patient, code, display, numeric, text, unit, effective, row_id in _typed_rows(
+            db_cursor, _QUERIES["vital"], patient_id, batch_size):
+        order = (0, row_id) if effective is None else (1, effective, row_id)
+        if code is not None and ((patient, code) not in latest or order > latest[patient, code][0]):
+            latest[patient, code] = (order, (patient, code, display, numeric, text, unit, effective))
+    vitals = {key: row for key, (_, row) in latest.items()}
+
+    # a patient counts once for each condition code however many times it was recorded
+    patient_conditions = {}
+    for patient, code, display, status in _typed_rows(db_cursor, _QUERIES["condition"], patient_id, batch_size):
+        if code is None:
+            continue
+        known = patient_conditions.get((patient, code))
+        if known is None:
+            patient_conditions[patient, code] = [display, status == "active"]
+        else:
+            known[0] = known[0] or display
+            known[1] = known[1] or status == "active"
+    conditions = {}
+    for (_, code), (display, active) in patient_conditions.items():
+        counts = conditions.setdefault(code, [display, 0, 0])
+        counts[0] = counts[0] or display
+        counts[1] += 1
+        counts[2] += active
+
+    # totals are added up in whole cents, so they come to the same amount whatever order the claims are in
+    claims = {}
+    for _, start, total in _typed_rows(db_cursor, _QUERIES["claim"], patient_id, batch_size):
+        month = month_of(start)
+        if month is not None:
+            counts = claims.setdefault(month, [0, 0])
+            counts[0] += 1
+            counts[1] += round(float(total or 0) * 10 ** CLAIM_TOTAL_PLACES)
+    return {"encounter": encounters, "vital": vitals, "condition": conditions, "claim": claims}
+
+
+def empty_summaries():
+    """
+    :return: the summaries of a patient with no typed rows, in the form read_summaries returns
+    """
+    return {"encounter": {}, "vital": {}, "condition": {}, "claim": {}}
+
+
+def add_patient_rows(summaries, loader):
+    """
+    Function to buffer the per patient summary rows on the loader
+    :param summaries: summaries from read_summaries
+    :param loader: the BulkLoader the rows are written with
+    :return:
+    """
+    for (patient, month), count in sorted(summaries["encounter"].items()):
+        loader.add("summary_encounter_month", (patient, month, count))
+    for _, row in sorted(summaries["vital"].items()):
+        loader.add("summary_latest_vital", row)
+
+
+def adjust_totals(before, after, loader):
+    """
+    Function to apply the change between two sets of summaries to the condition and claim tables
+    Rows are changed in key order so sessions loading in parallel lock them in the same order, and a
+    condition no patient has any more is removed.
+    :param before: summaries from read_summaries before the change
+    :param after: summaries from read_summaries after the change
+    :param loader: the BulkLoader whose transaction the changes run in
+    :return:
+    """
+    conditions = []
+    for code in sorted(set(before["condition"]) | set(after["condition"])):
+        old = before["condition"].get(code, (None, 0, 0))
+        new = after["condition"].get(code, (None, 0, 0))
+        if new[1] != old[1] or new[2] != old[2]:
+            conditions.append((code, new[0] or old[0], new[1] - old[1], new[2] - old[2]))
+    claims = []
+    for month in sorted(set(before["claim"]) | set(after["claim"])):
+        old = before["claim"].get(month, (0, 0))
+        new = after["claim"].get(month, (0, 0))
+        if new[0] != old[0] or new[1] != old[1]:
+            claims.append((month, new[0] - old[0], (new[1] - old[1]) / 10 ** CLAIM_TOTAL_PLACES))
+
+    if conditions:
+        loader.cursor.executemany(loader.backend.add_to_row_sql(
+            "summary_condition_prevalence", ("code",), ("display",), ("patient_count", "active_patient_count")),
+            conditions)
+        removed = [(code,) for code, _, patients, _ in conditions if patients < 0]
+        if removed:
+            loader.cursor.executemany("DELETE FROM summary_condition_prevalence WHERE code=%s AND patient_count<=0",
+                                      removed)
+    if claims:
+        loader.cursor.executemany(loader.backend.add_to_row_sql(
+            "summary_claim_month", ("claim_month",), (), ("claim_count", "total_value"),
+            {"total_value": CLAIM_TOTAL_PLACES}), claims)
+        removed = [(month,) for month, count, _ in claims if count < 0]
+        if removed:
+            loader.cursor.executemany("DELETE FROM summary_claim_month WHERE claim_month=%s AND claim_count<=0",
+                                      removed)
+
+
+def update_patient_summaries(patient_id, before, loader):
+    """
+    Function to bring the summaries up to date once a bundle has changed a patient's typed rows
+    The typed rows must have been flushed first.
+    :param patient_id: the database id of the patient
+    :param before: the patient's summaries from read_summaries before the bundle changed anything
+    :param loader: the BulkLoader whose transaction the changes run in
+    :return:
+    """
+    after = read_summaries(loader.cursor, patient_id)
+    for table in SUMMARY_TABLE_COLUMNS:
+        loader.cursor.execute("DELETE FROM " + table + " WHERE patient=%s", (patient_id,))
+    add_patient_rows(after, loader)
+    adjust_totals(before, after, loader)
+
+
+def rebuild_summaries(loader):
+    """
+    Function to recompute every summary table from the typed tables
+    :param loader: the BulkLoader whose transaction the tables are rebuilt in, the caller commits
+    :return:
+    """
+    for table in SUMMARY_TABLES:
+        loader.cursor.execute("DELETE FROM " + table)
+    summaries = read_summaries(loader.cursor)
+    add_patient_rows(summaries, loader)
+    adjust_totals(empty_summaries(), summaries, loader)
+    loader.flush()
@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+'''
+Shared fixtures. The modules are imported from the repository root, as the scripts are run from there.
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, "data")
+sys.path.insert(0, ROOT)
+# the backends the loading tests run on. MySQL is only used when PATIENT_TEST_MYSQL is set, the server is
+# configured with the PATIENT_DB_ variables and the tests create and drop patient_test_database on it
+DATABASE_BACKENDS = ["sqlite"] + (["mysql"] if os.environ.get("PATIENT_TEST_MYSQL") else [])
+
+
+@pytest.fixture
+def sample_files():
+    """
+    :return: the sample bundle files, in name order
+    """
+    return sorted(os.path.join(DATA_DIR, name) for name in os.listdir(DATA_DIR) if name.endswith(".json"))
+
+
+def open_database(backend, tmp_path, monkeypatch):
+    """
+    Function to point dataReader at a new, empty patient database
+    :param backend: one of the storage backends
+    :param tmp_path: the test's directory, which file based databases are kept in
+    :param monkeypatch: the test's monkeypatch, which restores the settings afterwards
+    :return: a connection to the database
+    """
+    import dataReader
+    os.makedirs(tmp_path, exist_ok=True)
+    monkeypatch.setattr(dataReader, "STORAGE_BACKEND", backend)
+    monkeypatch.setattr(dataReader, "DB_NAME", "patient_test_database")
+    monkeypatch.setattr(dataReader, "DB_PATH", str(tmp_path / ("patients." + backend)))
+    monkeypatch.setattr(dataReader, "EVENT_COMPRESSION", "none")
+    monkeypatch.setattr(dataReader, "_backend", None)
+    dataReader.storage_backend().drop_database()
+    assert dataReader.init_database()
+    return dataReader.connect_patient_db()
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    :return: a connection to a new SQLite patient database, which dataReader loads into
+    """
+    con = open_database("sqlite", tmp_path, monkeypatch)
+    yield con
+    con.close()
+
+
+@pytest.fixture(params=DATABASE_BACKENDS)
+def any_database(request, tmp_path, monkeypatch):
+    """
+    :return: a connection to a new patient database on each of DATABASE_BACKENDS, which dataReader loads into
+    """
+    import dataReader
+    con = open_database(request.param, tmp_path, monkeypatch)
+    yield con
+    con.close()
+    dataReader.storage_backend().drop_database()
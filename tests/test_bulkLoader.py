@@ -0,0 +1,123 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import dataReader
+from conftest import open_database
+from dataReader import TABLE_COLUMNS
+
+
+def copy_bundles(sample_files, directory, count):
+    """
+    :return: the paths of copies of the first count sample bundles
+    """
+    os.makedirs(directory, exist_ok=True)
+    copies = []
+    for number, source in enumerate(sample_files[:count]):
+        copies.append(os.path.realpath(os.path.join(directory, "bundle" + str(number) + ".json")))
+        shutil.copy(source, copies[-1])
+    return copies
+
+
+def break_bundle(file_path, position=40):
+    """
+    Function to add an entry without a resource part way through a bundle, which fails it once earlier
+    entries have been written
+    :return: the bundle's patient unique id
+    """
+    with open(file_path, encoding="utf-8") as file:
+        bundle = json.load(file)
+    bundle["entry"].insert(position, {"fullUrl": "urn:uuid:broken"})
+    with open(file_path, "w", encoding="utf-8") as file:
+        json.dump(bundle, file)
+    return bundle["entry"][0]["resource"]["id"]
+
+
+def patient_ids(con):
+    """
+    :return: the unique ids of the stored patients
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT unique_id FROM patient")
+    return {row[0] for row in db_cursor.fetchall()}
+
+
+def table_counts(con):
+    """
+    :return: the number of rows in each table the loader writes
+    """
+    db_cursor = con.cursor()
+    counts = {}
+    for table in TABLE_COLUMNS:
+        db_cursor.execute("SELECT COUNT(*) FROM " + table)
+        counts[table] = db_cursor.fetchone()[0]
+    return counts
+
+
+def test_failed_bundle_rolls_back_to_its_savepoint(database, sample_files, tmp_path):
+    files = copy_bundles(sample_files, tmp_path, 3)
+    broken = break_bundle(files[1])
+    # the batches are small, so rows of the broken bundle have been sent before it fails
+    result = dataReader.load_files(files, batch_size=10, bundles_per_commit=3)
+
+    assert result["failed"] == [files[1]]
+    stored = patient_ids(database)
+    assert len(stored) == 2 and broken not in stored
+    db_cursor = database.cursor()
+    db_cursor.execute("SELECT COUNT(*) FROM patient_event e JOIN patient p ON p.patient_id = e.patient "
+                      "WHERE p.unique_id=%s", (broken,))
+    assert db_cursor.fetchone()[0] == 0
+
+
+def test_abort_transaction_reports_lost_files(database, sample_files, tmp_path):
+    files = copy_bundles(sample_files, tmp_path, 2)
+    loader = dataReader.BulkLoader(batch_size=10, bundles_per_commit=5)
+    assert all(dataReader.load_json_data(file_path, loader) for file_path in files)
+    loader.abort_transaction()
+
+    assert loader.take_lost_files() == files
+    assert loader.take_lost_files() == []
+    loader.close()
+    assert patient_ids(database) == set()
+
+
+def test_lost_savepoint_fails_the_whole_transaction(database, sample_files, tmp_path, monkeypatch):
+    files = copy_bundles(sample_files, tmp_path, 3)
+    break_bundle(files[2])
+
+    def lost_savepoint(self, con, db_cursor):
+        # as after a deadlock or a lost connection, when the server has rolled back the whole transaction
+        con.rollback()
+        raise self.Error("no such savepoint: bundle")
+    backend_class = type(dataReader.storage_backend())
+    rollback_to_savepoint = backend_class.rollback_to_savepoint
+    monkeypatch.setattr(backend_class, "rollback_to_savepoint", lost_savepoint)
+    result = dataReader.load_files(files, bundles_per_commit=5)
+
+    assert sorted(result["failed"]) == files
+    assert patient_ids(database) == set()
+    # nothing was recorded as loaded, so the files are tried again
+    monkeypatch.setattr(backend_class, "rollback_to_savepoint", rollback_to_savepoint)
+    result = dataReader.load_files(files[:2])
+    assert result["failed"] == [] and result["unchanged"] == 0
+
+
+@pytest.mark.parametrize("bundles_per_commit", [1, 4])
+def test_batched_rows_match_a_row_at_a_time_load(sample_files, tmp_path, monkeypatch, bundles_per_commit):
+    counts = []
+    stats = []
+    for batch_size in (1, dataReader.BATCH_SIZE):
+        con = open_database("sqlite", tmp_path / str(batch_size), monkeypatch)
+        result = dataReader.load_files(sample_files[:4], batch_size=batch_size,
+                                       bundles_per_commit=bundles_per_commit)
+        assert result["failed"] == []
+        counts.append(table_counts(con))
+        stats.append({table: rows for table, (rows, _) in result["stats"].items()})
+        con.close()
+
+    assert counts[0] == counts[1]
+    assert counts[0]["patient_event"] > 0
+    # the rows the loader reports sending are the rows stored
+    assert stats[0] == stats[1] == counts[0]
@@ -0,0 +1,87 @@
+import io
+import json
+
+import pytest
+
+from bundleParser import RESOURCE_TEXT, BundleFormatError, iter_bundle_entries, iter_entries
+
+# strings with escapes, a number split across chunks and a resource spread over several lines
+ESCAPED_BUNDLE = (
+    '{"resourceType": "Bundle", "type": "transaction", "entry": [\n'
+    ' {"fullUrl": "urn:uuid:1", "resource": {"resourceType": "Patient", "id": "1", '
+    '"name": [{"family": "O\'Brien \\"Bo\\"", "given": ["Zo\\u00eb", "\\ud83d\\ude00"]}]}},\n'
+    ' {"resource": {"resourceType": "Observation", "id": "2", "valueQuantity": {"value": 1234567.891e-3},\n'
+    '   "note": [{"text": "line one\\nline two\\t\\\\ C:\\\\path \\/ done"}]}, "request": {"method": "PUT"}},\n'
+    ' {"resource": {"resourceType": "CarePlan", "id": "3", "text": {"div": '
+    '"<div xmlns=\\"http://www.w3.org/1999/xhtml\\">Care \\u003cplan\\u003e</div>"}}},\n'
+    ' 42, {}\n'
+    '], "total": -17.5}'
+)
+
+
+def without_text(entries):
+    """
+    :return: the entries without the resource text the streaming reader adds
+    """
+    return [{key: value for key, value in entry.items() if key != RESOURCE_TEXT} if isinstance(entry, dict)
+            else entry for entry in entries]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 64 * 1024])
+def test_streaming_matches_json_load(chunk_size):
+    entries = list(iter_entries(io.StringIO(ESCAPED_BUNDLE), chunk_size))
+    assert without_text(entries) == json.loads(ESCAPED_BUNDLE)["entry"]
+
+
+def test_resource_text_is_kept_for_single_line_resources():
+    entries = list(iter_entries(io.StringIO(ESCAPED_BUNDLE), 16))
+    assert json.loads(entries[0][RESOURCE_TEXT]) == entries[0]["resource"]
+    assert json.loads(entries[2][RESOURCE_TEXT]) == entries[2]["resource"]
+    # spread over two lines, so its text is not a plain serialisation and is not kept
+    assert RESOURCE_TEXT not in entries[1]
+
+
+def test_bundle_without_entries():
+    assert list(iter_entries(io.StringIO('{"resourceType": "Bundle", "entry": []}'))) == []
+    assert list(iter_entries(io.StringIO('{}'))) == []
+
+
+@pytest.mark.parametrize("cut", [1, 30, 75, 160, 240, 330, len(ESCAPED_BUNDLE) // 2, len(ESCAPED_BUNDLE) - 1])
+def test_truncated_bundle_raises(cut):
+    with pytest.raises(ValueError):
+        list(iter_entries(io.StringIO(ESCAPED_BUNDLE[:cut]), 16))
+
+
+def test_every_truncation_raises():
+    for cut in range(len(ESCAPED_BUNDLE)):
+        with pytest.raises(ValueError):
+            list(iter_entries(io.StringIO(ESCAPED_BUNDLE[:cut]), 64))
+
+
+def test_not_a_bundle_raises():
+    with pytest.raises(BundleFormatError):
+        list(iter_entries(io.StringIO('[{"resource": {}}]')))
+
+
+@pytest.mark.parametrize("whole_file_limit", [0, 1 << 30])
+def test_bundle_file_matches_json_load(tmp_path, whole_file_limit):
+    file_path = tmp_path / "bundle.json"
+    file_path.write_text(ESCAPED_BUNDLE, encoding="utf-8")
+    entries = list(iter_bundle_entries(str(file_path), chunk_size=32, whole_file_limit=whole_file_limit))
+    assert without_text(entries) == json.loads(ESCAPED_BUNDLE)["entry"]
+
+
+@pytest.mark.parametrize("whole_file_limit", [0, 1 << 30])
+def test_truncated_bundle_file_raises(tmp_path, whole_file_limit):
+    file_path = tmp_path / "bundle.json"
+    file_path.write_text(ESCAPED_BUNDLE[:len(ESCAPED_BUNDLE) // 2], encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_bundle_entries(str(file_path), whole_file_limit=whole_file_limit))
+
+
+@pytest.mark.parametrize("whole_file_limit", [0, 1 << 30])
+def test_sample_bundles_match_json_load(sample_files, whole_file_limit):
+    for file_path in sample_files[:3]:
+        with open(file_path, encoding="utf-8") as file:
+            expected = json.load(file)["entry"]
+        assert without_text(iter_bundle_entries(file_path, whole_file_limit=whole_file_limit)) == expected
@@ -0,0 +1,155 @@
+import collections
+import csv
+import glob
+import os
+
+import pytest
+
+import dataReader
+import jsonCodec
+
+
+@pytest.fixture
+def loaded(database, sample_files):
+    """
+    :return: a connection to a SQLite patient database holding the first two sample bundles
+    """
+    assert dataReader.load_files(sample_files[:2])["failed"] == []
+    return database
+
+
+def database_counts(con):
+    """
+    :return: the number of patients, and the number of events by resource type and by patient unique id
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT COUNT(*) FROM patient")
+    patients = db_cursor.fetchone()[0]
+    db_cursor.execute("SELECT e.type, p.unique_id FROM patient_event e JOIN patient p ON p.patient_id = e.patient")
+    rows = db_cursor.fetchall()
+    return patients, collections.Counter(row[0] for row in rows), collections.Counter(row[1] for row in rows)
+
+
+def read_rows(file_path):
+    """
+    :return: the rows of a CSV file, as dictionaries keyed by its header
+    """
+    with open(file_path, encoding="utf-8", newline="") as file:
+        return list(csv.DictReader(file))
+
+
+def per_event_counts(output_dir):
+    """
+    :return: the counts of database_counts, read back from an export in the per-event layout
+    """
+    patients = 0
+    by_type = collections.Counter()
+    by_patient = collections.Counter()
+    for folder in os.listdir(output_dir):
+        unique_id = read_rows(os.path.join(output_dir, folder, "patient.csv"))[0]["unique_id"]
+        patients += 1
+        for file_path in glob.glob(os.path.join(output_dir, folder, "event_*.csv")):
+            rows = len(read_rows(file_path))
+            by_type[os.path.basename(file_path)[:-len(".csv")].split("_", 2)[2]] += rows
+            by_patient[unique_id] += rows
+    return patients, by_type, by_patient
+
+
+def per_type_counts(output_dir):
+    """
+    :return: the counts of database_counts, read back from an export in the per-type layout
+    """
+    patients = sum(len(read_rows(file_path)) for file_path in glob.glob(os.path.join(output_dir, "patient", "*.csv")))
+    by_type = collections.Counter()
+    by_patient = collections.Counter()
+    for resource_type in os.listdir(output_dir):
+        if resource_type == "patient":
+            continue
+        for file_path in glob.glob(os.path.join(output_dir, resource_type, "*.csv")):
+            for row in read_rows(file_path):
+                by_type[resource_type] += 1
+                by_patient[row["patient_unique_id"]] += 1
+    return patients, by_type, by_patient
+
+
+def export_files(output_dir):
+    """
+    :return: the contents of every file under an export, keyed by its path within it
+    """
+    contents = {}
+    for directory, _, names in os.walk(output_dir):
+        for name in names:
+            with open(os.path.join(directory, name), "rb") as file:
+                contents[os.path.relpath(os.path.join(directory, name), output_dir)] = file.read()
+    return contents
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("layout", dataReader.CSV_LAYOUTS)
+def test_csv_export_matches_the_database(loaded, tmp_path, layout, workers):
+    output_dir = str(tmp_path / "csv")
+    # small files, so the per-type layout splits a type across several
+    assert dataReader.create_csv_files(output_dir, batch_size=50, workers=workers, rows_per_file=40, layout=layout)
+
+    counts = per_event_counts(output_dir) if layout == "per-event" else per_type_counts(output_dir)
+    assert counts == database_counts(loaded)
+    assert not os.path.exists(output_dir + ".partial")
+
+
+def test_unknown_csv_layout_raises(loaded, tmp_path):
+    with pytest.raises(ValueError):
+        dataReader.create_csv_files(str(tmp_path / "csv"), layout="per-patient")
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_failed_export_leaves_the_previous_one(loaded, tmp_path, monkeypatch, workers):
+    output_dir = str(tmp_path / "csv")
+    dataReader.create_csv_files(output_dir, workers=workers, layout="per-type")
+    previous = export_files(output_dir)
+
+    csv_event_json = dataReader.csv_event_json
+
+    def failing_csv_event_json(event_data, event_blob=None):
+        # part way through the export, once other types have been written
+        event_json = csv_event_json(event_data, event_blob)
+        if jsonCodec.loads(event_json)["resourceType"] == "Condition":
+            raise RuntimeError("export failed")
+        return event_json
+    monkeypatch.setattr(dataReader, "csv_event_json", failing_csv_event_json)
+    with pytest.raises(RuntimeError):
+        dataReader.create_csv_files(output_dir, workers=workers, layout="per-type")
+    assert export_files(output_dir) == previous
+    assert not os.path.exists(output_dir + ".previous")
+
+    # the next export clears what the failed one left staged
+    monkeypatch.setattr(dataReader, "csv_event_json", csv_event_json)
+    dataReader.create_csv_files(output_dir, workers=workers, layout="per-type")
+    assert export_files(output_dir) == previous
+    assert not os.path.exists(output_dir + ".partial")
+
+
+def test_publish_export_replaces_the_previous_export(tmp_path):
+    output_dir = str(tmp_path / "csv")
+    os.makedirs(os.path.join(output_dir, "old"))
+    open(os.path.join(output_dir, "old", "patient.csv"), "w").close()
+    # left by an export interrupted while publishing
+    os.makedirs(output_dir + ".previous")
+
+    staging = dataReader.staging_dir(output_dir)
+    os.makedirs(os.path.join(staging, "new"))
+    open(os.path.join(staging, "new", "patient.csv"), "w").close()
+    dataReader.publish_export(staging, output_dir)
+
+    assert list(export_files(output_dir)) == [os.path.join("new", "patient.csv")]
+    assert sorted(os.listdir(tmp_path)) == ["csv"]
+
+
+def test_patient_shards_cover_every_patient_once(loaded):
+    db_cursor = loaded.cursor()
+    db_cursor.execute("SELECT patient_id FROM patient ORDER BY patient_id")
+    patient_ids = [row[0] for row in db_cursor.fetchall()]
+    for shard_count in (1, 3, 10):
+        shards = dataReader.patient_shards(shard_count)
+        assert 0 < len(shards) <= shard_count
+        assert [patient_id for first, last in shards for patient_id in patient_ids
+                if first <= patient_id <= last] == patient_ids
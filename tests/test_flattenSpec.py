@@ -0,0 +1,85 @@
+import pytest
+
+from flattenSpec import Extractor, SpecError
+
+CONDITION = {
+    "resourceType": "Condition",
+    "id": "c1",
+    "code": {"coding": [{"system": "http://snomed.info/sct", "code": "44054006", "display": "Diabetes"}],
+             "text": ""},
+    "onsetDateTime": "2001-02-03T04:05:06Z",
+    "identifier": [{"system": "a"}, {"system": "b", "value": "second"}],
+    "extension": [{"url": "http://hl7.org/fhir/StructureDefinition/patient-birthPlace", "valueString": "Boston"},
+                  {"url": "weight", "valueDecimal": 1.5}],
+}
+
+
+def extract(fields, resource=CONDITION, **spec):
+    """
+    :return: the rows a spec with the fields gives for the resource
+    """
+    return Extractor(dict(spec, fields=fields))(resource)
+
+
+def test_dotted_paths_and_indexes():
+    assert extract((("id", "id"), ("code", "code.coding[0].code"), ("system", "code.coding[0].system"))) == \
+        [("c1", "44054006", "http://snomed.info/sct")]
+
+
+def test_missing_or_wrong_typed_values_give_none():
+    assert extract((("a", "missing"), ("b", "code.coding[5].code"), ("c", "id.deeper"),
+                    ("d", "code[0]"), ("e", "onsetDateTime.x"))) == [(None, None, None, None, None)]
+
+
+def test_selectors():
+    assert extract((("value", "identifier[?value].value"),
+                    ("exact", "extension(weight).valueDecimal"),
+                    ("suffix", "extension(patient-birthPlace).valueString"),
+                    ("none", "extension(height).valueDecimal"))) == [("second", 1.5, "Boston", None)]
+
+
+def test_alternatives_skip_empty_values():
+    assert extract((("text", "code.text | code.coding[0].display"), ("first", "id | code.text"))) == \
+        [("Diabetes", "c1")]
+
+
+def test_transform_and_default():
+    rows = extract((("year", "onsetDateTime", lambda value: int(value[:4])),
+                    ("missing", "abatementDateTime", str.upper, "unknown"),
+                    ("empty", "code.text", None, "no text")))
+    assert rows == [(2001, "unknown", "no text")]
+
+
+def test_each_writes_a_row_per_item():
+    spec = {"table": "coding", "each": "code.coding",
+            "fields": (("id", "id"), ("code", "@code"), ("parent_id", "^id"))}
+    resource = dict(CONDITION, code={"coding": [{"code": "a"}, {"code": "b"}]})
+    extractor = Extractor(spec)
+    assert extractor(resource) == [("c1", "a", "c1"), ("c1", "b", "c1")]
+    # without items the resource gives one row of its own, with nothing read from a parent
+    assert extractor({"id": "c2"}) == [("c2", None, None)]
+
+
+def test_flatten_repeats_per_resource_columns():
+    extractor = Extractor({"each": "code.coding", "fields": (("code", "@code"),)})
+    resources = [{"code": {"coding": [{"code": "a"}, {"code": "b"}]}}, {"id": "x"}]
+    assert extractor.flatten(resources, {"patient": [1, 2]}) == {"patient": [1, 1, 2], "code": ["a", "b", None]}
+
+
+def test_flatten_matches_rows():
+    extractor = Extractor({"fields": (("id", "id"), ("code", "code.coding[0].code"))})
+    resources = [CONDITION, {"id": "c2"}]
+    columns = extractor.flatten(resources)
+    assert list(zip(*columns.values())) == [row for resource in resources for row in extractor(resource)]
+    assert extractor.flatten([]) == {"id": [], "code": []}
+
+
+@pytest.mark.parametrize("path", ["", "a..b", "a.", "code[", "1abc", "a[x]", "a(b"])
+def test_bad_paths_raise(path):
+    with pytest.raises(SpecError):
+        Extractor({"fields": (("column", path),)})
+
+
+def test_bad_field_raises():
+    with pytest.raises(SpecError):
+        Extractor({"fields": (("column",),)})
@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+
+import dataReader
+
+
+def count_rows(con, table):
+    """
+    :return: the number of rows in a table
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT COUNT(*) FROM " + table)
+    return db_cursor.fetchone()[0]
+
+
+def bundle_events(file_paths):
+    """
+    :return: the number of events the bundle files hold, every entry but the Patient
+    """
+    events = 0
+    for file_path in file_paths:
+        with open(file_path, encoding="utf-8") as file:
+            events += len(json.load(file)["entry"]) - 1
+    return events
+
+
+def copy_bundles(sample_files, directory, count):
+    """
+    :return: the paths of copies of the first count sample bundles
+    """
+    os.makedirs(directory, exist_ok=True)
+    copies = []
+    for number, source in enumerate(sample_files[:count]):
+        copies.append(os.path.join(str(directory), "bundle" + str(number) + ".json"))
+        shutil.copy(source, copies[-1])
+    return copies
+
+
+def duplicate_events(con):
+    """
+    :return: the (patient, resource_id) pairs stored more than once
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT patient, resource_id FROM patient_event GROUP BY patient, resource_id "
+                      "HAVING COUNT(*) > 1")
+    return db_cursor.fetchall()
+
+
+def test_unchanged_files_are_skipped(database, sample_files, tmp_path, monkeypatch):
+    files = copy_bundles(sample_files, tmp_path / "data", 3)
+    assert dataReader.load_files(files)["unchanged"] == 0
+    events = count_rows(database, "patient_event")
+
+    result = dataReader.load_files(files)
+    assert result["unchanged"] == 3 and result["failed"] == []
+    assert sum(rows for rows, _ in result["stats"].values()) == 0
+    # touched files are hashed and skipped, and the same file reached by a relative path is recognised
+    os.utime(files[0])
+    monkeypatch.chdir(tmp_path)
+    result = dataReader.load_files([os.path.join("data", os.path.basename(file_path)) for file_path in files])
+    assert result["unchanged"] == 3
+    assert count_rows(database, "patient_event") == events
+    assert count_rows(database, "ingest_manifest") == 3
+
+
+def test_changed_file_is_reloaded_without_duplicates(database, sample_files, tmp_path):
+    files = copy_bundles(sample_files, tmp_path, 3)
+    dataReader.load_files(files)
+    events = count_rows(database, "patient_event")
+
+    with open(files[1], encoding="utf-8") as file:
+        bundle = json.load(file)
+    changed = next(entry["resource"] for entry in bundle["entry"]
+                   if entry["resource"]["resourceType"] == "Condition")
+    changed["clinicalStatus"]["coding"][0]["code"] = "entered-in-error"
+    with open(files[1], "w", encoding="utf-8") as file:
+        json.dump(bundle, file)
+    result = dataReader.load_files(files)
+
+    assert result["unchanged"] == 2 and result["failed"] == []
+    # only the changed resource is written again
+    assert result["stats"]["patient_event"][0] == 1
+    assert count_rows(database, "patient_event") == events
+    assert duplicate_events(database) == []
+    db_cursor = database.cursor()
+    db_cursor.execute("SELECT clinical_status FROM patient_condition WHERE resource_id=%s", (changed["id"],))
+    assert db_cursor.fetchall() == [("entered-in-error",)]
+
+
+def patient_rows(con, table, patient_id):
+    """
+    :return: the number of rows of a patient in a table
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT COUNT(*) FROM " + table + " WHERE patient=%s", (patient_id,))
+    return db_cursor.fetchone()[0]
+
+
+def test_interrupted_run_resumes_with_the_rest(database, sample_files, tmp_path, monkeypatch):
+    directory = str(tmp_path / "data")
+    files = sorted(copy_bundles(sample_files, directory, 5))
+    run_id = dataReader.start_run(database, directory, len(files))
+    dataReader.load_files(files[:3], run_id=run_id)
+    assert dataReader.interrupted_run(database)[0] == run_id
+
+    # a patient left half loaded by an earlier version, with its typed rows but none of its events
+    db_cursor = database.cursor()
+    db_cursor.execute("SELECT p.patient_id FROM ingest_manifest m JOIN patient p ON p.unique_id = "
+                      "m.patient_unique_id WHERE m.file_path=%s", (os.path.realpath(files[2]),))
+    half_loaded = db_cursor.fetchone()[0]
+    loaded = {table: patient_rows(database, table, half_loaded) for table in ("patient_event", "patient_encounter")}
+    db_cursor.execute("DELETE FROM patient_event WHERE patient=%s", (half_loaded,))
+    database.commit()
+
+    results = []
+    load_files = dataReader.load_files
+
+    def recording_load_files(*args):
+        results.append(load_files(*args))
+        return results[-1]
+    monkeypatch.setattr(dataReader, "load_files", recording_load_files)
+    assert dataReader.load_json_files(directory, resume=True)
+
+    # the two files it had not reached and the half loaded patient's file are loaded, the others skipped
+    assert results[0]["unchanged"] == 2 and results[0]["failed"] == []
+    assert dataReader.interrupted_run(database) is None
+    db_cursor.execute("SELECT COUNT(*), MIN(run_id), MAX(run_id) FROM ingest_manifest")
+    assert db_cursor.fetchone() == (5, run_id, run_id)
+    assert count_rows(database, "ingest_run") == 1
+    assert {table: patient_rows(database, table, half_loaded) for table in loaded} == loaded
+    assert count_rows(database, "patient_event") == bundle_events(files)
+    assert duplicate_events(database) == []
+
+
+def test_parallel_sqlite_load(database, sample_files):
+    # with several bundles per commit, a worker holding its transaction open kept the others waiting on the
+    # write lock until they timed out, so SQLite is loaded by one process however many workers are asked for
+    dataReader.storage_backend().config["timeout"] = 5
+    result = dataReader.load_files(sample_files[:12], bundles_per_commit=2, workers=3)
+    assert result["failed"] == []
+    assert count_rows(database, "patient") == 12
+    assert count_rows(database, "patient_event") == bundle_events(sample_files[:12])
+
+
+def test_parallel_load_with_a_repeated_bundle(any_database, sample_files, tmp_path):
+    # the same bundle under two names, which two workers may load at the same time
+    files = copy_bundles(sample_files, tmp_path, 8)
+    repeated = str(tmp_path / "repeated.json")
+    shutil.copy(files[0], repeated)
+    result = dataReader.load_files(files + [repeated], bundles_per_commit=2, workers=3)
+
+    assert result["failed"] == []
+    assert count_rows(any_database, "patient") == 8
+    db_cursor = any_database.cursor()
+    db_cursor.execute("SELECT unique_id FROM patient GROUP BY unique_id HAVING COUNT(*) > 1")
+    assert db_cursor.fetchall() == []
+    assert duplicate_events(any_database) == []
+    assert count_rows(any_database, "patient_event") == bundle_events(files)
+    assert count_rows(any_database, "ingest_manifest") == 9
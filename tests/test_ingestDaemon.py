@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import shutil
+import signal
+
+import ingestDaemon
+from metrics import METRICS
+
+
+def fill_inbox(sample_files, inbox, count):
+    """
+    :return: the real paths of copies of the first count sample bundles put in the inbox
+    """
+    os.makedirs(inbox, exist_ok=True)
+    copies = []
+    for number, source in enumerate(sample_files[:count]):
+        copies.append(os.path.realpath(os.path.join(inbox, "bundle" + str(number) + ".json")))
+        shutil.copy(source, copies[-1])
+    return copies
+
+
+def manifest_files(con):
+    """
+    :return: the file paths recorded in ingest_manifest, with a path recorded twice appearing twice
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT file_path FROM ingest_manifest")
+    return sorted(row[0] for row in db_cursor.fetchall())
+
+
+def stored_events(con):
+    """
+    :return: the number of events stored, and the (patient, resource_id) pairs stored more than once
+    """
+    db_cursor = con.cursor()
+    db_cursor.execute("SELECT COUNT(*) FROM patient_event")
+    events = db_cursor.fetchone()[0]
+    db_cursor.execute("SELECT patient, resource_id FROM patient_event GROUP BY patient, resource_id "
+                      "HAVING COUNT(*) > 1")
+    return events, db_cursor.fetchall()
+
+
+def bundle_events(file_paths):
+    """
+    :return: the number of events the bundle files hold, every entry but the Patient
+    """
+    events = 0
+    for file_path in file_paths:
+        with open(file_path, encoding="utf-8") as file:
+            events += len(json.load(file)["entry"]) - 1
+    return events
+
+
+def test_once_records_every_file_exactly_once(database, sample_files, tmp_path):
+    inbox = str(tmp_path / "inbox")
+    files = fill_inbox(sample_files, inbox, 10)
+    events = bundle_events(files)
+    with open(os.path.join(inbox, "broken.json"), "w", encoding="utf-8") as file:
+        file.write('{"resourceType": "Bundle", "entry": [')
+    METRICS.reset()
+    # queues shorter than the inbox, so the poller and parsers wait on the writer
+    asyncio.run(ingestDaemon.run_daemon(inbox, queue_depth=2, parse_threads=2, once=True))
+
+    assert manifest_files(database) == sorted(files)
+    assert stored_events(database) == (events, [])
+    assert sorted(os.listdir(os.path.join(inbox, "done"))) == sorted(os.path.basename(path) for path in files)
+    assert os.listdir(os.path.join(inbox, "failed")) == ["broken.json"]
+    assert ingestDaemon.scan_inbox(inbox) == []
+    assert sum(amount for key, amount in METRICS.errors.items() if key.startswith("parse:")) == 1
+
+
+def test_writer_error_fails_the_file_and_carries_on(database, sample_files, tmp_path, monkeypatch):
+    inbox = str(tmp_path / "inbox")
+    files = fill_inbox(sample_files, inbox, 5)
+    events = bundle_events(files)
+    loaded_events = events - bundle_events(files[2:3])
+    write_bundle = ingestDaemon.write_bundle
+
+    def failing_write_bundle(loader, manifest_row, entries):
+        if manifest_row[0] == files[2]:
+            raise RuntimeError("lost connection")
+        return write_bundle(loader, manifest_row, entries)
+    monkeypatch.setattr(ingestDaemon, "write_bundle", failing_write_bundle)
+    METRICS.reset()
+    asyncio.run(ingestDaemon.run_daemon(inbox, queue_depth=2, parse_threads=2, once=True))
+
+    loaded = files[:2] + files[3:]
+    assert manifest_files(database) == sorted(loaded)
+    assert stored_events(database) == (loaded_events, [])
+    assert os.listdir(os.path.join(inbox, "failed")) == [os.path.basename(files[2])]
+    assert len(os.listdir(os.path.join(inbox, "done"))) == 4
+    assert METRICS.errors == {"load_bundle:RuntimeError": 1}
+
+    # the failed file loads once it is put back in the inbox
+    monkeypatch.setattr(ingestDaemon, "write_bundle", write_bundle)
+    shutil.move(os.path.join(inbox, "failed", os.path.basename(files[2])), files[2])
+    asyncio.run(ingestDaemon.run_daemon(inbox, once=True))
+    assert manifest_files(database) == sorted(files)
+    assert stored_events(database) == (events, [])
+
+
+def test_stopping_drains_the_queued_files(database, sample_files, tmp_path, monkeypatch):
+    inbox = str(tmp_path / "inbox")
+    files = fill_inbox(sample_files, inbox, 6)
+    events = bundle_events(files)
+    write_bundle = ingestDaemon.write_bundle
+    writes = []
+
+    def stopping_write_bundle(loader, manifest_row, entries):
+        # every file was queued on the same scan, as the queue holds them all, before the first is written
+        if not writes:
+            os.kill(os.getpid(), signal.SIGTERM)
+        writes.append(manifest_row[0])
+        return write_bundle(loader, manifest_row, entries)
+    monkeypatch.setattr(ingestDaemon, "write_bundle", stopping_write_bundle)
+    # watching rather than once, so it only returns when it is stopped
+    asyncio.run(asyncio.wait_for(ingestDaemon.run_daemon(inbox, poll_interval=0.05, parse_threads=2), 60))
+
+    assert sorted(writes) == sorted(files)
+    assert manifest_files(database) == sorted(files)
+    assert stored_events(database) == (events, [])
+    assert len(os.listdir(os.path.join(inbox, "done"))) == 6
@@ -0,0 +1,77 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import jsonCodec
+from dataReader import content_hash, same_content
+
+CODECS = jsonCodec.available_codecs()
+
+RESOURCE = {
+    "resourceType": "Observation",
+    "id": "o1",
+    "note": [{"text": "Zoë's résumé — 診断 😀 \"quoted\" back\\slash\nnew line"}],
+    "valueQuantity": {"value": 1e16, "small": 1e-7, "large": 1.5e300, "plain": 0.1, "negative": -2.5},
+    "count": 2 ** 63,
+    "flags": [True, False, None],
+}
+
+
+@pytest.fixture(params=CODECS)
+def codec(request):
+    """
+    :return: the name of a codec, which loads and dumps use until the test ends
+    """
+    previous = jsonCodec.CODEC
+    jsonCodec.use_codec(request.param)
+    yield request.param
+    jsonCodec.use_codec(previous)
+
+
+def test_round_trip(codec):
+    text = jsonCodec.dumps(RESOURCE)
+    assert jsonCodec.loads(text) == RESOURCE
+    assert jsonCodec.loads(text.encode("utf-8")) == RESOURCE
+    # compact, with the text kept as UTF-8 rather than escaped
+    assert ": " not in text and ", " not in text
+    assert "Zoë's résumé — 診断 😀" in text
+
+
+def test_codecs_read_each_other(codec):
+    for other in CODECS:
+        jsonCodec.use_codec(other)
+        text = jsonCodec.dumps(RESOURCE)
+        jsonCodec.use_codec(codec)
+        assert jsonCodec.loads(text) == RESOURCE
+
+
+def test_decimal_is_rejected(codec):
+    with pytest.raises(TypeError):
+        jsonCodec.dumps({"value": Decimal("1.10")})
+
+
+def test_encodings_cover_every_codec():
+    texts = jsonCodec.encodings(RESOURCE)
+    assert len(texts) == (2 if len(CODECS) == 2 else 1)
+    assert all(json.loads(text) == RESOURCE for text in texts)
+
+
+def test_unknown_codec_raises():
+    with pytest.raises(ValueError):
+        jsonCodec.use_codec("simdjson")
+
+
+@pytest.mark.parametrize("stored_with", CODECS)
+def test_same_content_across_codecs(codec, stored_with):
+    # a hash stored while the other codec was in use, or by the first version, still matches
+    previous = jsonCodec.CODEC
+    jsonCodec.use_codec(stored_with)
+    stored_hash = content_hash(jsonCodec.dumps(RESOURCE))
+    jsonCodec.use_codec(previous)
+    text = jsonCodec.dumps(RESOURCE)
+    assert same_content(stored_hash, RESOURCE, text)
+    assert same_content(content_hash(json.dumps(RESOURCE)), RESOURCE, text)
+
+    changed = dict(RESOURCE, valueQuantity=dict(RESOURCE["valueQuantity"], value=1e17))
+    assert not same_content(stored_hash, changed, jsonCodec.dumps(changed))
@@ -0,0 +1,68 @@
+import pytest
+
+import dataReader
+from dataReader import UI_SORT_COLUMNS, PatientPager
+
+
+@pytest.fixture
+def patients(database, sample_files):
+    """
+    :return: the patient rows of a database holding six sample bundles, with many given and family names the
+    same and some missing
+    """
+    assert dataReader.load_files(sample_files[:6])["failed"] == []
+    db_cursor = database.cursor()
+    db_cursor.execute("UPDATE patient SET family_name = CASE WHEN patient_id % 3 = 0 THEN NULL "
+                      "WHEN patient_id % 3 = 1 THEN 'Smith' ELSE family_name END")
+    db_cursor.execute("UPDATE patient SET given_name = 'Ana' WHERE patient_id % 2 = 0")
+    database.commit()
+    db_cursor.execute("SELECT patient_id, unique_id, given_name, family_name FROM patient")
+    return db_cursor.fetchall()
+
+
+def walk(pager, patient_count):
+    """
+    Function to read every page going forward from the first, then every page going back to it
+    :param patient_count: the number of patients, more pages than which means a page was read again
+    :return: the pages read going forward and the pages read going back
+    """
+    forward = [pager.read()]
+    while pager.more:
+        assert len(forward) <= patient_count
+        pager.next_page()
+        forward.append(pager.read())
+    back = []
+    while pager.page_number() > 1:
+        pager.previous_page()
+        back.append(pager.read())
+    return forward, back
+
+
+@pytest.mark.parametrize("page_size", [1, 3, 4, 10])
+@pytest.mark.parametrize("order_by", UI_SORT_COLUMNS)
+def test_every_patient_is_on_one_page(database, patients, order_by, page_size):
+    forward, back = walk(PatientPager(database.cursor(), order_by=order_by, page_size=page_size), len(patients))
+
+    assert sorted(row for page in forward for row in page) == sorted(patients)
+    assert all(len(page) == page_size for page in forward[:-1]) and forward[-1]
+    assert back == forward[-2::-1]
+    keys = [PatientPager(None, order_by=order_by).sort_key(row) for page in forward for row in page]
+    assert keys == sorted(keys)
+
+
+@pytest.mark.parametrize("order_by", UI_SORT_COLUMNS)
+def test_search_pages_through_the_matching_patients(database, patients, order_by):
+    forward, back = walk(PatientPager(database.cursor(), "smi", order_by, page_size=2), len(patients))
+
+    assert sorted(row for page in forward for row in page) == sorted(row for row in patients if row[3] == "Smith")
+    assert back == forward[-2::-1]
+
+
+def test_search_escapes_wildcards(database, patients):
+    assert PatientPager(database.cursor(), "_").read() == []
+    assert PatientPager(database.cursor(), "%").read() == []
+
+
+def test_unknown_order_raises():
+    with pytest.raises(ValueError):
+        dataReader.patient_page_query(order_by="birth_date")
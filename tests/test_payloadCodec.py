@@ -0,0 +1,57 @@
+import json
+import zlib
+
+import pytest
+
+import payloadCodec
+from bundleParser import iter_bundle_entries
+
+CODECS = payloadCodec.available_codecs()
+
+
+@pytest.fixture
+def resources(sample_files):
+    """
+    :return: the serialised resources of a few sample bundles
+    """
+    return [json.dumps(entry["resource"]) for file_path in sample_files[:3]
+            for entry in iter_bundle_entries(file_path)]
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_without_dictionary(codec, resources):
+    for text in resources[:200] + ["", '{"note": "caf\\u00e9 é \U0001f600"}']:
+        assert payloadCodec.decompress(payloadCodec.compress(text, codec)) == text
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_with_dictionary(codec, resources):
+    dictionary_id = 9000 + payloadCodec.CODEC_TAGS[codec]
+    dictionary = payloadCodec.train_dictionary(codec, resources)
+    assert dictionary
+    payloadCodec.add_dictionary(dictionary_id, codec, dictionary)
+    plain = with_dictionary = 0
+    for text in resources:
+        payload = payloadCodec.compress(text, codec, dictionary_id)
+        assert payloadCodec.decompress(bytearray(payload)) == text
+        plain += len(payloadCodec.compress(text, codec))
+        with_dictionary += len(payload)
+    # the resources share most of their text, which is what the dictionary is for
+    assert with_dictionary < plain
+
+
+def test_unregistered_dictionary_raises():
+    payload = payloadCodec.HEADER.pack(payloadCodec.CODEC_TAGS["zlib"], 8999) + zlib.compress(b"{}")
+    with pytest.raises(KeyError):
+        payloadCodec.decompress(payload)
+
+
+def test_unknown_codec_raises():
+    with pytest.raises(ValueError):
+        payloadCodec.decompress(payloadCodec.HEADER.pack(99, 0) + b"data")
+    with pytest.raises(ValueError):
+        payloadCodec.check_codec("lz4")
+
+
+def test_too_few_samples_give_no_dictionary():
+    assert payloadCodec.train_dictionary("zlib", ['{"a": 1}']) is None
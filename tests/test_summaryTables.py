@@ -0,0 +1,98 @@
+import json
+import shutil
+
+import dataReader
+from summaryTables import SUMMARY_TABLE_COLUMNS, SUMMARY_TABLES, rebuild_summaries
+
+
+def summary_rows(con):
+    """
+    :return: the rows of every summary table, without the generated ids, in a fixed order
+    """
+    db_cursor = con.cursor()
+    tables = {}
+    for table in SUMMARY_TABLES:
+        db_cursor.execute("SELECT * FROM " + table)
+        rows = [tuple(row[1:] if table in SUMMARY_TABLE_COLUMNS else row) for row in db_cursor.fetchall()]
+        tables[table] = sorted(rows, key=repr)
+    return tables
+
+
+def rebuilt_rows(con):
+    """
+    :return: the summary rows once they have been recomputed from the typed tables
+    """
+    loader = dataReader.BulkLoader(con)
+    rebuild_summaries(loader)
+    loader.commit()
+    return summary_rows(con)
+
+
+def test_summaries_after_ingest_match_rebuild(database, sample_files):
+    dataReader.load_files(sample_files[:6], bundles_per_commit=2)
+    loaded = summary_rows(database)
+    assert loaded["summary_encounter_month"] and loaded["summary_claim_month"]
+    assert rebuilt_rows(database) == loaded
+
+
+def change_resources(bundle):
+    """
+    Function to change the summarised content of a bundle's resources in place, keeping their ids
+    Claims alternately cost more and less and every third moves to another year, every other encounter moves to
+    another year and each condition's clinical status is flipped.
+    :param bundle: the decoded bundle
+    :return:
+    """
+    claims = encounters = 0
+    for entry in bundle["entry"]:
+        resource = entry["resource"]
+        if resource["resourceType"] == "Claim":
+            total = resource["total"]
+            total["value"] = round(total["value"] + 100.37 if claims % 2 else total["value"] / 2 - 0.01, 2)
+            if claims % 3 == 0:
+                for key in ("start", "end"):
+                    resource["billablePeriod"][key] = "1990" + resource["billablePeriod"][key][4:]
+            claims += 1
+        elif resource["resourceType"] == "Encounter":
+            if encounters % 2 == 0:
+                for key in ("start", "end"):
+                    resource["period"][key] = "1991" + resource["period"][key][4:]
+            encounters += 1
+        elif resource["resourceType"] == "Condition":
+            coding = resource["clinicalStatus"]["coding"][0]
+            coding["code"] = "resolved" if coding["code"] == "active" else "active"
+
+
+def test_summaries_after_reload_match_rebuild(database, sample_files, tmp_path):
+    files = [str(tmp_path / ("bundle" + str(number) + ".json")) for number in range(3)]
+    for source, file_path in zip(sample_files, files):
+        shutil.copy(source, file_path)
+    dataReader.load_files(files)
+    db_cursor = database.cursor()
+    db_cursor.execute("SELECT COUNT(*) FROM patient_event")
+    events = db_cursor.fetchone()[0]
+    loaded = summary_rows(database)
+
+    # changed resources replace the stored events, so the patient's share of each summary is adjusted
+    with open(files[0], encoding="utf-8") as file:
+        bundle = json.load(file)
+    change_resources(bundle)
+    with open(files[0], "w", encoding="utf-8") as file:
+        json.dump(bundle, file)
+    dataReader.load_files(files)
+    reloaded = summary_rows(database)
+
+    db_cursor.execute("SELECT COUNT(*) FROM patient_event")
+    assert db_cursor.fetchone()[0] == events
+    for table in ("summary_encounter_month", "summary_condition_prevalence", "summary_claim_month"):
+        assert reloaded[table] != loaded[table]
+    claims_before = {month: float(total) for month, _, total in loaded["summary_claim_month"]}
+    claims_after = {month: float(total) for month, _, total in reloaded["summary_claim_month"]}
+    changes = [claims_after.get(month, 0) - claims_before.get(month, 0)
+               for month in set(claims_before) | set(claims_after)]
+    assert min(changes) < 0 < max(changes)
+    active_before = {code: active for code, _, _, active in loaded["summary_condition_prevalence"]}
+    active_after = {code: active for code, _, _, active in reloaded["summary_condition_prevalence"]}
+    changes = [active_after[code] - active_before[code] for code in active_before]
+    assert min(changes) < 0 < max(changes)
+    assert rebuilt_rows(database) == reloaded